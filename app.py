@@ -1,15 +1,26 @@
 
+import time
+_run_started = time.perf_counter()
+
 import streamlit as st
 import pandas as pd
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
 import os
 import json
-import time
+import itertools
+import datetime
 from streamlit_quill import st_quill
+from progress import ProgressReporter, describe_progress
+from attachments import AttachmentStore, AttachmentError, AttachmentPrefetcher, check_message_size
+from smtp_accounts import ACCOUNT_FIELDS, account_from_settings, accounts_from_config, is_local
+# The SMTP/email stack, the work queue, recipient file readers, suppression and domain checks
+# are imported where they are used, so the first page load of a new session does not wait for
+# them. pandas is needed by the sidebar on every run; the rest here is standard library only.
+from scheduler import default_timezone_name, get_scheduler, resolve_timezone, run_in_background
+from governor import describe_governor, get_governor
+from templating import TemplateError, compile_template, render_template
+from html_optimizer import optimize_html
+from inline_images import prepare_body
+from shared_cache import content_key, describe_cache, get_cache
 
 # Page Configuration
 st.set_page_config(
@@ -128,34 +139,51 @@ def save_templates(templates):
         json.dump(templates, f, indent=4)
 
 
-def send_email(smtp_settings, recipient_email, subject, body_html, attachments=None):
-    """Send a single email via SMTP"""
-    msg = MIMEMultipart()
-    msg['From'] = smtp_settings['sender_email']
-    msg['To'] = recipient_email
-    msg['Subject'] = subject
-    if smtp_settings.get('reply_to'):
-        msg['Reply-To'] = smtp_settings['reply_to']
+def get_attachment_store():
+    """Return this session's attachment spool (files on disk, not in memory, shared with other sessions)"""
+    if 'attachment_store' not in st.session_state:
+        st.session_state.attachment_store = AttachmentStore(shared=get_cache())
+    return st.session_state.attachment_store
+
 
-    msg.attach(MIMEText(body_html, 'html'))
+def recipient_table(source):
+    """Return the uploaded recipients with only the columns the current campaign reads"""
+    from recipients import campaign_columns
+    return source.table(campaign_columns(
+        source.columns, st.session_state.get('subject_text', ''), st.session_state.get('email_body', ''),
+        st.session_state.get('email_col'), st.session_state.get('name_col'),
+        extra=(st.session_state.get('attachment_col'), st.session_state.get('tz_col'))
+    ))
 
+
+def show_profile(report):
+    """Summarize a profile capture and offer its reports for download"""
+    from profiling import describe_profile
+    st.caption(f"🔬 {describe_profile(report)}")
+    for path in report.files:
+        with open(path, 'rb') as f:
+            st.download_button(f"⬇️ {os.path.basename(path)}", f.read(), file_name=os.path.basename(path), key=path)
+
+
+def send_email(smtp_settings, recipient_email, subject, body_html, attachments=None, inline_images=None):
+    """Send a single email via SMTP"""
     if attachments:
-        for file in attachments:
-            try:
-                # In Streamlit, file is an UploadedFile object
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(file.getvalue())
-                encoders.encode_base64(part)
-                part.add_header('Content-Disposition', f'attachment; filename="{file.name}"')
-                msg.attach(part)
-            except Exception as e:
-                return False, f"Attachment error: {str(e)}"
+        try:
+            # Attachments are spooled files, encoded once and streamed into each message
+            for attachment in attachments:
+                attachment.prepare()
+        except Exception as e:
+            return False, f"Attachment error: {str(e)}"
+
+    from message_builder import build_message
+    from transports import open_transport
 
     try:
-        server = smtplib.SMTP(smtp_settings['server'], int(smtp_settings['port']))
-        server.starttls()
-        server.login(smtp_settings['username'], smtp_settings['password'])
-        server.sendmail(smtp_settings['sender_email'], recipient_email, msg.as_string())
+        server = open_transport(smtp_settings)
+        msg = build_message(smtp_settings['sender_email'], recipient_email, subject, body_html,
+                            attachments, reply_to=smtp_settings.get('reply_to'), inline_images=inline_images,
+                            eight_bit=server.eight_bit)
+        server.deliver(smtp_settings['sender_email'], recipient_email, msg)
         server.quit()
         return True, "Sent successfully"
     except Exception as e:
@@ -172,20 +200,39 @@ with st.sidebar:
             st.session_state.update(loaded_conf)
             st.success("Configuration loaded! (Enter password below)")
     
-    smtp_server = st.text_input("SMTP Server", value=st.session_state.get('smtp_server', 'email-smtp.ap-south-1.amazonaws.com'))
-    smtp_port = st.text_input("SMTP Port", value=st.session_state.get('smtp_port', '587'))
+    smtp_server = st.text_input("SMTP Server", value=st.session_state.get('smtp_server', 'email-smtp.ap-south-1.amazonaws.com'),
+                                help="Or deliver locally, with no login: sendmail:///usr/sbin/sendmail, "
+                                     "pickup:///path/to/pickup, maildir:///path/to/outbox or mbox:///path/to/file.mbox")
+    smtp_port = st.text_input("SMTP Port", value=st.session_state.get('smtp_port', '587'),
+                              help="587 uses STARTTLS; 465 uses implicit TLS.")
     username = st.text_input("Username", value=st.session_state.get('username', ''))
     password = st.text_input("Password", type="password", value=st.session_state.get('password', ''))
     sender_email = st.text_input("Sender Email", value=st.session_state.get('sender_email', ''))
     reply_to = st.text_input("Reply-To Email", value=st.session_state.get('reply_to_email', 'info@mulearn.org'))
     
+    # Extra accounts/relays share bulk campaigns with the one above, by weight
+    with st.expander("🔀 Additional SMTP Accounts"):
+        st.caption("Bulk sends are spread across all accounts by weight, each within its own rate "
+                   "(emails/sec, empty = unlimited). A failing account's share moves to the others.")
+        accounts_df = pd.DataFrame(st.session_state.get('accounts') or [], columns=ACCOUNT_FIELDS)
+        edited_accounts = st.data_editor(accounts_df, num_rows="dynamic", key="accounts_editor", use_container_width=True)
+        edited_accounts = edited_accounts.astype(object).where(edited_accounts.notna(), None)
+        extra_accounts = [a for a in edited_accounts.to_dict('records') if a.get('server')]
+        
+        account_passwords = {}
+        for i, account in enumerate(extra_accounts):
+            account['name'] = account.get('name') or f"Account {i + 1}"
+            account_passwords[account['name']] = st.text_input(f"Password for {account['name']}", type="password",
+                                                               key=f"account_password_{account['name']}")
+    
     if st.button("💾 Save Config (Safe)"):
         conf_to_save = {
             'smtp_server': smtp_server,
             'smtp_port': smtp_port,
             'username': username,
             'sender_email': sender_email,
-            'reply_to_email': reply_to
+            'reply_to_email': reply_to,
+            'accounts': extra_accounts
         }
         save_config(conf_to_save)
         st.success("Settings saved (Password not saved)")
@@ -202,25 +249,38 @@ tab1, tab2, tab3 = st.tabs(["1️⃣ Upload & Data", "2️⃣ Compose & Attachme
 
 # --- TAB 1: DATA ---
 with tab1:
+    from recipients import EXTENSIONS, shared_source
     st.subheader("📊 Upload Recipient Data")
-    uploaded_file = st.file_uploader("Upload CSV File (Req: Name, Email columns)", type=['csv'])
+    uploaded_file = st.file_uploader("Upload Recipients (CSV, Excel, Parquet or Arrow; Req: Name, Email columns)",
+                                     type=list(EXTENSIONS))
     
     if uploaded_file is not None:
         try:
-            df = pd.read_csv(uploaded_file)
-            st.session_state['csv_data'] = df
-            st.success(f"Loaded {len(df)} recipients successfully!")
+            # Only the header is parsed here; column data is read once the campaign needs it.
+            # Sessions that upload the same file share one table; the lease is released with the session
+            # Keyed on the upload itself: an edited file can have the same name and size
+            file_key = getattr(uploaded_file, 'file_id', None) or content_key('recipients', uploaded_file.getvalue())
+            if st.session_state.get('recipients_key') != file_key:
+                if 'recipients_lease' in st.session_state:
+                    st.session_state['recipients_lease'].release()
+                lease = shared_source(get_cache(), uploaded_file.getvalue(), uploaded_file.name)
+                st.session_state['recipients_lease'] = lease
+                st.session_state['recipients'] = lease.value
+                st.session_state['recipients_key'] = file_key
+            source = st.session_state['recipients']
+            st.success(f"Loaded {len(source)} recipients successfully!")
             
             with st.expander("👀 View Data Preview"):
-                st.dataframe(df.head())
+                st.dataframe(source.head())
             
             st.divider()
             st.subheader("🛠️ Map Columns")
             
             # Smart detection of columns
-            all_cols = list(df.columns)
+            all_cols = source.columns
             email_default_idx = 0
             name_default_idx = 0
+            attach_default_idx = 0
             
             # Try to find 'email' and 'name' in columns (case-insensitive)
             for i, col in enumerate(all_cols):
@@ -228,6 +288,8 @@ with tab1:
                     email_default_idx = i
                 if 'name' in col.lower():
                     name_default_idx = i
+                if any(k in col.lower() for k in ('attach', 'certificate', 'file')):
+                    attach_default_idx = i + 1
             
             # Column Selectors
             col1, col2 = st.columns(2)
@@ -238,12 +300,84 @@ with tab1:
                 name_col = st.selectbox("Select Name Column", all_cols, index=name_default_idx)
                 st.session_state['name_col'] = name_col
             
+            # Optional per-recipient attachment column (file names inside the ZIP uploaded in Tab 2)
+            attach_options = ["(none)"] + all_cols
+            attach_col = st.selectbox("Per-Recipient Attachment Column (optional)", attach_options, index=attach_default_idx,
+                                      help="Each row names its own file(s), e.g. a certificate PDF. Separate several files with ';'.")
+            st.session_state['attachment_col'] = None if attach_col == "(none)" else attach_col
+            
             st.info(f"Using **{email_col}** for emails and **{name_col}** for names.")
+            
+            # Mapped columns plus the ones the subject and body refer to
+            df = recipient_table(source)
+            st.caption(f"{len(df.columns)} of {len(all_cols)} columns in memory: {', '.join(map(str, df.columns))}")
+            # Sizing walks every cached table, so it is only done on request
+            if st.button("📏 Measure Memory Use"):
+                st.caption(f"Loaded columns: {source.memory_usage() / 1e6:.1f} MB. "
+                           f"Shared cache: {describe_cache(get_cache().stats())}")
+            
+            # Checked again only when the list, the email column or the suppression list changes
+            from suppression import list_generation, suppressed_rows
+            suppression_key = (st.session_state['recipients_key'], email_col, list_generation())
+            if st.session_state.get('suppressed_key') != suppression_key:
+                st.session_state['suppressed_count'] = len(suppressed_rows(df[email_col]))
+                st.session_state['suppressed_key'] = suppression_key
+            suppressed_count = st.session_state['suppressed_count']
+            if suppressed_count:
+                st.warning(f"🚫 {suppressed_count} recipients are on the suppression list and will be skipped.")
+            
+            # Each unique domain is looked up once; answers are cached until their DNS TTL expires
+            if st.button("🔎 Check Recipient Domains"):
+                from domain_check import undeliverable_rows
+                with st.spinner("Looking up recipient domains..."):
+                    undeliverable = undeliverable_rows(df[email_col])
+                if undeliverable:
+                    st.warning(f"⚠️ {len(undeliverable)} recipients cannot receive mail and will be skipped.")
+                    problems = pd.Series(undeliverable).value_counts()
+                    st.dataframe(pd.DataFrame({'Problem': problems.index, 'Recipients': problems.values}))
+                else:
+                    st.success("All recipient domains can receive mail.")
                 
         except Exception as e:
-            st.error(f"Error reading CSV: {e}")
+            st.error(f"Error reading recipient file: {e}")
     else:
-        st.info("👆 Please upload a CSV file to begin.")
+        st.info("👆 Please upload a recipient list to begin.")
+    
+    # Unsubscribes and hard bounces, checked against every campaign before sending
+    with st.expander("🚫 Suppression List"):
+        from suppression import REASONS, SuppressionList
+        # Counting a large list takes a moment, so it is only done on request
+        if st.button("📊 Count Suppressed Addresses"):
+            suppressions = SuppressionList()
+            try:
+                counts = suppressions.counts()
+            finally:
+                suppressions.close()
+            st.write(f"**{sum(counts.values())}** suppressed addresses"
+                     + (" — " + ", ".join(f"{reason}: {count}" for reason, count in counts.items()) if counts else ""))
+        sup_reason = st.selectbox("Reason", REASONS, key='suppression_reason')
+        sup_file = st.file_uploader("Add a list (CSV or Excel with an email column)", type=['csv', 'xlsx'],
+                                    key='suppression_file')
+        sup_text = st.text_area("Or enter addresses (one per line)", key='suppression_text')
+        sup_add, sup_remove = st.columns(2)
+        with sup_add:
+            if st.button("➕ Add to Suppression List"):
+                suppressions = SuppressionList()
+                try:
+                    added = suppressions.add_file(sup_file, sup_reason) if sup_file is not None else 0
+                    added += suppressions.add(sup_text.split(), sup_reason, source='manual entry')
+                    st.success(f"Added {added} new addresses.")
+                except Exception as e:
+                    st.error(f"Could not read the list: {e}")
+                finally:
+                    suppressions.close()
+        with sup_remove:
+            if st.button("➖ Remove Entered Addresses"):
+                suppressions = SuppressionList()
+                try:
+                    st.success(f"Removed {suppressions.remove(sup_text.split())} addresses.")
+                finally:
+                    suppressions.close()
 
 # --- TAB 2: COMPOSE ---
 with tab2:
@@ -274,6 +408,8 @@ with tab2:
                 st.rerun()
 
         email_subject = st.text_input("Subject Line", value=st.session_state.get('email_subject', ''))
+        # Tab 1 reads it to decide which columns to load
+        st.session_state['subject_text'] = email_subject
             
         # Initialize session state for body if not exists
         if 'email_body' not in st.session_state:
@@ -341,8 +477,31 @@ with tab2:
         st.subheader("📎 Attachments")
         uploaded_attachments = st.file_uploader("Add Files", accept_multiple_files=True)
         
+        # Spool uploads to disk once; every send streams them from there
+        attachment_error = None
+        try:
+            spooled_attachments = get_attachment_store().spool_uploads(uploaded_attachments)
+        except AttachmentError as e:
+            spooled_attachments = []
+            attachment_error = str(e)
+            st.error(f"📎 {attachment_error}")
+        
+        # Per-recipient files are uploaded as one ZIP and picked per row by the attachment column
+        attachment_col = st.session_state.get('attachment_col')
+        per_recipient_dir = None
+        if attachment_col:
+            per_recipient_zip = st.file_uploader(f"Per-Recipient Files (ZIP, named in '{attachment_col}')", type=['zip'])
+            if per_recipient_zip is not None:
+                try:
+                    zip_key = getattr(per_recipient_zip, 'file_id', None) or (per_recipient_zip.name, per_recipient_zip.size)
+                    per_recipient_dir = get_attachment_store().add_archive(zip_key, per_recipient_zip)
+                except Exception as e:
+                    st.error(f"📎 Could not read ZIP: {e}")
+        # Hosted app: per-row paths may only point inside the uploaded ZIP
+        row_attachments = AttachmentPrefetcher(attachment_col, base_dir=per_recipient_dir, confine=True)
+        
         st.subheader("🧩 Variables")
-        if 'csv_data' in st.session_state:
+        if 'recipients' in st.session_state:
             st.info("💡 **Tip:** Click a variable below to append it to your email body. The editor will reload to reflect changes.")
             
             # Helper to append variable
@@ -358,11 +517,20 @@ with tab2:
 
             # Create a grid of buttons
             cols = st.columns(3)
-            for i, col_name in enumerate(st.session_state['csv_data'].columns):
+            for i, col_name in enumerate(st.session_state['recipients'].columns):
                 with cols[i % 3]:
                     st.button(f"{{{col_name}}}", key=f"btn_{col_name}", on_click=append_var, args=(col_name,))
         else:
-            st.warning("Upload CSV to see variables")
+            st.warning("Upload recipients to see variables")
+        
+        with st.expander("🧠 Template Logic"):
+            st.markdown(
+                "- `{Name|default:\"there\"}` fallback when a value is empty\n"
+                "- `{Name|first|title}` filters: `upper`, `lower`, `title`, `first`, `strip`, `escape`, `truncate:40`, `join`, `count`\n"
+                "- `{% if Segment == \"student\" %}...{% elif Score >= 80 %}...{% else %}...{% endif %}`\n"
+                "- `{% for course in Courses %}<li>{course}</li>{% endfor %}` (splits on `;`, or `Courses|split:\",\"`)\n"
+                "- Columns with spaces inside `{% %}` tags: `[First Name]`"
+            )
 
 
 # --- TAB 3: PREVIEW & SEND ---
@@ -378,10 +546,12 @@ with tab3:
             q_test_name = st.text_input("Recipient Name (for {Name} variable)", placeholder="Test User")
             
         if st.button("🚀 Send Quick Test"):
-             if not password:
+             if not password and not is_local(smtp_server):
                 st.error("Please enter SMTP Password in Sidebar first!")
              elif not q_test_email:
                 st.error("Please enter a recipient email.")
+             elif attachment_error:
+                st.error(f"Please fix attachments first: {attachment_error}")
              else:
                 # Mock a row for variables
                 # We use the manually entered name for {Name}
@@ -391,21 +561,23 @@ with tab3:
                 current_body = st.session_state.get('email_body', '')
                 current_subject = st.session_state.get('email_subject', '')
                 
-                # Replace Name
-                test_body = current_body.replace("{Name}", q_test_name)
-                test_subject = current_subject.replace("{Name}", q_test_name)
-                
-                # Replace other variables with placeholders
-                # (Simple regex or loop could work if we knew all vars, but standard replace is safe enough)
-                
-                smtp_settings = {
-                    'server': smtp_server, 'port': smtp_port,
-                    'username': username, 'password': password,
-                    'sender_email': sender_email, 'reply_to': reply_to
-                }
-                
-                with st.spinner("Sending..."):
-                    success, msg = send_email(smtp_settings, q_test_email, test_subject, test_body, uploaded_attachments)
+                # Render with only Name set; other variables fall back to their defaults
+                try:
+                    test_html, test_images = prepare_body(current_body)
+                    test_body = render_template(test_html, {'Name': q_test_name})
+                    test_subject = render_template(current_subject, {'Name': q_test_name})
+                except TemplateError as e:
+                    success, msg = False, f"Template error: {e}"
+                else:
+                    smtp_settings = {
+                        'server': smtp_server, 'port': smtp_port,
+                        'username': username, 'password': password,
+                        'sender_email': sender_email, 'reply_to': reply_to
+                    }
+                    
+                    with st.spinner("Sending..."):
+                        success, msg = send_email(smtp_settings, q_test_email, test_subject, test_body, spooled_attachments,
+                                                  test_images)
                 
                 if success:
                     st.success(f"✅ Test email sent to {q_test_email}!")
@@ -414,8 +586,9 @@ with tab3:
 
     st.divider()
 
-    if 'csv_data' in st.session_state:
-        df = st.session_state['csv_data']
+    if 'recipients' in st.session_state:
+        # Reloads only the columns this run's template newly refers to
+        df = recipient_table(st.session_state['recipients'])
         
         # Previewer
         preview_index = st.number_input("Preview Row Index", min_value=0, max_value=len(df)-1, value=0, step=1)
@@ -427,18 +600,31 @@ with tab3:
             email_col = st.session_state.get('email_col', 'Email')
             name_col = st.session_state.get('name_col', 'Name')
             
-            # Replace Variables
-            preview_subject = email_subject.replace("{Name}", str(row.get(name_col, '')))
-            
-            # Get current body from state
+            # Get current body from state; CSS is inlined and markup minified once per template
             current_body = st.session_state.get('email_body', '')
-            preview_body = current_body
-            for col in df.columns:
-                preview_body = preview_body.replace(f"{{{col}}}", str(row[col]))
+            optimized_body = optimize_html(current_body)
+            # What actually goes out: pasted images become shared cid: parts
+            send_body, inline_images = prepare_body(current_body)
+            
+            # Render variables, conditionals and loops ({Name} in the subject is the mapped name column)
+            template_error = None
+            try:
+                preview_subject = render_template(email_subject, {**row.to_dict(), 'Name': row.get(name_col, '')})
+                preview_body = render_template(optimized_body, row.to_dict())
+            except TemplateError as e:
+                template_error = str(e)
+                preview_subject, preview_body = email_subject, current_body
+                st.error(f"Template error: {template_error}")
             
             st.markdown("### 👁️ Email Preview")
             st.markdown(f"**To:** {row.get(email_col, 'Unknown')}")
             st.markdown(f"**Subject:** {preview_subject}")
+            if current_body:
+                st.caption(f"HTML optimized: {len(current_body.encode()):,} → {len(send_body.encode()):,} bytes "
+                           "(CSS inlined, whitespace removed"
+                           + (f", {len(inline_images)} images sent as shared inline parts)" if inline_images else ")"))
+            if attachment_col:
+                st.markdown(f"**Per-Recipient Attachment:** {row.get(attachment_col, '')}")
             
             # HTML Preview container
             # Wrap in a white container to simulate actual email appearance and ensure readability in Dark Mode
@@ -458,15 +644,29 @@ with tab3:
                 st.markdown("### 🧪 Test Send")
                 test_email = st.text_input("Test Email Address", value=row.get(email_col, ''))
                 if st.button("🚀 Send Test Email"):
-                    if not password:
+                    if not password and not is_local(smtp_server):
                         st.error("Please enter SMTP Password in Sidebar!")
+                    elif attachment_error:
+                        st.error(f"Please fix attachments first: {attachment_error}")
+                    elif template_error:
+                        st.error(f"Please fix the template first: {template_error}")
                     else:
                         smtp_settings = {
                             'server': smtp_server, 'port': smtp_port,
                             'username': username, 'password': password,
                             'sender_email': sender_email, 'reply_to': reply_to
                         }
-                        success, msg = send_email(smtp_settings, test_email, preview_subject, preview_body, uploaded_attachments)
+                        prefetched = row_attachments.load_row(row)
+                        if prefetched.error:
+                            success, msg = False, f"Attachment error: {prefetched.error}"
+                        else:
+                            try:
+                                test_body = render_template(send_body, row.to_dict())
+                            except TemplateError as e:
+                                success, msg = False, f"Template error: {e}"
+                            else:
+                                success, msg = send_email(smtp_settings, test_email, preview_subject, test_body,
+                                                          spooled_attachments + prefetched.attachments, inline_images)
                         if success:
                             st.success(f"✅ Test email sent to {test_email}")
                         else:
@@ -475,15 +675,105 @@ with tab3:
             with col_send2:
                 st.markdown("### 🌍 Bulk Send")
                 st.write(f"Ready to send to **{len(df)} recipients**.")
+                # Campaigns already sending from this server share the account limits with this one
+                for governed in get_governor().stats():
+                    st.caption(f"🚦 Sending now: {describe_governor(governed)}")
                 
                 # Batch Configuration
                 with st.expander("⚙️ Batch Settings", expanded=False):
                     batch_size = st.number_input("Emails per Batch", min_value=1, max_value=500, value=50)
                     pause_seconds = st.number_input("Pause between Batches (seconds)", min_value=0, max_value=300, value=10)
+                    max_rate = st.number_input("Max Emails per Second (0 = unlimited)", min_value=0.0, max_value=100.0, value=0.0, step=0.5,
+                                               help="Rate limit for the sidebar account. Additional accounts use their own 'rate'.")
+                    connections = st.number_input("Parallel Connections", min_value=1, max_value=20, value=1,
+                                                  help="SMTP connections kept open for the sidebar account.")
+                    max_attempts = st.number_input("Max Attempts per Recipient", min_value=1, max_value=10, value=4,
+                                                   help="Temporary (4xx) errors and dropped connections are retried with backoff; 5xx rejections are not.")
+                    check_domains = st.checkbox("Skip recipients on undeliverable domains", value=True,
+                                                help="Unique domains are looked up (and cached) before sending; "
+                                                     "addresses on domains that do not exist or take no mail are skipped.")
+                    progress_interval = st.number_input("Progress Update Interval (seconds)", min_value=0.1, max_value=10.0, value=0.5, step=0.1,
+                                                        help="Progress is redrawn at most this often to keep the browser responsive.")
+                    from render_pool import default_processes
+                    render_processes = st.number_input("Render Processes", min_value=1, max_value=64, value=default_processes(len(df)),
+                                                       help="Personalize and build messages on this many CPU cores, ahead of the "
+                                                            "senders. 1 renders them on the sending thread.")
+                    profile_seconds = st.number_input("Profile the First Seconds of the Run (0 = off)", min_value=0, max_value=3600, value=0,
+                                                      help="Samples where CPU time goes and which lines allocate memory. The reports "
+                                                           "(flame graph input and top allocators) are saved under ./profiles "
+                                                           "and offered for download when the run ends.")
+                
+                # Scheduling: spread the campaign across a window instead of sending flat out
+                with st.expander("📅 Schedule", expanded=False):
+                    schedule_enabled = st.checkbox("Schedule instead of sending now",
+                                                   help="Recipients are spread evenly between the start and the deadline. "
+                                                        "Scheduled campaigns run in the background on the server.")
+                    schedule_tz = st.text_input("Campaign Timezone", value=default_timezone_name(),
+                                                help="IANA name, e.g. Asia/Kolkata. Start and deadline are wall-clock "
+                                                     "times in this zone (the server's own when empty).")
+                    # Defaults are the current time in the campaign's zone, not the server's
+                    now = datetime.datetime.now(resolve_timezone(schedule_tz)).replace(tzinfo=None, second=0, microsecond=0)
+                    later = now + datetime.timedelta(hours=8)
+                    sc_col1, sc_col2 = st.columns(2)
+                    with sc_col1:
+                        start_date = st.date_input("Start Date", value=now.date())
+                        start_time = st.time_input("Start Time", value=now.time())
+                    with sc_col2:
+                        deadline_date = st.date_input("Deadline Date", value=later.date())
+                        deadline_time = st.time_input("Deadline Time", value=later.time())
+                    schedule_start = datetime.datetime.combine(start_date, start_time)
+                    schedule_deadline = datetime.datetime.combine(deadline_date, deadline_time)
+                    tz_options = ["(none)"] + st.session_state['recipients'].columns
+                    tz_col = st.selectbox("Recipient Timezone Column (optional)", tz_options, key='tz_col',
+                                          help="When set, start and deadline apply in each recipient's own timezone.")
+                    schedule_priority = st.number_input("Priority (higher goes first)", min_value=0, max_value=10, value=5)
+                    scheduler_rate = st.number_input("Shared Rate for All Scheduled Campaigns (emails/sec, 0 = unlimited)",
+                                                     min_value=0.0, max_value=100.0, value=float(get_scheduler().rate or 0), step=0.5)
+                
+                # Shared work queue: worker processes (here or on other hosts) claim chunks of recipients
+                with st.expander("🧵 Worker Processes", expanded=False):
+                    queue_enabled = st.checkbox("Send through a shared work queue",
+                                                help="The campaign is split into chunks in a SQLite file. Worker processes "
+                                                     "lease chunks and send them in parallel; a crashed worker's chunks "
+                                                     "are picked up by the others.")
+                    queue_path = st.text_input("Queue File", value=st.session_state.get('queue_path', 'campaigns.db'),
+                                               key='queue_path',
+                                               help="Put this on shared storage to add workers on other hosts: "
+                                                    "python work_queue.py <file>")
+                    chunk_size = st.number_input("Recipients per Chunk", min_value=1, max_value=500, value=100)
+                    local_workers = st.number_input("Worker Processes on this Server", min_value=0, max_value=32,
+                                                    value=min(4, os.cpu_count() or 1))
+                
+                # Render everything to disk first; a separate dispatcher process delivers it
+                with st.expander("📬 Render to Spool", expanded=False):
+                    spool_enabled = st.checkbox("Render to a spool instead of sending",
+                                                help="Every message is rendered at full speed into a directory of "
+                                                     "ready-to-send .eml files, with no network. Use it as a dry run "
+                                                     "or throughput test, or deliver it with: python spool.py dispatch <dir>")
+                    spool_path = st.text_input("Spool Directory", value=st.session_state.get('spool_path', 'outbox'),
+                                               key='spool_path')
+                    spool_layout = st.radio("Layout", ["Maildir", ".eml files"], horizontal=True,
+                                            help="A Maildir can be opened in a mail client to inspect the rendered messages.")
+                    start_dispatcher = st.checkbox("Start a dispatcher when rendering finishes", value=False)
+                
+                # Size checks run before the campaign starts, not per recipient
+                size_error = attachment_error or (f"template error: {template_error}" if template_error else None)
+                if not size_error:
+                    try:
+                        # Each row's own files are checked against what is left when they are loaded
+                        row_attachments.message_bytes = check_message_size(send_body, spooled_attachments + inline_images)
+                    except AttachmentError as e:
+                        size_error = str(e)
+                if not size_error and attachment_col and per_recipient_dir is None:
+                    size_error = f"upload a ZIP with the files named in '{attachment_col}' (Tab 2)"
                 
                 if st.button("🔥 Start Bulk Sending"):
-                    if not password:
+                    if not password and not is_local(smtp_server):
                         st.error("Please enter SMTP Password in Sidebar!")
+                    elif size_error:
+                        st.error(f"Cannot start campaign: {size_error}")
+                    elif schedule_enabled and schedule_deadline <= schedule_start:
+                        st.error("The deadline must be after the start!")
                     else:
                         smtp_settings = {
                             'server': smtp_server, 'port': smtp_port,
@@ -497,50 +787,260 @@ with tab3:
                         
                         total_emails = len(df)
                         
-                        # Process in batches
-                        for batch_start in range(0, total_emails, batch_size):
-                            batch_end = min(batch_start + batch_size, total_emails)
-                            batch_df = df.iloc[batch_start:batch_end]
+                        # Coalesce progress redraws: each call is a websocket delta to the browser
+                        def show_progress(snapshot):
+                            progress_bar.progress(snapshot.processed / total_emails)
+                            status_text.text(describe_progress(snapshot))
+                        
+                        reporter = ProgressReporter(total_emails, show_progress, min_interval=progress_interval)
+                        
+                        # Encode attachments once for the whole campaign
+                        get_attachment_store().prepare()
+                        
+                        # Per-row files are read and encoded ahead of the send loop on background threads
+                        row_stream = row_attachments.iterate(df.iterrows())
+                        
+                        # All configured accounts send concurrently, each over persistent connections
+                        accounts = [account_from_settings(smtp_settings, rate=max_rate, connections=connections)]
+                        accounts += accounts_from_config(extra_accounts, account_passwords)
+                        from message_builder import choose_body_encoding
+                        from retries import RetryPolicy
+                        from send_engine import SendEngine, SendJob, settled_job
+                        from profiling import ProfileCapture
+                        profile = ProfileCapture(seconds=profile_seconds) if profile_seconds else None
+                        # Every campaign on this server takes its sends from the same per-account limits
+                        engine = SendEngine(accounts, retry_policy=RetryPolicy(max_attempts=max_attempts),
+                                            governor=get_governor(), profile=profile)
+                        from transports import describe_tls, tls_stats
+                        tls_before = tls_stats()
+                        
+                        # Personalize on the engine's dispatch thread (no Streamlit calls in here).
+                        # Compile once; each row is then a single function call over the image-free HTML
+                        render_body = compile_template(send_body, tuple(df.columns))
+                        render_subject = compile_template(email_subject, tuple(df.columns) + ('Name',))
+                        # Pick the HTML transfer encoding once from the template; each message only re-checks it
+                        body_encoding = choose_body_encoding(send_body, eight_bit=True)
+                        
+                        # Checked once for the whole column before any SMTP work
+                        from suppression import suppressed_rows
+                        skip_rows = {}
+                        if check_domains:
+                            from domain_check import undeliverable_rows
+                            status_text.text("🔎 Checking recipient domains...")
+                            skip_rows.update((i, f"Undeliverable: {reason}") for i, reason in undeliverable_rows(df[email_col]).items())
+                        skip_rows.update((i, f"Suppressed ({reason})") for i, reason in suppressed_rows(df[email_col]).items())
+                        
+                        def make_job(i, r, prefetched):
+                            # Get correct email and name
+                            target_email = r.get(email_col)
+                            target_name = r.get(name_col, '')
+                            # Blank, skipped and attachment-error rows settle the same way as on the render pool
+                            settled = settled_job(i, target_email, skip_rows.get(i), prefetched)
+                            if settled is not None:
+                                return settled
                             
-                            current_batch_num = (batch_start // batch_size) + 1
-                            total_batches = (total_emails + batch_size - 1) // batch_size
+                            # Personalize
+                            values = r.to_dict()
+                            p_curr_body = render_body(values)
+                            p_curr_sub = render_subject({**values, 'Name': target_name})
                             
-                            status_text.text(f"Processing Batch {current_batch_num}/{total_batches} ({batch_start+1}-{batch_end})...")
+                            return SendJob(i, target_email, p_curr_sub, p_curr_body,
+                                           spooled_attachments + prefetched.attachments,
+                                           inline_images=inline_images, body_encoding=body_encoding)
+                        
+                        def make_jobs(rows):
+                            if render_pool is not None:
+                                records = ((i, r.astype(object).where(r.notna(), None).to_dict(), prefetched)
+                                           for i, r, prefetched in rows)
+                                return render_pool.jobs(records, spooled_attachments, inline_images)
+                            return (make_job(i, r, prefetched) for i, r, prefetched in rows)
+                        
+                        # Workers and spools render from the template and raw rows, never from this session
+                        payload = {
+                            'email_col': email_col, 'name_col': name_col,
+                            'subject': email_subject, 'body': current_body, 'reply_to': reply_to,
+                            'accounts': [a.to_config() for a in accounts], 'max_attempts': max_attempts,
+                            'attachments': [{'path': a.path, 'filename': a.filename} for a in spooled_attachments],
+                            'attachment_col': attachment_col, 'attachment_dir': per_recipient_dir,
+                            'skip': {str(key): reason for key, reason in skip_rows.items()}
+                        }
+                        
+                        # Sending and spooling can render on worker processes from the payload instead
+                        render_pool = None
+                        if render_processes > 1 and not schedule_enabled and not queue_enabled:
+                            from render_pool import RenderPool
+                            render_pool = RenderPool(payload, render_processes)
+                        
+                        if schedule_enabled:
+                            # Hand the campaign to the shared scheduler; rows are rendered as they come due
+                            scheduler = get_scheduler()
+                            scheduler.set_rate(scheduler_rate)
+                            # This session's spool may be cleaned up before the last row is due
+                            files_dir = scheduler.take_files(per_recipient_dir) if per_recipient_dir else None
+                            scheduled_attachments = AttachmentPrefetcher(attachment_col, base_dir=files_dir, confine=True,
+                                                                         message_bytes=row_attachments.message_bytes)
                             
-                            for i, r in batch_df.iterrows():
-                                # Get correct email and name
-                                target_email = r.get(email_col)
-                                target_name = r.get(name_col, '')
-                                
-                                # Personalize
-                                p_curr_body = st.session_state.get('email_body', '')
-                                p_curr_sub = email_subject.replace("{Name}", str(target_name))
-                                for col in df.columns:
-                                    p_curr_body = p_curr_body.replace(f"{{{col}}}", str(r[col]))
-                                
-                                # status_text.text(f"Sending to {target_email} ({i+1}/{len(df)})...") # Noisy if batch status is better
-                                
-                                success, msg = send_email(smtp_settings, target_email, p_curr_sub, p_curr_body, uploaded_attachments)
-                                results.append({"Email": target_email, "Status": "Sent" if success else "Failed", "Error": msg})
-                                
-                                # Update global progress
-                                global_idx = i + 1  # i is index from original df if referenced correctly? Wait, iterrows preserves index. 
-                                # But let's calculate progress based on count processed.
-                                processed_count = len(results)
-                                progress_bar.progress(processed_count / total_emails)
+                            def make_scheduled_job(pos, _tz):
+                                r = df.iloc[pos]
+                                return make_job(df.index[pos], r, scheduled_attachments.load_row(r))
+                            
+                            tz_values = df[tz_col].tolist() if tz_col != "(none)" else [None] * len(df)
+                            campaign = scheduler.submit(
+                                list(enumerate(tz_values)), make_scheduled_job,
+                                start=schedule_start, deadline=schedule_deadline,
+                                priority=schedule_priority, name=email_subject,
+                                timezone_of=lambda tz: tz, default_tz=resolve_timezone(schedule_tz),
+                                files_dir=files_dir
+                            )
+                            run_in_background(campaign, engine)
+                            status_text.text(f"📅 Scheduled {campaign.total} emails.")
+                            st.success("Campaign scheduled! Track it under **Scheduled Campaigns** below.")
+                            if profile is not None:
+                                st.caption(f"🔬 Profiling the first {profile_seconds}s once sending starts → {profile.directory}")
+                        elif queue_enabled:
+                            # Workers render and send; only the template and raw rows go into the queue
+                            from work_queue import WorkQueue, start_process
+                            records = df.astype(object).where(df.notna(), None).to_dict('records')
+                            work_queue = WorkQueue(os.path.abspath(queue_path))
+                            campaign_id = work_queue.create_campaign(zip(df.index, records), payload,
+                                                                     name=email_subject, chunk_size=chunk_size)
+                            work_queue.close()
+                            
+                            # Passwords reach the workers through their environment, never the queue file
+                            worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'work_queue.py')
+                            for _ in range(local_workers):
+                                start_process([worker_script, os.path.abspath(queue_path), '--no-prompt'],
+                                              {a.name: a.password for a in accounts})
+                            engine.close()
+                            status_text.text(f"🧵 Queued {total_emails} emails as campaign #{campaign_id}.")
+                            st.success(f"Campaign queued with {local_workers} local workers! "
+                                       "Track it under **Work Queue** below.")
+                        elif spool_enabled:
+                            # Render flat out to disk; nothing touches the network here
+                            from spool import EML, MAILDIR, Spool, describe_render, render_to_spool
+                            spool = Spool(os.path.abspath(spool_path), layout=MAILDIR if spool_layout == "Maildir" else EML)
+                            spool.write_campaign(payload)
+                            reporter.set_status("Rendering to spool")
+                            if profile is not None:
+                                # Rendering is where the CPU goes here; the engine never runs
+                                profile.start()
+                            stats = render_to_spool(
+                                spool, make_jobs(row_stream), sender_email, reply_to,
+                                on_result=lambda job, status: reporter.record(status == 'rendered', skipped=status == 'skipped')
+                            )
+                            engine.close()
+                            if render_pool is not None:
+                                render_pool.close()
+                            reporter.finish("✅ Rendering finished!")
+                            st.success(f"📬 {describe_render(stats)} → {spool.path}")
+                            if profile is not None:
+                                show_profile(profile.report)
+                            
+                            if start_dispatcher:
+                                from work_queue import start_process
+                                dispatcher_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool.py')
+                                dispatcher_args = ['--profile', str(profile_seconds)] if profile_seconds else []
+                                start_process([dispatcher_script, 'dispatch', spool.path, '--no-prompt'] + dispatcher_args,
+                                              {a.name: a.password for a in accounts})
+                                st.info("🚚 Dispatcher started; results go to results.jsonl in the spool directory.")
+                        else:
+                            # Log in every connection in parallel first: the first batch goes out at once,
+                            # and bad credentials stop the campaign before any recipient is tried
+                            status_text.text("🔌 Opening SMTP connections...")
+                            login_errors = engine.warm()
+                            for account_name, error in login_errors.items():
+                                st.warning(f"⚠️ Could not log in to {account_name}: {error}")
+                            if len(login_errors) == len(accounts):
+                                engine.close()
+                                if render_pool is not None:
+                                    render_pool.close()
+                                st.error("❌ No SMTP account could log in; nothing was sent.")
+                                st.stop()
+                            
+                            # Process in batches
+                            for batch_start in range(0, total_emails, batch_size):
+                                batch_end = min(batch_start + batch_size, total_emails)
+                            
+                                current_batch_num = (batch_start // batch_size) + 1
+                                total_batches = (total_emails + batch_size - 1) // batch_size
+                            
+                                reporter.set_status(f"Processing Batch {current_batch_num}/{total_batches} ({batch_start+1}-{batch_end})")
+                            
+                                batch_rows = itertools.islice(row_stream, batch_end - batch_start)
+                                for result in engine.run(make_jobs(batch_rows)):
+                                    success = result.status == 'sent'
+                                    results.append({"Email": result.job.recipient, "Status": result.status.capitalize(),
+                                                    "Error": result.message, "Account": result.account,
+                                                    "Attempts": result.job.attempts})
                                 
-                                # Small delay between individual emails to separate them slightly? 
-                                # Maybe not needed if batch pause is main mechanism. 
-                                # time.sleep(0.1) 
+                                    # Update global progress (throttled)
+                                    reporter.record(success, skipped=result.status == 'skipped')
                             
-                            # Pause between batches (if not the last one)
-                            if batch_end < total_emails:
-                                with st.spinner(f"⏸️ Batch {current_batch_num} done. Pausing for {pause_seconds}s to respect rate limits..."):
-                                    time.sleep(pause_seconds)
+                                # Pause between batches (if not the last one)
+                                if batch_end < total_emails:
+                                    reporter.finish(f"Batch {current_batch_num} done, pausing {pause_seconds}s")
+                                    with st.spinner(f"⏸️ Batch {current_batch_num} done. Pausing for {pause_seconds}s to respect rate limits..."):
+                                        time.sleep(pause_seconds)
                         
-                        status_text.text("✅ Bulk sending finished!")
-                        st.success(f"Campaign Completed! Sent {len(results)} emails.")
-                        st.dataframe(pd.DataFrame(results))
+                            engine.close()
+                            if render_pool is not None:
+                                render_pool.close()
+                            reporter.finish("✅ Bulk sending finished!")
+                            st.success(f"Campaign Completed! Sent {len(results)} emails.")
+                            # Counted process-wide, so campaigns running alongside are included
+                            st.caption(f"🔒 {describe_tls(tls_stats(), since=tls_before)}")
+                            if profile is not None and profile.report is not None:
+                                show_profile(profile.report)
+                            st.dataframe(pd.DataFrame(results))
                         
     else:
-        st.info("👆 To use **Bulk Sending**, please upload a CSV file in Tab 1.")
+        st.info("👆 To use **Bulk Sending**, please upload a recipient list in Tab 1.")
+
+    # Campaigns queued on this server (shared by everyone using the app)
+    scheduled = get_scheduler().campaigns()
+    if scheduled:
+        st.divider()
+        st.markdown("### 📅 Scheduled Campaigns")
+        if st.button("🔄 Refresh Status"):
+            st.rerun()
+        for n, campaign in enumerate(scheduled):
+            next_due = get_scheduler().next_due(campaign)
+            sc_info, sc_cancel = st.columns([4, 1])
+            with sc_info:
+                st.write(f"**{campaign.name}** (priority {campaign.priority}) — "
+                         f"Sent: {campaign.count('sent')} | Failed: {campaign.count('failed')} | "
+                         f"Waiting: {campaign.pending}"
+                         + (f" | Next send: {next_due:%d %b %H:%M}" if next_due else ""))
+                st.progress(len(campaign.results) / campaign.total if campaign.total else 1.0)
+            with sc_cancel:
+                if st.button("⏹️ Cancel", key=f"cancel_campaign_{n}_{id(campaign)}"):
+                    get_scheduler().cancel(campaign)
+                    st.rerun()
+
+    # Campaigns in the shared work queue, sent by worker processes
+    queue_file = st.session_state.get('queue_path', 'campaigns.db')
+    if os.path.exists(queue_file):
+        from work_queue import WorkQueue
+        work_queue = WorkQueue(queue_file)
+        queued = [c for c in work_queue.campaigns() if not c.cancelled and c.sent + c.failed + c.skipped < c.total]
+        if queued:
+            st.divider()
+            st.markdown("### 🧵 Work Queue")
+            if st.button("🔄 Refresh Queue"):
+                st.rerun()
+            for campaign in queued:
+                done = campaign.sent + campaign.failed + campaign.skipped
+                wq_info, wq_cancel = st.columns([4, 1])
+                with wq_info:
+                    st.write(f"**#{campaign.id} {campaign.name}** — Sent: {campaign.sent} | Failed: {campaign.failed} | "
+                             f"Remaining: {campaign.total - done} | Chunks in progress: {campaign.leased}")
+                    st.progress(done / campaign.total if campaign.total else 1.0)
+                with wq_cancel:
+                    if st.button("⏹️ Cancel", key=f"cancel_queued_{campaign.id}"):
+                        work_queue.cancel(campaign.id)
+                        st.rerun()
+        work_queue.close()
+
+# Set MUMAILER_PROFILE_STARTUP=1 to see how long each script run takes
+if os.environ.get('MUMAILER_PROFILE_STARTUP'):
+    st.sidebar.caption(f"⏱️ Script run: {(time.perf_counter() - _run_started) * 1000:.0f} ms")
@@ -0,0 +1,449 @@
+"""
+Attachment spooling for bulk sends
+
+Attachments are copied once into a temporary spool directory and
+base64-encoded once per campaign into a sibling file. Each message then
+streams the encoded bytes from a memory map instead of holding another
+copy of the file in memory per recipient.
+
+With a shared cache, an upload whose content and name another session has
+already spooled reuses that copy (and its encoded file). Shared copies are
+deleted once no session or campaign uses them.
+"""
+
+import atexit
+import base64
+import mimetypes
+import mmap
+import os
+import shutil
+import tempfile
+import threading
+import weakref
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from shared_cache import content_key
+
+
+# Per-file and whole-message limits (most providers reject messages over 25 MB)
+MAX_ATTACHMENT_BYTES = 20 * 1024 * 1024
+MAX_MESSAGE_BYTES = 25 * 1024 * 1024
+
+# Per-recipient ZIPs: total bytes written and number of files (a ZIP's headers can lie about sizes)
+MAX_ARCHIVE_BYTES = 4 * 1024 * 1024 * 1024
+MAX_ARCHIVE_FILES = 200000
+
+# Encoded per-row files a prefetcher may hold for rows not yet sent
+MAX_PREFETCH_BYTES = 64 * 1024 * 1024
+
+# 57 raw bytes encode to one 76 character base64 line
+LINE_BYTES = 57
+ENCODE_CHUNK = LINE_BYTES * 16 * 1024
+STREAM_CHUNK = 64 * 1024
+
+
+class AttachmentError(Exception):
+    """Raised when an attachment cannot be spooled or exceeds a size limit"""
+
+
+def encoded_length(size):
+    """Return the size of `size` bytes once base64-encoded into CRLF lines"""
+    full_lines, rest = divmod(size, LINE_BYTES)
+    length = full_lines * 78
+    if rest:
+        length += 4 * ((rest + 2) // 3) + 2
+    return length
+
+
+def format_size(size):
+    """Format a byte count for error messages"""
+    if size >= 1024 * 1024:
+        return f"{size / (1024 * 1024):.1f} MB"
+    return f"{size / 1024:.0f} KB"
+
+
+class SpooledAttachment:
+    """A file on disk that is base64-encoded once and streamed per message"""
+
+    def __init__(self, path, filename=None, spool_dir=None, content_type=None):
+        self.path = path
+        self.filename = filename or os.path.basename(path)
+        self.size = os.path.getsize(path)
+        self.content_type = content_type or mimetypes.guess_type(self.filename)[0] or 'application/octet-stream'
+        self._spool_dir = spool_dir or os.path.dirname(path)
+        self._encoded_path = None
+        self._lock = threading.Lock()
+
+    @property
+    def encoded_size(self):
+        return encoded_length(self.size)
+
+    def prepare(self):
+        """Base64-encode the file into the spool directory (only once)"""
+        with self._lock:
+            if self._encoded_path is not None:
+                return self._encoded_path
+
+            fd, encoded_path = tempfile.mkstemp(suffix='.b64', dir=self._spool_dir)
+            with open(self.path, 'rb') as src, os.fdopen(fd, 'wb') as out:
+                if self.size:
+                    with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as raw:
+                        for offset in range(0, self.size, ENCODE_CHUNK):
+                            encoded = base64.encodebytes(raw[offset:offset + ENCODE_CHUNK])
+                            out.write(encoded.replace(b'\n', b'\r\n'))
+
+            self._encoded_path = encoded_path
+            return encoded_path
+
+    def iter_encoded(self, chunk_size=STREAM_CHUNK):
+        """Yield the CRLF-wrapped base64 body in chunks from a memory map"""
+        encoded_path = self.prepare()
+        if not self.size:
+            return
+        with open(encoded_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as encoded:
+                for offset in range(0, len(encoded), chunk_size):
+                    yield encoded[offset:offset + chunk_size]
+
+
+class InMemoryAttachment:
+    """A small, already encoded attachment (e.g. one recipient's certificate)"""
+
+    def __init__(self, filename, encoded, size, content_type=None):
+        self.filename = filename
+        self.size = size
+        self.content_type = content_type or mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self._encoded = encoded
+
+    @property
+    def encoded_size(self):
+        return len(self._encoded)
+
+    def prepare(self):
+        return None
+
+    def iter_encoded(self, chunk_size=STREAM_CHUNK):
+        yield self._encoded
+
+
+_shared_root = None
+_shared_root_lock = threading.Lock()
+
+
+def _spool_shared(fileobj, filename):
+    """Copy an upload into its own folder of the process-wide spool, deleted with the attachment"""
+    global _shared_root
+    with _shared_root_lock:
+        if _shared_root is None:
+            _shared_root = tempfile.mkdtemp(prefix='mumailer-shared-')
+            atexit.register(shutil.rmtree, _shared_root, True)
+    folder = tempfile.mkdtemp(dir=_shared_root)
+    path = os.path.join(folder, 'upload')
+    fileobj.seek(0)
+    with open(path, 'wb') as out:
+        shutil.copyfileobj(fileobj, out, STREAM_CHUNK)
+    attachment = SpooledAttachment(path, filename=filename, spool_dir=folder)
+    weakref.finalize(attachment, shutil.rmtree, folder, True)
+    return attachment
+
+
+def _spooled_bytes(attachment):
+    return attachment.size + (attachment.encoded_size if attachment._encoded_path else 0)
+
+
+def load_attachment(path, max_attachment_bytes=MAX_ATTACHMENT_BYTES):
+    """Read and base64-encode a file into an InMemoryAttachment"""
+    filename = os.path.basename(path)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size > max_attachment_bytes:
+            raise AttachmentError(
+                f"'{filename}' is {format_size(size)}, over the {format_size(max_attachment_bytes)} attachment limit"
+            )
+        data = f.read()
+    encoded = base64.encodebytes(data).replace(b'\n', b'\r\n')
+    return InMemoryAttachment(filename, encoded, size)
+
+
+def split_attachment_paths(value):
+    """Split a CSV cell into attachment paths (several may be separated by ';')"""
+    if value is None or value != value:  # None or NaN
+        return []
+    return [p.strip() for p in str(value).split(';') if p.strip()]
+
+
+def resolve_attachment_path(path, base_dir=None, confine=False):
+    """Resolve a per-row attachment path relative to `base_dir`
+
+    With `confine`, paths that escape `base_dir` are rejected, so a hosted
+    app cannot be made to attach arbitrary server files.
+    """
+    if base_dir and not os.path.isabs(path):
+        path = os.path.join(base_dir, path)
+    path = os.path.realpath(path)
+    if confine:
+        root = os.path.realpath(base_dir or os.getcwd())
+        if os.path.commonpath([root, path]) != root:
+            raise AttachmentError(f"'{path}' is outside the attachment folder")
+    return path
+
+
+class PrefetchResult:
+    """Attachments loaded for one row, or the error that prevented it"""
+
+    def __init__(self, attachments=None, error=None):
+        self.attachments = attachments or []
+        self.error = error
+
+
+class AttachmentPrefetcher:
+    """Load and encode per-row attachments on background threads
+
+    (index, row) pairs, as from DataFrame.iterrows(), are yielded in order
+    together with their PrefetchResult while up to `lookahead` upcoming rows
+    (and at most `max_buffered_bytes` of their encoded files) are being read
+    and encoded, so file I/O overlaps with sending instead of stalling it.
+
+    `message_bytes` is the size of the rest of the message (body, campaign
+    attachments and images, as returned by check_message_size); a row whose
+    files would take the message over `max_message_bytes` gets an error.
+    """
+
+    def __init__(self, column, base_dir=None, confine=False, lookahead=16, workers=4,
+                 max_attachment_bytes=MAX_ATTACHMENT_BYTES, max_message_bytes=MAX_MESSAGE_BYTES,
+                 message_bytes=0, max_buffered_bytes=MAX_PREFETCH_BYTES):
+        self.column = column
+        self.base_dir = base_dir
+        self.confine = confine
+        self.lookahead = max(1, lookahead)
+        self.workers = workers
+        self.max_attachment_bytes = max_attachment_bytes
+        self.max_message_bytes = max_message_bytes
+        self.message_bytes = message_bytes
+        self.max_buffered_bytes = max_buffered_bytes
+
+    def _paths(self, row):
+        paths = split_attachment_paths(row.get(self.column) if self.column else None)
+        return [resolve_attachment_path(p, self.base_dir, self.confine) for p in paths]
+
+    def row_bytes(self, row):
+        """Estimate the encoded size of a row's files from the disk, without reading them (0 if unknown)"""
+        try:
+            return sum(encoded_length(os.path.getsize(path)) for path in self._paths(row))
+        except (AttachmentError, OSError):
+            return 0
+
+    def load_row(self, row):
+        """Load every attachment named in a row (runs on a worker thread)"""
+        try:
+            paths = self._paths(row)
+            # Checked from the file sizes, before anything is read
+            total = self.message_bytes + sum(encoded_length(os.path.getsize(path)) + 512 for path in paths)
+            if paths and total > self.max_message_bytes:
+                raise AttachmentError(_too_large(total, self.max_message_bytes))
+            return PrefetchResult([load_attachment(path, self.max_attachment_bytes) for path in paths])
+        except (AttachmentError, OSError) as e:
+            return PrefetchResult(error=str(e))
+
+    def iterate(self, rows):
+        """Yield (index, row, PrefetchResult) for (index, row) pairs, in order"""
+        rows = iter(rows)
+        pending = deque()
+        buffered = 0
+        upcoming = None
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='attachment-prefetch') as executor:
+            while True:
+                # Top the window up before waiting, so reads stay ahead of the sender
+                while len(pending) < self.lookahead:
+                    if upcoming is None:
+                        item = next(rows, None)
+                        if item is None:
+                            break
+                        upcoming = (*item, self.row_bytes(item[1]))
+                    index, row, size = upcoming
+                    # The next row to send is always loaded, however large
+                    if pending and buffered + size > self.max_buffered_bytes:
+                        break
+                    pending.append((index, row, size, executor.submit(self.load_row, row)))
+                    buffered += size
+                    upcoming = None
+                if not pending:
+                    return
+                index, row, size, future = pending.popleft()
+                result = future.result()
+                buffered -= size
+                yield index, row, result
+
+
+class AttachmentStore:
+    """Temporary spool of campaign attachments, removed when closed"""
+
+    def __init__(self, max_attachment_bytes=MAX_ATTACHMENT_BYTES, root=None, shared=None,
+                 max_archive_bytes=MAX_ARCHIVE_BYTES, max_archive_files=MAX_ARCHIVE_FILES):
+        self.max_attachment_bytes = max_attachment_bytes
+        self.max_archive_bytes = max_archive_bytes
+        self.max_archive_files = max_archive_files
+        self.spool_dir = tempfile.mkdtemp(prefix='mumailer-', dir=root)
+        self.shared = shared
+        self._entries = {}
+        self._leases = {}
+        self._finalizer = weakref.finalize(self, shutil.rmtree, self.spool_dir, True)
+
+    @property
+    def attachments(self):
+        return list(self._entries.values())
+
+    def _check_size(self, filename, size):
+        if size > self.max_attachment_bytes:
+            raise AttachmentError(
+                f"'{filename}' is {format_size(size)}, over the {format_size(self.max_attachment_bytes)} attachment limit"
+            )
+
+    def add_path(self, path, filename=None):
+        """Register a file already on disk without copying it"""
+        if path not in self._entries:
+            self._check_size(filename or os.path.basename(path), os.path.getsize(path))
+            self._entries[path] = SpooledAttachment(path, filename=filename, spool_dir=self.spool_dir)
+        return self._entries[path]
+
+    def add_upload(self, key, fileobj, filename):
+        """Copy a file-like upload into the spool in chunks"""
+        if key in self._entries:
+            return self._entries[key]
+
+        fileobj.seek(0, os.SEEK_END)
+        self._check_size(filename, fileobj.tell())
+        fileobj.seek(0)
+
+        if self.shared is not None:
+            lease = self.shared.lease(content_key(f'attachment:{filename}', fileobj),
+                                      lambda: _spool_shared(fileobj, filename), sizeof=_spooled_bytes)
+            self._leases[key] = lease
+            self._entries[key] = lease.value
+            return lease.value
+
+        fd, path = tempfile.mkstemp(dir=self.spool_dir)
+        with os.fdopen(fd, 'wb') as out:
+            shutil.copyfileobj(fileobj, out, STREAM_CHUNK)
+
+        self._entries[key] = SpooledAttachment(path, filename=filename, spool_dir=self.spool_dir)
+        return self._entries[key]
+
+    def spool_uploads(self, uploads):
+        """Spool Streamlit UploadedFile objects, dropping ones no longer uploaded"""
+        spooled = []
+        keys = set()
+        for upload in uploads or []:
+            key = getattr(upload, 'file_id', None) or (upload.name, upload.size)
+            keys.add(key)
+            spooled.append(self.add_upload(key, upload, upload.name))
+
+        for key in list(self._entries):
+            if key not in keys:
+                self.remove(key)
+        return spooled
+
+    def add_archive(self, key, fileobj):
+        """Extract a ZIP of per-recipient files into the spool and return its folder
+
+        Sizes are counted as the files are written, not taken from the ZIP's
+        headers, so a crafted archive cannot fill the disk.
+        """
+        folder = os.path.join(self.spool_dir, f"archive-{abs(hash(key))}")
+        if os.path.isdir(folder):
+            return folder
+
+        # Extracted beside the final folder and moved into place only when complete
+        partial = tempfile.mkdtemp(prefix='archive-', suffix='.partial', dir=self.spool_dir)
+        root = os.path.realpath(partial)
+        try:
+            with zipfile.ZipFile(fileobj) as archive:
+                members = archive.infolist()
+                if len(members) > self.max_archive_files:
+                    raise AttachmentError(f"The archive holds {len(members)} files, over the "
+                                          f"{self.max_archive_files} file limit")
+                total = 0
+                for member in members:
+                    target = os.path.realpath(os.path.join(partial, member.filename))
+                    if os.path.commonpath([root, target]) != root:
+                        raise AttachmentError(f"Unsafe path in archive: {member.filename}")
+                    if member.is_dir():
+                        os.makedirs(target, exist_ok=True)
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    total += self._extract_member(archive, member, target, self.max_archive_bytes - total)
+            os.replace(partial, folder)
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        return folder
+
+    def _extract_member(self, archive, member, target, remaining):
+        """Copy one member out in chunks, stopping at the per-file or remaining archive limit; returns its size"""
+        written = 0
+        with archive.open(member) as source, open(target, 'wb') as out:
+            for chunk in iter(lambda: source.read(STREAM_CHUNK), b''):
+                written += len(chunk)
+                if written > self.max_attachment_bytes:
+                    raise AttachmentError(f"'{member.filename}' is over the "
+                                          f"{format_size(self.max_attachment_bytes)} attachment limit")
+                if written > remaining:
+                    raise AttachmentError(f"The archive unpacks to more than "
+                                          f"{format_size(self.max_archive_bytes)}")
+                out.write(chunk)
+        return written
+
+    def remove(self, key):
+        """Forget an attachment and delete its spooled copies"""
+        attachment = self._entries.pop(key, None)
+        lease = self._leases.pop(key, None)
+        if lease is not None:
+            # Shared copies are deleted once nothing uses them
+            lease.release()
+            return
+        if attachment is None:
+            return
+        for path in (attachment.path, attachment._encoded_path):
+            if path and os.path.dirname(path) == self.spool_dir and os.path.exists(path):
+                os.remove(path)
+
+    def prepare(self):
+        """Encode every attachment up front, before the campaign starts"""
+        for attachment in self._entries.values():
+            attachment.prepare()
+
+    def close(self):
+        """Delete the spool directory"""
+        for lease in self._leases.values():
+            lease.release()
+        self._leases.clear()
+        self._entries.clear()
+        self._finalizer()
+
+
+def _too_large(total, max_message_bytes):
+    return f"Message would be about {format_size(total)}, over the {format_size(max_message_bytes)} limit"
+
+
+def message_size(body_html, attachments):
+    """Estimate the size of a message with this body and these attachments, as sent"""
+    # Body is sent base64 in the worst case; allow a little for headers
+    total = encoded_length(len(body_html.encode('utf-8'))) + 4096
+    return total + sum(attachment.encoded_size + 512 for attachment in attachments or [])
+
+
+def check_message_size(body_html, attachments, max_message_bytes=MAX_MESSAGE_BYTES, max_attachment_bytes=MAX_ATTACHMENT_BYTES):
+    """Raise AttachmentError if a message would exceed the provider limits; returns its estimated size"""
+    for attachment in attachments or []:
+        if attachment.size > max_attachment_bytes:
+            raise AttachmentError(
+                f"'{attachment.filename}' is {format_size(attachment.size)}, "
+                f"over the {format_size(max_attachment_bytes)} attachment limit"
+            )
+
+    total = message_size(body_html, attachments)
+    if total > max_message_bytes:
+        raise AttachmentError(_too_large(total, max_message_bytes))
+    return total
@@ -0,0 +1,269 @@
+"""
+Recipient domain pre-check
+
+Mistyped domains (gmial.com) cost a full connect/STARTTLS/AUTH/DATA cycle
+each and come back later as bounces. Before a campaign, the unique domains
+of the recipient list are looked up concurrently, and recipients on domains
+that cannot receive mail are flagged. A domain cannot receive mail when it
+does not exist, has no MX or address records, or publishes a null MX.
+
+Answers are kept in a small SQLite cache until their DNS TTL runs out, so
+repeated campaigns to the same domains do no lookups at all. Lookups go
+through a resolver object: dnspython is used when installed, otherwise the
+system resolver, which can only confirm domains that have address records
+(an MX-only domain looks the same as a missing one, so neither is flagged).
+StaticResolver answers from a dict, for offline runs and tests. A lookup
+that times out or fails for any other reason is never treated as
+undeliverable.
+"""
+
+import difflib
+import socket
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+try:
+    import dns.exception
+    import dns.resolver
+except ImportError:
+    dns = None
+
+
+DEFAULT_CACHE_PATH = 'domains.db'
+
+OK = 'ok'
+NO_DOMAIN = 'no domain'
+NO_MAIL = 'no mail'
+INVALID = 'invalid'
+UNKNOWN = 'unknown'
+UNDELIVERABLE = (NO_DOMAIN, NO_MAIL, INVALID)
+
+# Bounds on how long answers are cached (seconds)
+MIN_TTL = 300
+MAX_TTL = 86400
+NEGATIVE_TTL = 3600
+
+# Used to suggest the intended domain for a typo
+COMMON_DOMAINS = (
+    'gmail.com', 'googlemail.com', 'yahoo.com', 'yahoo.co.in', 'hotmail.com', 'outlook.com', 'live.com',
+    'icloud.com', 'me.com', 'aol.com', 'protonmail.com', 'proton.me', 'rediffmail.com', 'zoho.com', 'gmx.com',
+    'yandex.com', 'mail.com'
+)
+
+DomainCheck = namedtuple('DomainCheck', ['domain', 'status', 'detail'])
+
+
+def suggest_domain(domain):
+    """Return the common mail domain `domain` is probably a typo of, or None"""
+    matches = difflib.get_close_matches(domain, COMMON_DOMAINS, n=1, cutoff=0.8)
+    return matches[0] if matches and matches[0] != domain else None
+
+
+def describe_check(check):
+    """Return a short human readable reason for a failed check"""
+    text = {
+        NO_DOMAIN: f"{check.domain} does not exist",
+        NO_MAIL: f"{check.domain} does not accept mail",
+        INVALID: "not a valid email address",
+    }.get(check.status, check.detail)
+    suggestion = suggest_domain(check.domain) if check.domain else None
+    return f"{text} (did you mean {suggestion}?)" if suggestion else text
+
+
+class StaticResolver:
+    """Answer from a dict of domain -> MX hosts; [] means the domain takes no mail, None that the lookup
+    fails, and a domain that is absent does not exist"""
+
+    def __init__(self, records):
+        self.records = {domain.lower(): hosts for domain, hosts in records.items()}
+
+    def lookup(self, domain):
+        if domain not in self.records:
+            return NO_DOMAIN, "Domain does not exist", NEGATIVE_TTL
+        hosts = self.records[domain]
+        if hosts is None:
+            return UNKNOWN, "Lookup failed", 0
+        if not hosts:
+            return NO_MAIL, "No mail servers", NEGATIVE_TTL
+        return OK, ', '.join(hosts), MAX_TTL
+
+
+class SystemResolver:
+    """Check domains through the system resolver: address records only, MX cannot be seen
+
+    A name without address records may still take mail through its MX, so
+    only a positive answer is definite.
+    """
+
+    # Without working DNS every lookup would fail slowly, so names are only looked up if this one resolves
+    PROBE_DOMAIN = 'example.com'
+
+    def __init__(self):
+        self._online = None
+        self._lock = threading.Lock()
+
+    def _lookup(self, domain):
+        try:
+            socket.getaddrinfo(domain, 25, proto=socket.IPPROTO_TCP)
+        except socket.gaierror as e:
+            if e.errno == socket.EAI_NONAME:
+                return UNKNOWN, "No address records (MX cannot be checked without dnspython)", 0
+            return UNKNOWN, str(e), 0
+        except (UnicodeError, OSError) as e:
+            return UNKNOWN, str(e), 0
+        return OK, "Has address records", MAX_TTL
+
+    def lookup(self, domain):
+        with self._lock:
+            if self._online is None:
+                self._online = self._lookup(self.PROBE_DOMAIN)[0] == OK
+        if not self._online:
+            return UNKNOWN, "DNS is not reachable", 0
+        return self._lookup(domain)
+
+
+class DnsResolver:
+    """Check MX records (then address records) with dnspython"""
+
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self.resolver = dns.resolver.Resolver()
+
+    def _resolve(self, domain, rdtype):
+        return self.resolver.resolve(domain, rdtype, lifetime=self.timeout)
+
+    def lookup(self, domain):
+        try:
+            answer = self._resolve(domain, 'MX')
+        except dns.resolver.NXDOMAIN:
+            return NO_DOMAIN, "Domain does not exist", NEGATIVE_TTL
+        except dns.resolver.NoAnswer:
+            answer = None
+        except dns.exception.DNSException as e:
+            return UNKNOWN, str(e), 0
+
+        if answer is not None:
+            hosts = sorted((record.preference, str(record.exchange).rstrip('.')) for record in answer)
+            # A null MX (RFC 7505) says the domain accepts no mail at all
+            if all(host == '' for _, host in hosts):
+                return NO_MAIL, "Domain accepts no mail (null MX)", answer.rrset.ttl
+            return OK, ', '.join(host for _, host in hosts[:3]), answer.rrset.ttl
+
+        # No MX: mail goes to the domain's own address records
+        for rdtype in ('A', 'AAAA'):
+            try:
+                answer = self._resolve(domain, rdtype)
+                return OK, "No MX, has address records", answer.rrset.ttl
+            except (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN):
+                continue
+            except dns.exception.DNSException as e:
+                return UNKNOWN, str(e), 0
+        return NO_MAIL, "No MX or address records", NEGATIVE_TTL
+
+
+def default_resolver():
+    return DnsResolver() if dns is not None else SystemResolver()
+
+
+class DomainCache:
+    """Domain check results kept until their TTL expires"""
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, clock=time.time):
+        self.path = path
+        self.clock = clock
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS domains "
+                               "(domain TEXT PRIMARY KEY, status TEXT NOT NULL, detail TEXT, expires REAL NOT NULL)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_many(self, domains):
+        """Return {domain: DomainCheck} for the domains with an unexpired answer"""
+        domains = list(domains)
+        found = {}
+        now = self.clock()
+        with self._lock:
+            for start in range(0, len(domains), 500):
+                batch = domains[start:start + 500]
+                rows = self._conn.execute(
+                    f"SELECT domain, status, detail FROM domains WHERE expires > ? "
+                    f"AND domain IN ({','.join('?' * len(batch))})", [now] + batch)
+                found.update((domain, DomainCheck(domain, status, detail)) for domain, status, detail in rows)
+        return found
+
+    def put_many(self, answers):
+        """Store (DomainCheck, ttl) pairs; answers with no TTL are not cached"""
+        now = self.clock()
+        rows = [(check.domain, check.status, check.detail, now + min(max(ttl, MIN_TTL), MAX_TTL))
+                for check, ttl in answers if ttl]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO domains VALUES (?, ?, ?, ?)", rows)
+
+
+def address_domains(addresses):
+    """Return a Series of lower-cased domains aligned with `addresses` (None for malformed addresses)"""
+    series = pd.Series(addresses, dtype=object) if not isinstance(addresses, pd.Series) else addresses
+    parts = series.astype(str).str.strip().str.rpartition('@')
+    valid = series.notna() & (parts[1] == '@') & (parts[0] != '') & parts[2].str.contains(r'^[^\s@]+\.[^\s@.]+$')
+    return parts[2].str.lower().where(valid, None)
+
+
+class DomainChecker:
+    """Look up each unique recipient domain once, concurrently, through a TTL cache"""
+
+    def __init__(self, resolver=None, cache=None, max_workers=16):
+        self.resolver = resolver or default_resolver()
+        self.cache = cache
+        self.max_workers = max_workers
+
+    def check_domains(self, domains):
+        """Return {domain: DomainCheck} for a set of domains"""
+        domains = sorted(set(domains))
+        results = self.cache.get_many(domains) if self.cache is not None else {}
+        missing = [domain for domain in domains if domain not in results]
+        if missing:
+            def lookup(domain):
+                try:
+                    status, detail, ttl = self.resolver.lookup(domain)
+                except Exception as e:
+                    status, detail, ttl = UNKNOWN, str(e), 0
+                return DomainCheck(domain, status, detail), ttl
+
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(missing))) as pool:
+                answers = list(pool.map(lookup, missing))
+            if self.cache is not None:
+                self.cache.put_many(answers)
+            results.update((check.domain, check) for check, _ in answers)
+        return results
+
+    def check_addresses(self, addresses):
+        """Return a Series aligned with `addresses`: why the address is undeliverable, or None"""
+        series = addresses if isinstance(addresses, pd.Series) else pd.Series(addresses, dtype=object)
+        domains = address_domains(series)
+        checks = self.check_domains(domains.dropna().unique())
+        problems = {domain: describe_check(check) for domain, check in checks.items()
+                    if check.status in UNDELIVERABLE}
+        reasons = domains.map(problems).astype(object)
+        # Addresses without a usable domain are invalid; empty cells are left to the "No email address" check
+        malformed = domains.isna() & series.notna() & (series.astype(str).str.strip() != '')
+        reasons[malformed] = describe_check(DomainCheck(None, INVALID, None))
+        return reasons.where(reasons.notna(), None)
+
+
+def undeliverable_rows(addresses, cache_path=DEFAULT_CACHE_PATH, resolver=None):
+    """Return {row label: reason} for addresses whose domain cannot receive mail"""
+    cache = DomainCache(cache_path)
+    try:
+        reasons = DomainChecker(resolver, cache).check_addresses(addresses)
+    finally:
+        cache.close()
+    return {label: reason for label, reason in reasons.items() if reason is not None}
@@ -1,18 +1,49 @@
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
-import pandas as pd
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
 import os
 import threading
 import time
 from tkinter import font
-import webbrowser
-import tempfile
 import json
+import datetime
+import itertools
+from collections import deque
+from event_log import get_event_log
+from progress import ProgressReporter, describe_progress
+from attachments import AttachmentStore, AttachmentError, AttachmentPrefetcher, check_message_size, message_size
+from smtp_accounts import SmtpAccount, account_from_settings, accounts_from_config, is_local
+
+# pandas, the email package and the send stack cost far more to import than
+# building the window, so they are imported where they are first used and
+# warmed up in the background once the window is on screen.
+DEFERRED_MODULES = ('pandas', 'templating', 'inline_images', 'message_builder', 'transports',
+                    'send_engine', 'scheduler', 'webbrowser')
+
+# Lines kept in the on-screen log; the full history goes to the event log files
+LOG_LINES = 1000
+# How often newly logged lines are drawn (milliseconds)
+LOG_REDRAW_MS = 100
+
+# Set MUMAILER_PROFILE_STARTUP=1 to print how long each startup phase takes
+PROFILE_STARTUP = bool(os.environ.get('MUMAILER_PROFILE_STARTUP'))
+STARTUP_BEGAN = time.perf_counter()
+
+
+def startup_mark(phase):
+    """Print the time since startup when startup profiling is on"""
+    if PROFILE_STARTUP:
+        print(f"⏱️ {phase}: {(time.perf_counter() - STARTUP_BEGAN) * 1000:.0f} ms")
+
+
+def warm_imports():
+    """Import the deferred modules so their first use does not stall the UI"""
+    import importlib
+    for name in DEFERRED_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    startup_mark("deferred modules imported")
 
 
 class EmailSenderGUI:
@@ -34,6 +65,25 @@ class EmailSenderGUI:
         self.csv_data = None
         self.current_preview_index = 0
         self.attachments = []
+        self.attachment_store = AttachmentStore()
+        self.extra_accounts = []
+        self.send_rate = tk.StringVar(value="0.5")
+        self.connections = tk.StringVar(value="1")
+        self.check_domains = tk.BooleanVar(value=True)
+        self.profile_campaign = tk.BooleanVar(value=False)
+        self.engine = None
+        # Connections opened by Test Connection, handed to the next campaign
+        self.warm_engine = None
+        self.campaign = None
+        self.attachment_column = tk.StringVar(value="(none)")
+        # State shown in tabs that have not been built yet
+        self.pending_content = ""
+        # Recent log lines, drawn by draw_log() from the Tk loop whichever thread logged them
+        self.log_lines = deque(maxlen=LOG_LINES)
+        self.log_count = 0
+        self.log_drawn = 0
+        self.log_lock = threading.Lock()
+        self.event_log = get_event_log()
         
         self.setup_styles()
         self.create_widgets()
@@ -56,23 +106,46 @@ class EmailSenderGUI:
         self.notebook = ttk.Notebook(self.root)
         self.notebook.pack(fill='both', expand=True, padx=10, pady=10)
         
-        # Tab 1: SMTP Configuration
-        self.create_smtp_tab()
-        
-        # Tab 2: CSV Upload & Preview
-        self.create_csv_tab()
-        
-        # Tab 3: Email Composition
-        self.create_compose_tab()
-        
-        # Tab 4: Preview & Send
-        self.create_preview_tab()
-        
-    def create_smtp_tab(self):
+        # Every tab gets an empty frame now; its widgets are built the first
+        # time it is shown (or its widgets are needed), so only the SMTP tab
+        # is built before the window appears
+        self.tab_frames = {}
+        self.tab_builders = {}
+        tabs = [
+            ('smtp', "📧 SMTP Configuration", self.create_smtp_tab),
+            ('csv', "📊 CSV Data", self.create_csv_tab),
+            ('compose', "✏️ Compose Email", self.create_compose_tab),
+            ('preview', "📤 Preview & Send", self.create_preview_tab)
+        ]
+        for name, text, builder in tabs:
+            frame = ttk.Frame(self.notebook)
+            self.notebook.add(frame, text=text)
+            self.tab_frames[name] = frame
+            self.tab_builders[name] = builder
+        
+        self.ensure_tab('smtp')
+        self.notebook.bind('<<NotebookTabChanged>>', self.on_tab_changed)
+        
+    def ensure_tab(self, name):
+        """Build a tab's widgets if that has not happened yet"""
+        builder = self.tab_builders.pop(name, None)
+        if builder is not None:
+            builder(self.tab_frames[name])
+            startup_mark(f"{name} tab built")
+    
+    def tab_built(self, name):
+        return name not in self.tab_builders
+    
+    def on_tab_changed(self, event):
+        """Build a deferred tab when it is first selected"""
+        selected = self.notebook.select()
+        for name, frame in self.tab_frames.items():
+            if str(frame) == selected:
+                self.ensure_tab(name)
+                break
+        
+    def create_smtp_tab(self, smtp_frame):
         """Create SMTP configuration tab"""
-        smtp_frame = ttk.Frame(self.notebook)
-        self.notebook.add(smtp_frame, text="📧 SMTP Configuration")
-        
         # Title
         title_label = ttk.Label(smtp_frame, text="SMTP Server Configuration", style='Title.TLabel')
         title_label.pack(pady=20)
@@ -134,17 +207,27 @@ class EmailSenderGUI:
         # Save Config Button
         ttk.Button(presets_frame, text="💾 Save Configuration", command=self.save_config).pack(side='right', padx=5)
         
-    def create_csv_tab(self):
-        """Create CSV upload and data preview tab"""
-        csv_frame = ttk.Frame(self.notebook)
-        self.notebook.add(csv_frame, text="📊 CSV Data")
+        # Additional accounts/relays that share bulk campaigns by weight
+        accounts_frame = ttk.LabelFrame(smtp_frame, text="Additional SMTP Accounts", padding=15)
+        accounts_frame.pack(fill='x', padx=20, pady=10)
+        
+        self.accounts_list = tk.Listbox(accounts_frame, height=4)
+        self.accounts_list.pack(side='left', fill='x', expand=True, padx=(0, 10))
+        
+        accounts_btn_frame = ttk.Frame(accounts_frame)
+        accounts_btn_frame.pack(side='right', fill='y')
         
+        ttk.Button(accounts_btn_frame, text="➕ Add Account", command=self.add_account).pack(fill='x', pady=2)
+        ttk.Button(accounts_btn_frame, text="➖ Remove", command=self.remove_account).pack(fill='x', pady=2)
+        
+    def create_csv_tab(self, csv_frame):
+        """Create CSV upload and data preview tab"""
         # Title
         title_label = ttk.Label(csv_frame, text="CSV File Upload & Data Preview", style='Title.TLabel')
         title_label.pack(pady=20)
         
         # Upload section
-        upload_frame = ttk.LabelFrame(csv_frame, text="Upload CSV File", padding=15)
+        upload_frame = ttk.LabelFrame(csv_frame, text="Upload Recipient List", padding=15)
         upload_frame.pack(fill='x', padx=20, pady=10)
         
         # File selection
@@ -159,6 +242,10 @@ class EmailSenderGUI:
                   command=self.browse_csv_file).pack(side='right', padx=5)
         ttk.Button(file_frame, text="🔄 Reload", 
                   command=self.load_csv_data).pack(side='right', padx=5)
+        ttk.Button(file_frame, text="🚫 Suppression List", 
+                  command=self.manage_suppressions).pack(side='right', padx=5)
+        ttk.Button(file_frame, text="🔎 Check Domains", 
+                  command=self.check_recipient_domains).pack(side='right', padx=5)
         
         # CSV Requirements
         req_frame = ttk.Frame(upload_frame)
@@ -197,11 +284,8 @@ class EmailSenderGUI:
         self.stats_label = ttk.Label(preview_frame, text="No data loaded", style='Heading.TLabel')
         self.stats_label.pack(pady=10)
         
-    def create_compose_tab(self):
+    def create_compose_tab(self, compose_frame):
         """Create email composition tab"""
-        compose_frame = ttk.Frame(self.notebook)
-        self.notebook.add(compose_frame, text="✏️ Compose Email")
-        
         # Title
         title_label = ttk.Label(compose_frame, text="Email Composition & Formatting", style='Title.TLabel')
         title_label.pack(pady=20)
@@ -245,6 +329,7 @@ class EmailSenderGUI:
         
         self.email_content = scrolledtext.ScrolledText(text_frame, height=15, font=('Consolas', 10))
         self.email_content.pack(fill='both', expand=True)
+        self.email_content.insert(1.0, self.pending_content)
         
         # Quick templates
         template_frame = ttk.Frame(content_frame)
@@ -276,7 +361,7 @@ class EmailSenderGUI:
         
         ttk.Button(var_frame, text="Insert into Email", command=self.insert_variable).pack(side='left', padx=5)
         
-        ttk.Label(var_frame, text="(Automatically replaces {Field} with CSV data for each person)", font=('Arial', 8, 'italic')).pack(side='left', padx=10)
+        ttk.Label(var_frame, text="(Replaces {Field} per person; also {% if Field %}...{% endif %}, {% for x in Field %}...{% endfor %}, {Field|default:'...'})", font=('Arial', 8, 'italic')).pack(side='left', padx=10)
 
         # Attachment Section
         attachment_frame = ttk.LabelFrame(compose_frame, text="Attachments", padding=15)
@@ -285,6 +370,8 @@ class EmailSenderGUI:
         # Attachment List
         self.attachment_list = tk.Listbox(attachment_frame, height=4)
         self.attachment_list.pack(side='left', fill='x', expand=True, padx=(0, 10))
+        for path in self.attachments:
+            self.attachment_list.insert('end', os.path.basename(path))
         
         # Attachment Buttons
         att_btn_frame = ttk.Frame(attachment_frame)
@@ -294,11 +381,21 @@ class EmailSenderGUI:
         ttk.Button(att_btn_frame, text="➖ Remove", command=self.remove_attachment).pack(fill='x', pady=2)
         ttk.Button(att_btn_frame, text="🗑️ Clear All", command=self.clear_attachments).pack(fill='x', pady=2)
         
-    def create_preview_tab(self):
-        """Create email preview and sending tab"""
-        preview_frame = ttk.Frame(self.notebook)
-        self.notebook.add(preview_frame, text="📤 Preview & Send")
+        # Per-recipient attachments: a CSV column naming each row's file(s)
+        row_att_frame = ttk.Frame(compose_frame)
+        row_att_frame.pack(fill='x', padx=20)
+        
+        ttk.Label(row_att_frame, text="Per-Recipient Attachment Column:", style='Heading.TLabel').pack(side='left', padx=5)
+        self.attachment_col_combo = ttk.Combobox(row_att_frame, textvariable=self.attachment_column,
+                                                 state='readonly', width=30, values=["(none)"])
+        self.attachment_col_combo.pack(side='left', padx=5)
+        ttk.Label(row_att_frame, text="(Paths relative to the CSV file's folder; separate several with ';')", 
+                  font=('Arial', 8, 'italic')).pack(side='left', padx=10)
         
+        self.refresh_column_choices()
+        
+    def create_preview_tab(self, preview_frame):
+        """Create email preview and sending tab"""
         # Title
         title_label = ttk.Label(preview_frame, text="Email Preview & Bulk Sending", style='Title.TLabel')
         title_label.pack(pady=20)
@@ -335,12 +432,24 @@ class EmailSenderGUI:
                                      command=self.send_all_emails, style='Custom.TButton')
         self.send_button.pack(side='left', padx=5)
         
+        ttk.Button(control_frame, text="📅 Schedule Send", 
+                  command=self.schedule_send).pack(side='left', padx=5)
+        
         ttk.Button(control_frame, text="📧 Send Test Email", 
                   command=self.send_test_email).pack(side='left', padx=5)
         
         ttk.Button(control_frame, text="📮 Custom Test Email", 
                   command=self.send_custom_test_email).pack(side='left', padx=5)
         
+        ttk.Label(control_frame, text="Emails/sec:").pack(side='left', padx=(15, 2))
+        ttk.Entry(control_frame, textvariable=self.send_rate, width=5).pack(side='left')
+        ttk.Label(control_frame, text="Connections:").pack(side='left', padx=(10, 2))
+        ttk.Entry(control_frame, textvariable=self.connections, width=4).pack(side='left')
+        ttk.Checkbutton(control_frame, text="Skip undeliverable domains", 
+                        variable=self.check_domains).pack(side='left', padx=(10, 0))
+        ttk.Checkbutton(control_frame, text="Profile",
+                        variable=self.profile_campaign).pack(side='left', padx=(10, 0))
+        
         self.stop_button = ttk.Button(control_frame, text="⏹️ Stop Sending", 
                                      command=self.stop_sending, state='disabled')
         self.stop_button.pack(side='left', padx=5)
@@ -364,14 +473,22 @@ class EmailSenderGUI:
         self.log_display = scrolledtext.ScrolledText(log_frame, height=8, state='disabled')
         self.log_display.pack(fill='both', expand=True)
         
+        # Show what was logged before this tab existed, then keep drawing new lines
+        self.draw_log()
+        
         # Initialize variables
         self.sending_stopped = False
         
+        self.update_email_preview()
+        
     def browse_csv_file(self):
-        """Browse and select CSV file"""
+        """Browse and select a recipient list (CSV, Excel, Parquet or Arrow)"""
+        from recipients import EXTENSIONS
+        
         file_path = filedialog.askopenfilename(
-            title="Select CSV File",
-            filetypes=[("CSV files", "*.csv"), ("All files", "*.*")]
+            title="Select Recipient List",
+            filetypes=[("Recipient lists", ' '.join(f"*.{ext}" for ext in EXTENSIONS)),
+                       ("CSV files", "*.csv"), ("All files", "*.*")]
         )
         
         if file_path:
@@ -381,11 +498,15 @@ class EmailSenderGUI:
     def load_csv_data(self):
         """Load and validate CSV data"""
         if not self.csv_file_path.get():
-            messagebox.showwarning("Warning", "Please select a CSV file first!")
+            messagebox.showwarning("Warning", "Please select a recipient list first!")
             return
         
+        from recipients import read_recipients
+        
+        self.ensure_tab('csv')
         try:
-            self.csv_data = pd.read_csv(self.csv_file_path.get())
+            # The data table shows every column, so all are loaded, in compact dtypes
+            self.csv_data = read_recipients(self.csv_file_path.get())
             
             # Validate required columns
             required_columns = ['Name', 'Email']
@@ -409,17 +530,128 @@ class EmailSenderGUI:
             
             self.log_message(f"✅ Loaded {total_rows} records from CSV file")
             
-            # Update variable combo
-            self.var_combo['values'] = list(self.csv_data.columns)
-            if len(self.csv_data.columns) > 0:
-                self.var_combo.current(0)
+            from suppression import suppressed_rows
+            suppressed_count = len(suppressed_rows(self.csv_data['Email']))
+            if suppressed_count:
+                self.log_message(f"🚫 {suppressed_count} recipients are on the suppression list and will be skipped")
+            
+            # Pick a likely per-recipient attachment column
+            self.attachment_column.set("(none)")
+            for col in self.csv_data.columns:
+                if any(k in col.lower() for k in ('attach', 'certificate', 'file')):
+                    self.attachment_column.set(col)
+                    break
+            self.refresh_column_choices()
             
         except Exception as e:
-            messagebox.showerror("Error", f"Failed to load CSV file: {str(e)}")
+            messagebox.showerror("Error", f"Failed to load recipient list: {str(e)}")
             self.log_message(f"❌ Error loading CSV: {str(e)}")
     
+    def refresh_column_choices(self):
+        """Offer the CSV's columns in the compose tab's pickers"""
+        if self.csv_data is None or not self.tab_built('compose'):
+            return
+        # Update variable combo
+        self.var_combo['values'] = list(self.csv_data.columns)
+        if len(self.csv_data.columns) > 0:
+            self.var_combo.current(0)
+        
+        # Update per-recipient attachment column choices
+        self.attachment_col_combo['values'] = ["(none)"] + list(self.csv_data.columns)
+    
+    def check_recipient_domains(self):
+        """Look up the CSV's unique recipient domains and report the ones that cannot receive mail"""
+        if self.csv_data is None:
+            messagebox.showwarning("Warning", "Please load CSV data!")
+            return
+        
+        def check():
+            from domain_check import undeliverable_rows
+            
+            self.log_message("🔎 Checking recipient domains...")
+            undeliverable = undeliverable_rows(self.csv_data['Email'])
+            if not undeliverable:
+                self.log_message("✅ All recipient domains can receive mail")
+                messagebox.showinfo("Domain Check", "All recipient domains can receive mail.")
+                return
+            problems = {}
+            for reason in undeliverable.values():
+                problems[reason] = problems.get(reason, 0) + 1
+            for reason, count in sorted(problems.items(), key=lambda item: -item[1]):
+                self.log_message(f"⚠️ {count} × {reason}")
+            messagebox.showwarning("Domain Check", f"{len(undeliverable)} recipients cannot receive mail and will be "
+                                                   "skipped. See the Sending Log for details.")
+        
+        threading.Thread(target=check, daemon=True).start()
+    
+    def manage_suppressions(self):
+        """Add unsubscribes and bounces to the suppression list, or take addresses off it"""
+        from suppression import REASONS, SuppressionList
+        
+        suppressions = SuppressionList()
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Suppression List")
+        dialog.transient(self.root)
+        dialog.protocol("WM_DELETE_WINDOW", lambda: (suppressions.close(), dialog.destroy()))
+        
+        main_frame = ttk.Frame(dialog, padding=20)
+        main_frame.pack(fill='both', expand=True)
+        
+        count_label = ttk.Label(main_frame, style='Heading.TLabel')
+        count_label.grid(row=0, column=0, columnspan=3, sticky='w', pady=(0, 10))
+        
+        def refresh_count():
+            counts = suppressions.counts()
+            details = ", ".join(f"{reason}: {count}" for reason, count in counts.items())
+            count_label.config(text=f"{sum(counts.values())} suppressed addresses" + (f" ({details})" if details else ""))
+        
+        ttk.Label(main_frame, text="Reason:").grid(row=1, column=0, sticky='w', pady=3)
+        reason = tk.StringVar(value=REASONS[0])
+        ttk.Combobox(main_frame, textvariable=reason, values=REASONS, state='readonly', width=20).grid(
+            row=1, column=1, sticky='w', padx=10, pady=3)
+        
+        ttk.Label(main_frame, text="Address:").grid(row=2, column=0, sticky='w', pady=3)
+        address = tk.StringVar()
+        ttk.Entry(main_frame, textvariable=address, width=30).grid(row=2, column=1, padx=10, pady=3)
+        
+        def import_list():
+            path = filedialog.askopenfilename(parent=dialog, title="Select Suppression List",
+                                              filetypes=[("Lists", "*.csv *.xlsx"), ("All files", "*.*")])
+            if not path:
+                return
+            try:
+                added = suppressions.add_file(path, reason.get())
+            except Exception as e:
+                messagebox.showerror("Error", f"Could not read the list: {str(e)}", parent=dialog)
+                return
+            self.log_message(f"🚫 Added {added} addresses to the suppression list")
+            refresh_count()
+        
+        def add_address():
+            if address.get().strip():
+                suppressions.add([address.get()], reason.get(), source='manual entry')
+                address.set("")
+                refresh_count()
+        
+        def remove_address():
+            if address.get().strip():
+                if not suppressions.remove([address.get()]):
+                    messagebox.showinfo("Suppression List", "That address is not on the list.", parent=dialog)
+                address.set("")
+                refresh_count()
+        
+        buttons = ttk.Frame(main_frame)
+        buttons.grid(row=3, column=0, columnspan=3, sticky='ew', pady=(10, 0))
+        ttk.Button(buttons, text="📁 Import List...", command=import_list).pack(side='left', padx=2)
+        ttk.Button(buttons, text="➕ Add", command=add_address).pack(side='left', padx=2)
+        ttk.Button(buttons, text="➖ Remove", command=remove_address).pack(side='left', padx=2)
+        
+        refresh_count()
+    
     def update_data_preview(self):
         """Update the data preview treeview"""
+        import pandas as pd
+        
         # Clear existing data
         for item in self.tree.get_children():
             self.tree.delete(item)
@@ -444,22 +676,33 @@ class EmailSenderGUI:
     
     def test_smtp_connection(self):
         """Test SMTP connection"""
-        if not all([self.smtp_server.get(), self.smtp_port.get(), self.username.get(), self.password.get()]):
+        login = [] if is_local(self.smtp_server.get()) else [self.smtp_port.get(), self.username.get(), self.password.get()]
+        if not all([self.smtp_server.get()] + login):
             messagebox.showwarning("Warning", "Please fill in all SMTP configuration fields!")
             return
         
         def test_connection():
+            from send_engine import SendEngine
+            from transports import describe_tls, tls_stats
             try:
                 self.connection_status.config(text="🔄 Testing connection...", foreground='blue')
                 self.root.update()
                 
-                server = smtplib.SMTP(self.smtp_server.get(), int(self.smtp_port.get()))
-                server.starttls()
-                server.login(self.username.get(), self.password.get())
-                server.quit()
+                # Open the campaign's connections now and keep them for the next send
+                before = tls_stats()
+                account = account_from_settings(self.get_smtp_settings(), connections=int(self.connections.get() or 1))
+                engine = SendEngine([account])
+                errors = engine.warm()
+                if errors:
+                    engine.close()
+                    raise errors[account.name]
+                if self.warm_engine is not None:
+                    self.warm_engine.close()
+                self.warm_engine = engine
                 
                 self.connection_status.config(text="✅ Connection successful!", foreground='green')
-                self.log_message("✅ SMTP connection test successful")
+                self.log_message(f"✅ SMTP connection test successful: {account.connections} connection(s) "
+                                 f"ready ({describe_tls(tls_stats(), since=before)})")
                 
             except Exception as e:
                 self.connection_status.config(text=f"❌ Connection failed: {str(e)}", foreground='red')
@@ -486,6 +729,65 @@ class EmailSenderGUI:
         self.smtp_port.set("587")
         self.log_message("📝 Loaded Outlook preset configuration")
     
+    def add_account(self):
+        """Add an extra SMTP account for bulk sending"""
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Add SMTP Account")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        main_frame = ttk.Frame(dialog, padding=20)
+        main_frame.pack(fill='both', expand=True)
+        
+        fields = [
+            ("Name", "name", ""), ("SMTP Server", "server", self.smtp_server.get()), ("SMTP Port", "port", "587"),
+            ("Username", "username", ""), ("Password", "password", ""), ("Sender Email", "sender_email", ""),
+            ("Emails per Second (0 = unlimited)", "rate", "1"), ("Weight", "weight", "1"), ("Connections", "connections", "1")
+        ]
+        values = {}
+        for row, (label, key, default) in enumerate(fields):
+            ttk.Label(main_frame, text=f"{label}:").grid(row=row, column=0, sticky='w', pady=3)
+            values[key] = tk.StringVar(value=default)
+            ttk.Entry(main_frame, textvariable=values[key], width=35,
+                      show="*" if key == 'password' else "").grid(row=row, column=1, padx=10, pady=3)
+        
+        def save_account():
+            try:
+                account = SmtpAccount(
+                    values['name'].get().strip() or f"Account {len(self.extra_accounts) + 1}",
+                    values['server'].get().strip(), values['port'].get().strip(), values['username'].get().strip(),
+                    values['password'].get(), values['sender_email'].get().strip(),
+                    rate=float(values['rate'].get() or 0), weight=int(values['weight'].get() or 1),
+                    connections=int(values['connections'].get() or 1)
+                )
+            except ValueError:
+                messagebox.showwarning("Warning", "Rate, weight and connections must be numbers!", parent=dialog)
+                return
+            if not account.server or not account.sender_email:
+                messagebox.showwarning("Warning", "Server and sender email are required!", parent=dialog)
+                return
+            self.extra_accounts.append(account)
+            self.refresh_accounts_list()
+            self.log_message(f"🔀 Added SMTP account {account.name}")
+            dialog.destroy()
+        
+        ttk.Button(main_frame, text="Add Account", command=save_account).grid(row=len(fields), column=1, sticky='e', pady=10)
+    
+    def remove_account(self):
+        """Remove the selected extra SMTP account"""
+        selection = self.accounts_list.curselection()
+        if selection:
+            self.extra_accounts.pop(selection[0])
+            self.refresh_accounts_list()
+    
+    def refresh_accounts_list(self):
+        """Redraw the extra accounts list"""
+        self.accounts_list.delete(0, 'end')
+        for account in self.extra_accounts:
+            rate = f"{account.rate:g}/s" if account.rate else "unlimited"
+            self.accounts_list.insert('end', f"{account.name} — {account.sender_email} via {account.server} "
+                                             f"({rate}, weight {account.weight}, {account.connections} conn)")
+    
     def make_bold(self):
         """Insert bold formatting"""
         self.insert_formatting("<strong>", "</strong>")
@@ -554,20 +856,31 @@ class EmailSenderGUI:
         """Preview HTML in browser"""
         self.open_in_browser()
     
+    def get_email_content(self):
+        """Return the email body being composed"""
+        if not self.tab_built('compose'):
+            return self.pending_content
+        return self.email_content.get(1.0, 'end-1c')
+    
+    def set_email_content(self, content):
+        """Replace the email body being composed"""
+        if not self.tab_built('compose'):
+            self.pending_content = content
+            return
+        self.email_content.delete(1.0, 'end')
+        self.email_content.insert(1.0, content)
+    
     def load_welcome_template(self):
         """Load welcome email template"""
-        self.email_content.delete(1.0, 'end')
-        self.email_content.insert(1.0, self.get_welcome_template())
+        self.set_email_content(self.get_welcome_template())
     
     def load_notification_template(self):
         """Load notification template"""
-        self.email_content.delete(1.0, 'end')
-        self.email_content.insert(1.0, self.get_notification_template())
+        self.set_email_content(self.get_notification_template())
     
     def load_certificate_template(self):
         """Load certificate template"""
-        self.email_content.delete(1.0, 'end')
-        self.email_content.insert(1.0, self.get_certificate_template())
+        self.set_email_content(self.get_certificate_template())
     
     def get_welcome_template(self):
         """Return welcome email template"""
@@ -635,6 +948,12 @@ class EmailSenderGUI:
     
     def update_email_preview(self):
         """Update email preview with current data"""
+        if not self.tab_built('preview'):
+            # Rendered when the tab is first shown
+            return
+        
+        from templating import TemplateError, render_template
+        
         if self.csv_data is None or len(self.csv_data) == 0:
             self.preview_info.config(text="No data loaded")
             self.preview_display.config(state='normal')
@@ -653,11 +972,13 @@ class EmailSenderGUI:
         self.preview_info.config(text=f"Preview {self.current_preview_index + 1} of {len(self.csv_data)}: {row['Name']} ({row['Email']})")
         
         # Generate preview content
-        content = self.email_content.get(1.0, 'end-1c')
+        content = self.get_email_content()
         
-        # Replace variables
-        for column in self.csv_data.columns:
-            content = content.replace(f"{{{column}}}", str(row[column]) if pd.notna(row[column]) else "")
+        # Render variables, conditionals and loops
+        try:
+            content = render_template(content, row.to_dict())
+        except TemplateError as e:
+            content = f"Template error: {e}\n\n{content}"
         
         # Update preview display
         self.preview_display.config(state='normal')
@@ -686,6 +1007,9 @@ class EmailSenderGUI:
         # Get current content
         content = self.preview_display.get(1.0, 'end-1c')
         
+        import tempfile
+        import webbrowser
+        
         # Create temporary HTML file
         with tempfile.NamedTemporaryFile(mode='w', suffix='.html', delete=False) as f:
             f.write(f"""
@@ -720,7 +1044,10 @@ class EmailSenderGUI:
         def send_test():
             try:
                 self.log_message(f"📧 Sending test email to {first_row['Email']}...")
-                self.send_single_email(first_row['Email'], first_row['Name'], first_row.to_dict())
+                prefetched = self.row_attachment_prefetcher().load_row(first_row)
+                if prefetched.error:
+                    raise AttachmentError(prefetched.error)
+                self.send_single_email(first_row['Email'], first_row['Name'], first_row.to_dict(), prefetched.attachments)
                 self.log_message("✅ Test email sent successfully!")
                 messagebox.showinfo("Success", f"Test email sent to {first_row['Email']}")
             except Exception as e:
@@ -741,7 +1068,7 @@ class EmailSenderGUI:
             messagebox.showwarning("Warning", "Please enter email subject!")
             return
         
-        if not self.email_content.get(1.0, 'end-1c').strip():
+        if not self.get_email_content().strip():
             messagebox.showwarning("Warning", "Please enter email content!")
             return
         
@@ -798,6 +1125,8 @@ class EmailSenderGUI:
             dialog.destroy()
             
             def send_custom_thread():
+                import pandas as pd
+                
                 try:
                     self.log_message(f"📮 Sending custom test email to {email}...")
                     
@@ -831,8 +1160,66 @@ class EmailSenderGUI:
         dialog.bind('<Return>', lambda e: send_custom())
         dialog.bind('<Escape>', lambda e: dialog.destroy())
     
-    def send_all_emails(self):
-        """Send emails to all recipients"""
+    def schedule_send(self):
+        """Schedule the campaign across a send window"""
+        if not self.validate_send_requirements():
+            return
+        
+        dialog = tk.Toplevel(self.root)
+        dialog.title("Schedule Campaign")
+        dialog.transient(self.root)
+        dialog.grab_set()
+        
+        main_frame = ttk.Frame(dialog, padding=20)
+        main_frame.pack(fill='both', expand=True)
+        
+        from scheduler import default_timezone_name, resolve_timezone
+        # Start and deadline are read in the campaign's zone, so the defaults are its current time too
+        timezone_name = default_timezone_name()
+        now = datetime.datetime.now(resolve_timezone(timezone_name)).replace(tzinfo=None)
+        fields = [
+            ("Start (YYYY-MM-DD HH:MM)", "start", now.strftime("%Y-%m-%d %H:%M")),
+            ("Deadline (YYYY-MM-DD HH:MM)", "deadline", (now + datetime.timedelta(hours=8)).strftime("%Y-%m-%d %H:%M")),
+            ("Campaign Timezone", "timezone", timezone_name),
+            ("Priority (higher sends first)", "priority", "0"),
+            ("Shared Emails/sec (0 = unlimited)", "rate", "0")
+        ]
+        values = {}
+        for row, (label, key, default) in enumerate(fields):
+            ttk.Label(main_frame, text=f"{label}:").grid(row=row, column=0, sticky='w', pady=3)
+            values[key] = tk.StringVar(value=default)
+            ttk.Entry(main_frame, textvariable=values[key], width=30).grid(row=row, column=1, padx=10, pady=3)
+        
+        # Optional per-recipient timezone column
+        ttk.Label(main_frame, text="Timezone Column:").grid(row=len(fields), column=0, sticky='w', pady=3)
+        tz_col = tk.StringVar(value="(none)")
+        ttk.Combobox(main_frame, textvariable=tz_col, state='readonly', width=27,
+                     values=["(none)"] + list(self.csv_data.columns)).grid(row=len(fields), column=1, padx=10, pady=3)
+        
+        def confirm_schedule():
+            try:
+                schedule = {
+                    'start': datetime.datetime.strptime(values['start'].get().strip(), "%Y-%m-%d %H:%M"),
+                    'deadline': datetime.datetime.strptime(values['deadline'].get().strip(), "%Y-%m-%d %H:%M"),
+                    'priority': int(values['priority'].get() or 0),
+                    'rate': float(values['rate'].get() or 0),
+                    'timezone': values['timezone'].get().strip(),
+                    'tz_col': tz_col.get() if tz_col.get() != "(none)" else None
+                }
+            except ValueError:
+                messagebox.showwarning("Warning", "Use YYYY-MM-DD HH:MM for times and numbers for priority and rate!",
+                                       parent=dialog)
+                return
+            if schedule['deadline'] <= schedule['start']:
+                messagebox.showwarning("Warning", "The deadline must be after the start!", parent=dialog)
+                return
+            dialog.destroy()
+            self.send_all_emails(schedule)
+        
+        ttk.Button(main_frame, text="Schedule", command=confirm_schedule).grid(row=len(fields) + 1, column=1, sticky='e', pady=10)
+    
+    def send_all_emails(self, schedule=None):
+        """Send emails to all recipients, now or spread over a schedule"""
         if not self.validate_send_requirements():
             return
         
@@ -841,62 +1228,163 @@ class EmailSenderGUI:
             return
         
         # Confirm sending
-        result = messagebox.askyesno("Confirm", f"Send emails to {len(self.csv_data)} recipients?")
+        if schedule:
+            prompt = (f"Schedule {len(self.csv_data)} emails between {schedule['start']:%Y-%m-%d %H:%M} "
+                      f"and {schedule['deadline']:%Y-%m-%d %H:%M}?")
+        else:
+            prompt = f"Send emails to {len(self.csv_data)} recipients?"
+        result = messagebox.askyesno("Confirm", prompt)
         if not result:
             return
         
+        # Every configured account sends concurrently over persistent connections
+        try:
+            accounts = [account_from_settings(self.get_smtp_settings(), rate=float(self.send_rate.get() or 0),
+                                              connections=int(self.connections.get() or 1))]
+        except ValueError:
+            messagebox.showwarning("Warning", "Emails/sec and connections must be numbers!")
+            return
+        for account in self.extra_accounts:
+            if not account.password and not is_local(account.server):
+                account.password = tk.simpledialog.askstring("Password", f"Password for {account.name}:", show='*') or ''
+        accounts += self.extra_accounts
+        
+        from inline_images import prepare_body
+        from message_builder import choose_body_encoding
+        from governor import get_governor
+        from scheduler import get_scheduler, resolve_timezone
+        from send_engine import SendEngine, SendJob, settled_job
+        from transports import describe_tls, tls_stats
+        from domain_check import undeliverable_rows
+        from suppression import suppressed_rows
+        
+        # Checked once for the whole column before any SMTP work
+        skip_rows = {index: f"Suppressed ({reason})" for index, reason in suppressed_rows(self.csv_data['Email']).items()}
+        check_domains = self.check_domains.get()
+        
+        # Read the template once on the UI thread; pasted images become shared inline parts and
+        # CSS is inlined and markup minified once per campaign
+        content, inline_images = prepare_body(self.get_email_content())
+        body_encoding = choose_body_encoding(content, eight_bit=True)
+        subject = self.subject.get()
+        reply_to = self.reply_to_email.get()
+        
         # Start sending
         self.sending_stopped = False
         self.send_button.config(state='disabled')
         self.stop_button.config(state='normal')
+        # CPU and allocation reports for the start of the run, written under ./profiles
+        profile = None
+        if self.profile_campaign.get():
+            from profiling import DEFAULT_SECONDS, ProfileCapture, describe_profile
+            profile = ProfileCapture(seconds=DEFAULT_SECONDS)
+            self.log_message(f"🔬 Profiling the first {DEFAULT_SECONDS}s of sending into {profile.directory}")
+        
+        # Shared with scheduled campaigns running through the same accounts
+        self.engine = SendEngine(accounts, governor=get_governor(), profile=profile)
         
         def send_all():
+            tls_before = tls_stats()
             try:
+                # Reuse the tested connections and log in the rest in parallel before any recipient
+                if self.warm_engine is not None:
+                    self.engine.adopt_connections(self.warm_engine)
+                    self.warm_engine = None
+                login_errors = self.engine.warm()
+                for name, error in login_errors.items():
+                    self.log_message(f"❌ Could not log in to {name}: {error}")
+                if len(login_errors) == len(accounts):
+                    messagebox.showerror("Error", "No SMTP account could log in; nothing was sent.")
+                    return
+
                 total = len(self.csv_data)
                 sent = 0
                 failed = 0
                 
                 self.progress_bar['maximum'] = total
                 
-                for index, row in self.csv_data.iterrows():
-                    if self.sending_stopped:
-                        self.log_message("⏹️ Sending stopped by user")
-                        break
+                # Redraw progress at a bounded rate instead of after every email
+                def show_progress(snapshot):
+                    self.progress_bar['value'] = snapshot.processed
+                    self.progress_label.config(text=describe_progress(snapshot))
+                    self.root.update()
+                
+                reporter = ProgressReporter(total, show_progress)
+                
+                # Domains are looked up here, off the UI thread; suppressions take precedence
+                if check_domains:
+                    self.progress_label.config(text="🔎 Checking recipient domains...")
+                    for index, reason in undeliverable_rows(self.csv_data['Email']).items():
+                        skip_rows.setdefault(index, f"Undeliverable: {reason}")
+                
+                # Per-row files are read and encoded ahead of the send loop on background threads
+                campaign_attachments = self.spooled_attachments()
+                prefetcher = self.row_attachment_prefetcher(message_size(content, campaign_attachments + inline_images))
+                
+                def build_job(index, row, prefetched):
+                    email = row['Email']
+                    name = row['Name']
                     
-                    try:
-                        email = row['Email']
-                        name = row['Name']
-                        
-                        if pd.isna(email) or email.strip() == '':
-                            self.log_message(f"⚠️ Skipping {name}: No email address")
-                            continue
-                        
-                        self.log_message(f"📧 Sending to {name} ({email})...")
-                        
-                        self.send_single_email(email, name, row.to_dict())
+                    settled = settled_job(index, email, skip_rows.get(index), prefetched, data=name)
+                    if settled is not None:
+                        return settled
+                    
+                    job_subject, job_content = self.render_email(subject, content, name, row.to_dict())
+                    return SendJob(index, email, job_subject, job_content, campaign_attachments + prefetched.attachments,
+                                   reply_to=reply_to, data=name, inline_images=inline_images,
+                                   body_encoding=body_encoding)
+                
+                def make_jobs():
+                    for index, row, prefetched in prefetcher.iterate(self.csv_data.iterrows()):
+                        yield build_job(index, row, prefetched)
+                
+                if schedule:
+                    # Rows are released by the shared scheduler and rendered as they come due
+                    def make_scheduled_job(pos, _tz):
+                        row = self.csv_data.iloc[pos]
+                        return build_job(self.csv_data.index[pos], row, prefetcher.load_row(row))
+                    
+                    scheduler = get_scheduler()
+                    scheduler.set_rate(schedule['rate'])
+                    tz_values = (self.csv_data[schedule['tz_col']].tolist() if schedule['tz_col']
+                                 else [None] * total)
+                    self.campaign = scheduler.submit(
+                        list(enumerate(tz_values)), make_scheduled_job,
+                        start=schedule['start'], deadline=schedule['deadline'], priority=schedule['priority'],
+                        name=subject, timezone_of=lambda tz: tz, default_tz=resolve_timezone(schedule['timezone'])
+                    )
+                    self.log_message(f"📅 Scheduled {total} emails between {schedule['start']:%Y-%m-%d %H:%M} "
+                                     f"and {schedule['deadline']:%Y-%m-%d %H:%M}")
+                    jobs = self.campaign
+                else:
+                    jobs = make_jobs()
+                
+                for result in self.engine.run(jobs):
+                    name = result.job.data
+                    # Searchable per-recipient record in the event log files
+                    fields = {'campaign': subject, 'recipient': result.job.recipient, 'name': name,
+                              'status': result.status, 'account': result.account, 'attempts': result.job.attempts}
+                    if result.status == 'sent':
                         sent += 1
-                        
-                        self.log_message(f"✅ Sent to {name}")
-                        
-                        # Update progress
-                        self.progress_bar['value'] = sent + failed
-                        self.progress_label.config(text=f"Sent: {sent} | Failed: {failed} | Remaining: {total - sent - failed}")
-                        self.root.update()
-                        
-                        # Small delay to avoid overwhelming the server
-                        time.sleep(2)
-                        
-                    except Exception as e:
+                        retried = f" after {result.job.attempts} attempts" if result.job.attempts > 1 else ""
+                        self.log_message(f"✅ Sent to {name} ({result.job.recipient}) via {result.account}{retried}", **fields)
+                    elif result.status == 'skipped':
+                        self.log_message(f"⚠️ Skipping {name}: {result.message}", error=result.message, **fields)
+                    else:
                         failed += 1
-                        self.log_message(f"❌ Failed to send to {row['Name']}: {str(e)}")
-                        
-                        # Update progress
-                        self.progress_bar['value'] = sent + failed
-                        self.progress_label.config(text=f"Sent: {sent} | Failed: {failed} | Remaining: {total - sent - failed}")
-                        self.root.update()
+                        self.log_message(f"❌ Failed to send to {name}: {result.message}", error=result.message, **fields)
+                    
+                    # Update progress (throttled)
+                    reporter.record(result.status == 'sent', skipped=result.status == 'skipped')
+                
+                if self.sending_stopped:
+                    self.log_message("⏹️ Sending stopped by user")
                 
                 # Final summary
-                self.log_message(f"🏁 Sending complete! Sent: {sent}, Failed: {failed}")
+                self.log_message(f"🏁 Sending complete! Sent: {sent}, Failed: {failed}",
+                                 campaign=subject, sent=sent, failed=failed)
+                self.log_message(f"🔒 {describe_tls(tls_stats(), since=tls_before)}")
+                reporter.finish()
                 self.progress_label.config(text=f"Complete! Sent: {sent} | Failed: {failed}")
                 
                 if not self.sending_stopped:
@@ -907,6 +1395,10 @@ class EmailSenderGUI:
                 messagebox.showerror("Error", f"Critical error: {str(e)}")
             
             finally:
+                self.engine.close()
+                if profile is not None and profile.report is not None:
+                    self.log_message(f"🔬 Profile: {describe_profile(profile.report)}")
+                self.campaign = None
                 self.send_button.config(state='normal')
                 self.stop_button.config(state='disabled')
         
@@ -915,53 +1407,72 @@ class EmailSenderGUI:
     def stop_sending(self):
         """Stop the email sending process"""
         self.sending_stopped = True
+        if self.campaign is not None:
+            from scheduler import get_scheduler
+            get_scheduler().cancel(self.campaign)
+        if self.engine is not None:
+            self.engine.stop()
         self.stop_button.config(state='disabled')
     
-    def send_single_email(self, to_email, name, row_data):
-        """Send a single email"""
-        # Create email content
-        content = self.email_content.get(1.0, 'end-1c')
+    def render_email(self, subject, content, name, row_data):
+        """Return the personalized subject and content for one recipient"""
+        from templating import render_template
         
-        # Replace variables
-        for column, value in row_data.items():
-            content = content.replace(f"{{{column}}}", str(value) if pd.notna(value) else "")
+        # Templates are compiled once and cached, so this is cheap per row
+        content = render_template(content, row_data)
+        return render_template(subject, {**row_data, 'Name': name}), content
+    
+    def send_single_email(self, to_email, name, row_data, extra_attachments=None):
+        """Send a single email"""
+        from inline_images import prepare_body
+        from message_builder import build_message
+        from transports import open_transport
         
-        # Create message
-        msg = MIMEMultipart()
-        msg['From'] = self.sender_email.get()
-        msg['To'] = to_email
-        msg['Reply-To'] = self.reply_to_email.get()
-        msg['Subject'] = self.subject.get().replace("{Name}", name)
+        # Create email content
+        body, inline_images = prepare_body(self.get_email_content())
+        subject, content = self.render_email(self.subject.get(), body, name, row_data)
         
-        # Attach body
-        msg.attach(MIMEText(content, 'html'))
+        # Connect first: the body may go 8bit if the server supports it
+        server = open_transport(self.get_smtp_settings())
         
-        # Attach files
-        for file_path in self.attachments:
-            try:
-                filename = os.path.basename(file_path)
-                with open(file_path, 'rb') as attachment:
-                    part = MIMEBase('application', 'octet-stream')
-                    part.set_payload(attachment.read())
-                    encoders.encode_base64(part)
-                    part.add_header('Content-Disposition', f'attachment; filename="{filename}"')
-                    msg.attach(part)
-            except Exception as e:
-                self.log_message(f"⚠️ Failed to attach {filename}: {str(e)}")
-
+        # Create message (attachments are streamed from the spool, not read per recipient)
+        msg = build_message(self.sender_email.get(), to_email, subject,
+                            content, self.spooled_attachments() + list(extra_attachments or []),
+                            reply_to=self.reply_to_email.get(), inline_images=inline_images,
+                            eight_bit=server.eight_bit)
         
         # Send email
-        server = smtplib.SMTP(self.smtp_server.get(), int(self.smtp_port.get()))
-        server.starttls()
-        server.login(self.username.get(), self.password.get())
-        server.sendmail(self.sender_email.get(), to_email, msg.as_string())
+        server.deliver(self.sender_email.get(), to_email, msg)
         server.quit()
     
+    def get_smtp_settings(self):
+        """Return the SMTP settings as a plain dict"""
+        return {
+            'server': self.smtp_server.get(), 'port': self.smtp_port.get(),
+            'username': self.username.get(), 'password': self.password.get(),
+            'sender_email': self.sender_email.get(), 'reply_to': self.reply_to_email.get()
+        }
+    
+    def row_attachment_prefetcher(self, message_bytes=0):
+        """Return a prefetcher for the per-recipient attachment column
+
+        `message_bytes` is the size of the rest of the message, so rows whose
+        files would take it over the limit fail instead of being sent.
+        """
+        column = self.attachment_column.get()
+        base_dir = os.path.dirname(self.csv_file_path.get()) or None
+        return AttachmentPrefetcher(None if column == "(none)" else column, base_dir=base_dir,
+                                    message_bytes=message_bytes)
+    
+    def spooled_attachments(self):
+        """Return spool entries for the attachment list, encoding each once"""
+        return [self.attachment_store.add_path(path) for path in self.attachments]
+    
     def validate_send_requirements(self):
         """Validate all requirements for sending emails"""
-        # Check SMTP configuration
-        if not all([self.smtp_server.get(), self.smtp_port.get(), self.username.get(), 
-                   self.password.get(), self.sender_email.get(), self.reply_to_email.get()]):
+        # Check SMTP configuration (local transports have no login)
+        login = [] if is_local(self.smtp_server.get()) else [self.smtp_port.get(), self.username.get(), self.password.get()]
+        if not all([self.smtp_server.get(), self.sender_email.get(), self.reply_to_email.get()] + login):
             messagebox.showwarning("Warning", "Please complete SMTP configuration!")
             return False
         
@@ -971,7 +1482,7 @@ class EmailSenderGUI:
             return False
         
         # Check content
-        if not self.email_content.get(1.0, 'end-1c').strip():
+        if not self.get_email_content().strip():
             messagebox.showwarning("Warning", "Please enter email content!")
             return False
         
@@ -980,15 +1491,52 @@ class EmailSenderGUI:
             messagebox.showwarning("Warning", "Please load CSV data!")
             return False
         
+        from inline_images import prepare_body
+        from templating import TemplateError, compile_template
+        
+        # Check the template compiles before anything is sent
+        columns = tuple(self.csv_data.columns)
+        try:
+            compile_template(self.get_email_content(), columns)
+            compile_template(self.subject.get(), columns + ('Name',))
+        except TemplateError as e:
+            messagebox.showwarning("Warning", f"Template error: {str(e)}")
+            return False
+        
+        # Check attachment and message size before anything is sent
+        try:
+            body, inline_images = prepare_body(self.get_email_content())
+            check_message_size(body, self.spooled_attachments() + inline_images)
+            self.attachment_store.prepare()
+        except (AttachmentError, OSError) as e:
+            messagebox.showwarning("Warning", f"Attachment problem: {str(e)}")
+            return False
+        
         return True
     
-    def log_message(self, message):
-        """Add message to log display"""
-        self.log_display.config(state='normal')
-        self.log_display.insert('end', f"{time.strftime('%H:%M:%S')} - {message}\n")
-        self.log_display.see('end')
-        self.log_display.config(state='disabled')
-        self.root.update()
+    def log_message(self, message, **fields):
+        """Add a message to the log display and the event log (with any per-recipient fields)"""
+        line = f"{time.strftime('%H:%M:%S')} - {message}\n"
+        with self.log_lock:
+            self.log_lines.append(line)
+            self.log_count += 1
+        self.event_log.write(message, **fields)
+
+    def draw_log(self):
+        """Draw the lines logged since the last call, keeping only the last LOG_LINES on screen"""
+        with self.log_lock:
+            new = min(self.log_count - self.log_drawn, len(self.log_lines))
+            lines = list(itertools.islice(self.log_lines, len(self.log_lines) - new, None))
+            self.log_drawn = self.log_count
+        if lines:
+            self.log_display.config(state='normal')
+            self.log_display.insert('end', ''.join(lines))
+            excess = int(self.log_display.index('end-1c').split('.')[0]) - 1 - LOG_LINES
+            if excess > 0:
+                self.log_display.delete('1.0', f'{excess + 1}.0')
+            self.log_display.see('end')
+            self.log_display.config(state='disabled')
+        self.root.after(LOG_REDRAW_MS, self.draw_log)
 
     def add_attachment(self):
         """Add files to attachment list"""
@@ -996,6 +1544,11 @@ class EmailSenderGUI:
         if filenames:
             for filename in filenames:
                 if filename not in self.attachments:
+                    try:
+                        self.attachment_store.add_path(filename)
+                    except (AttachmentError, OSError) as e:
+                        messagebox.showerror("Error", f"Cannot attach file: {str(e)}")
+                        continue
                     self.attachments.append(filename)
                     self.attachment_list.insert('end', os.path.basename(filename))
 
@@ -1005,11 +1558,13 @@ class EmailSenderGUI:
         if selection:
             index = selection[0]
             self.attachment_list.delete(index)
-            self.attachments.pop(index)
+            self.attachment_store.remove(self.attachments.pop(index))
 
     def clear_attachments(self):
         """Clear all attachments"""
         self.attachment_list.delete(0, 'end')
+        for path in self.attachments:
+            self.attachment_store.remove(path)
         self.attachments.clear()
 
     def save_config(self):
@@ -1021,7 +1576,9 @@ class EmailSenderGUI:
             # Security: Do not save password
             "sender_email": self.sender_email.get(),
             "reply_to_email": self.reply_to_email.get(),
-            "subject": self.subject.get()
+            "subject": self.subject.get(),
+            # Extra accounts are saved without their passwords
+            "accounts": [account.to_config() for account in self.extra_accounts]
         }
         
         try:
@@ -1049,6 +1606,10 @@ class EmailSenderGUI:
                 # Only load subject if saved
                 if "subject" in config:
                     self.subject.set(config["subject"])
+                
+                # Passwords for extra accounts are asked for when sending
+                self.extra_accounts = accounts_from_config(config.get("accounts", []))
+                self.refresh_accounts_list()
                     
                 self.log_message("📂 Configuration loaded")
             except Exception as e:
@@ -1071,8 +1632,10 @@ except ImportError:
     pass
 
 def main():
+    startup_mark("modules imported")
     root = tk.Tk()
     app = EmailSenderGUI(root)
+    startup_mark("window built")
     
     # Set initial values
     app.subject.set("Welcome to our platform!")
@@ -1080,6 +1643,12 @@ def main():
     app.reply_to_email.set("info@mulearn.org")
     app.load_welcome_template()
     
+    # Once the window is drawn, import what sending needs in the background
+    def on_ready():
+        startup_mark("window ready")
+        threading.Thread(target=warm_imports, name='warm-imports', daemon=True).start()
+    
+    root.after_idle(on_ready)
     root.mainloop()
 
 if __name__ == "__main__":
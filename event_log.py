@@ -0,0 +1,148 @@
+"""
+Structured activity log
+
+Every line the desktop app logs is also written as one JSON object per line,
+with per-recipient fields (recipient, status, account, attempts, error) when
+they are known, so the full history of a campaign can be searched or loaded
+with pandas long after the on-screen log has dropped it. Callers only put
+entries on a queue; a background thread serializes and writes them in
+batches and rotates the file by size.
+
+    MUMAILER_LOG_DIR=/var/log/mumailer    # default ./logs
+    MUMAILER_LOG_MB=50                    # rotate at this size (default 10), keeping 5 old files
+"""
+
+import atexit
+import datetime
+import json
+import os
+import queue
+import threading
+import time
+
+
+DIR_ENV = 'MUMAILER_LOG_DIR'
+SIZE_ENV = 'MUMAILER_LOG_MB'
+DEFAULT_DIR = 'logs'
+DEFAULT_MB = 10
+BACKUPS = 5
+LOG_FILE = 'mumailer.jsonl'
+
+_CLOSE = object()
+
+
+class EventLog:
+    """JSON lines written by a background thread, rotated to path.1 ... path.N when the file grows past max_bytes"""
+
+    def __init__(self, path, max_bytes=DEFAULT_MB * 1024 * 1024, backups=BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dropped = 0
+        self._queue = queue.SimpleQueue()
+        self._file = None
+        self._thread = threading.Thread(target=self._run, name='event-log', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def write(self, message=None, **fields):
+        """Queue one entry; never blocks on the disk"""
+        if message is not None:
+            fields['message'] = message
+        self._queue.put((time.time(), fields))
+
+    def flush(self, timeout=None):
+        """Wait until everything queued so far is on disk"""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(_CLOSE)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Whatever queued up while the last batch was written goes out in one write
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for item in batch:
+                if isinstance(item, tuple):
+                    lines.append(self._format(*item))
+            try:
+                self._write(lines)
+            except OSError:
+                # A full or missing disk must not stop a campaign
+                self.dropped += len(lines)
+                if self._file is not None:
+                    try:
+                        self._file.close()
+                    except OSError:
+                        pass
+                self._file = None
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if any(item is _CLOSE for item in batch):
+                if self._file is not None:
+                    self._file.close()
+                return
+
+    def _format(self, stamp, fields):
+        entry = {'time': datetime.datetime.fromtimestamp(stamp).astimezone().isoformat(timespec='milliseconds')}
+        # NaN (an empty spreadsheet cell) is not valid JSON
+        entry.update((key, None if isinstance(value, float) and value != value else value)
+                     for key, value in fields.items())
+        return json.dumps(entry, ensure_ascii=False, default=str) + '\n'
+
+    def _write(self, lines):
+        if not lines:
+            return
+        if self._file is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            self._file = open(self.path, 'ab')
+        size = self._file.tell()
+        chunk = []
+        for line in lines:
+            data = line.encode('utf-8')
+            if self.max_bytes and size and size + len(data) > self.max_bytes:
+                self._file.write(b''.join(chunk))
+                chunk = []
+                self._rotate()
+                size = 0
+            chunk.append(data)
+            size += len(data)
+        self._file.write(b''.join(chunk))
+        self._file.flush()
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self._file = open(self.path, 'ab')
+
+
+_log = None
+_log_lock = threading.Lock()
+
+
+def get_event_log():
+    """Return the process-wide event log, placed and sized from MUMAILER_LOG_DIR and MUMAILER_LOG_MB"""
+    global _log
+    with _log_lock:
+        if _log is None:
+            directory = os.environ.get(DIR_ENV) or DEFAULT_DIR
+            max_mb = float(os.environ.get(SIZE_ENV) or DEFAULT_MB)
+            _log = EventLog(os.path.join(directory, LOG_FILE), int(max_mb * 1024 * 1024))
+        return _log
@@ -0,0 +1,309 @@
+"""
+Send governor shared by every campaign in the process
+
+Each send engine paces itself from its own account settings, but several
+campaigns (or several teammates on the hosted app) can send through the same
+account at once. The governor keeps one rate limit and one connection cap
+per account, keyed by server, port and username, and governed engines take
+every send and every connection from it. When campaigns are waiting, the
+one that has sent least goes next, and a campaign holding more than its
+share of connections gives one up to a waiting campaign. A campaign that
+sends in batches keeps its connections (and their slots) parked between
+batches; a campaign waiting for a slot takes one of those first.
+
+The limits are the lowest rate and connection count that the running
+campaigns set for the account. With MUMAILER_GOVERNOR_DB pointing at a
+SQLite file, the rate limit is shared by every process using that file
+(the app, queue workers and spool dispatchers); connection caps stay per
+process.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from smtp_accounts import RateLimiter
+
+
+DB_ENV = 'MUMAILER_GOVERNOR_DB'
+
+# How often waiters re-check when nothing wakes them (seconds)
+POLL_INTERVAL = 0.25
+
+GovernorStats = namedtuple('GovernorStats', ['account', 'rate', 'connections', 'campaigns', 'in_use', 'sent'])
+
+
+def account_key(account):
+    """Identify an account by where it logs in, whatever each campaign calls it"""
+    return f"{account.username or ''}@{account.server}:{account.port}".lower()
+
+
+def describe_governor(stats):
+    rate = f"{stats.rate:g}/s" if stats.rate else "no rate limit"
+    connections = f"{stats.in_use}/{stats.connections}" if stats.connections else str(stats.in_use)
+    return (f"{stats.account}: {stats.campaigns} campaign(s), {rate}, "
+            f"{connections} connections, {stats.sent} sent")
+
+
+class SqliteRateLimiter:
+    """Token bucket kept in a SQLite file, so every process using the file shares the rate"""
+
+    def __init__(self, path, key, rate, burst=None, clock=time.time):
+        self.key = key
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate or 1.0)
+        self.clock = clock
+        self._conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False, isolation_level=None)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS buckets "
+                               "(key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate in place; the bucket in the file carries over"""
+        with self._lock:
+            self.rate = rate
+            self.capacity = burst or max(1.0, rate or 1.0)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def try_acquire(self):
+        """Take a token if one is available; returns 0 if taken, otherwise the seconds until one is"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (self.key,)).fetchone()
+                now = self.clock()
+                tokens = self.capacity if row is None else min(self.capacity, row[0] + max(0.0, now - row[1]) * self.rate)
+                wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+                if not wait:
+                    tokens -= 1
+                self._conn.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?, ?)", (self.key, tokens, now))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return wait
+
+
+class AccountGovernor:
+    """Rate limit and connection cap for one account, shared fairly by the campaigns using it"""
+
+    def __init__(self, key, db_path=None):
+        self.key = key
+        self.db_path = db_path
+        self.rate = None
+        self.max_connections = None
+        # One limiter for the governor's life; its rate follows the campaigns registered
+        self.limiter = SqliteRateLimiter(db_path, key, None) if db_path else RateLimiter(None)
+        self._campaigns = {}        # campaign -> (rate, connections) it asked for
+        self._sent = {}             # sends granted per campaign (for fairness)
+        self.sent = 0
+        self._held = {}             # connections held per campaign
+        self._parked = {}           # of those, kept open by a campaign between its runs
+        self._reclaim = {}          # campaign -> callable closing one of its parked connections
+        self._waiting_send = {}
+        self._waiting_connection = {}
+        self._cond = threading.Condition()
+
+    def _apply_limits(self):
+        rates = [rate for rate, _ in self._campaigns.values() if rate]
+        connections = [count for _, count in self._campaigns.values() if count]
+        rate = min(rates) if rates else None
+        self.max_connections = min(connections) if connections else None
+        if rate != self.rate:
+            self.rate = rate
+            self.limiter.set_rate(rate)
+
+    def register(self, campaign, rate=None, connections=None, reclaim=None):
+        with self._cond:
+            # Newcomers start level with the others instead of catching up on their sends
+            self._sent[campaign] = min(self._sent.values(), default=0)
+            self._held[campaign] = 0
+            self._parked[campaign] = 0
+            self._reclaim[campaign] = reclaim
+            self._waiting_send[campaign] = 0
+            self._waiting_connection[campaign] = 0
+            self._campaigns[campaign] = (rate, connections)
+            self._apply_limits()
+            self._cond.notify_all()
+
+    def unregister(self, campaign):
+        with self._cond:
+            for counts in (self._campaigns, self._sent, self._held, self._parked, self._reclaim,
+                           self._waiting_send, self._waiting_connection):
+                counts.pop(campaign, None)
+            self._apply_limits()
+            self._cond.notify_all()
+
+    @property
+    def idle(self):
+        return not self._campaigns
+
+    def _next(self, waiting, served):
+        """The waiting campaign that has been served least (earliest registered on a tie)"""
+        candidates = [campaign for campaign, count in waiting.items() if count]
+        return min(candidates, key=lambda campaign: served[campaign]) if candidates else None
+
+    def acquire_send(self, campaign, stop_event=None):
+        """Block until `campaign` may send one message; returns False if stopped while waiting"""
+        with self._cond:
+            self._waiting_send[campaign] += 1
+        try:
+            while stop_event is None or not stop_event.is_set():
+                with self._cond:
+                    if self._next(self._waiting_send, self._sent) is not campaign:
+                        self._cond.wait(POLL_INTERVAL)
+                        continue
+                # The shared limiter may wait on its SQLite file; other campaigns keep the lock meanwhile
+                wait = self.limiter.try_acquire()
+                with self._cond:
+                    if not wait:
+                        if campaign in self._sent:
+                            self._sent[campaign] += 1
+                        self.sent += 1
+                        self._cond.notify_all()
+                        return True
+                    self._cond.wait(min(wait, POLL_INTERVAL))
+            return False
+        finally:
+            with self._cond:
+                if campaign in self._waiting_send:
+                    self._waiting_send[campaign] -= 1
+
+    def acquire_connection(self, campaign, stop_event=None):
+        """Block until `campaign` may hold one more connection; returns False if stopped while waiting"""
+        with self._cond:
+            self._waiting_connection[campaign] += 1
+        try:
+            while stop_event is None or not stop_event.is_set():
+                with self._cond:
+                    free = self.max_connections is None or sum(self._held.values()) < self.max_connections
+                    if free and self._next(self._waiting_connection, self._held) is campaign:
+                        self._held[campaign] += 1
+                        self._cond.notify_all()
+                        return True
+                    reclaim = None if free else self._take_parked(campaign)
+                    if reclaim is None:
+                        self._cond.wait(POLL_INTERVAL)
+                # Closed outside the lock, before anyone can open a connection in its place
+                if reclaim is not None:
+                    reclaim()
+            return False
+        finally:
+            with self._cond:
+                self._waiting_connection[campaign] -= 1
+
+    def _take_parked(self, campaign):
+        """Free the slot of another campaign's parked connection; returns what closes the connection"""
+        for other, parked in self._parked.items():
+            if parked and other is not campaign and self._reclaim.get(other) is not None:
+                self._parked[other] -= 1
+                self._held[other] -= 1
+                return self._reclaim[other]
+        return None
+
+    def park_connection(self, campaign):
+        """Keep a held connection open while `campaign` is between runs"""
+        with self._cond:
+            if campaign in self._parked:
+                self._parked[campaign] += 1
+            self._cond.notify_all()
+
+    def unpark_connection(self, campaign):
+        """Take back one of `campaign`'s parked slots; False if there is none left (or it was reclaimed)"""
+        with self._cond:
+            if self._parked.get(campaign):
+                self._parked[campaign] -= 1
+                return True
+            return False
+
+    def release_connection(self, campaign):
+        with self._cond:
+            if self._held.get(campaign):
+                self._held[campaign] -= 1
+            self._cond.notify_all()
+
+    def connection_wanted(self):
+        """True when some campaign is waiting for a connection"""
+        with self._cond:
+            return any(self._waiting_connection.values())
+
+    def should_yield(self, campaign):
+        """True when `campaign` holds more than its share of connections and another campaign is waiting for one"""
+        with self._cond:
+            if self.max_connections is None:
+                return False
+            others_waiting = any(count for other, count in self._waiting_connection.items() if other is not campaign)
+            share = max(1, self.max_connections // max(1, len(self._campaigns)))
+            return others_waiting and self._held.get(campaign, 0) > share
+
+    def stats(self):
+        with self._cond:
+            return GovernorStats(self.key, self.rate, self.max_connections, len(self._campaigns),
+                                 sum(self._held.values()), self.sent)
+
+
+class SendGovernor:
+    """Per-account governors for every send engine in the process"""
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path
+        self._accounts = {}
+        self._lock = threading.Lock()
+
+    def account(self, account):
+        """Return the AccountGovernor for an SmtpAccount"""
+        key = account_key(account)
+        with self._lock:
+            if key not in self._accounts:
+                self._accounts[key] = AccountGovernor(key, self.db_path)
+            return self._accounts[key]
+
+    def register(self, campaign, accounts, reclaim=None):
+        """Start governing a campaign's sends through its accounts
+
+        `reclaim(account)` closes one of the campaign's parked connections
+        to the account when another campaign needs its slot.
+        """
+        for account in accounts:
+            self.account(account).register(campaign, account.rate, account.connections,
+                                           reclaim=(lambda account=account: reclaim(account)) if reclaim else None)
+
+    def unregister(self, campaign, accounts):
+        for account in accounts:
+            self.account(account).unregister(campaign)
+
+    def stats(self):
+        """Return GovernorStats for the accounts with running campaigns"""
+        with self._lock:
+            governors = list(self._accounts.values())
+        return [governor.stats() for governor in governors if not governor.idle]
+
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+def get_governor():
+    """Return the process-wide governor (rates shared through MUMAILER_GOVERNOR_DB when set)"""
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = SendGovernor(os.environ.get(DB_ENV) or None)
+        return _governor
+
+
+def shared_governor():
+    """Return the process-wide governor when its rates are shared with other processes, else None
+
+    Single-purpose processes (queue workers, dispatchers) only need it to
+    share rates, and ungoverned engines keep connections open between runs.
+    """
+    return get_governor() if os.environ.get(DB_ENV) else None
@@ -0,0 +1,225 @@
+"""
+One-time HTML optimization for email templates
+
+Many mail clients drop <style> blocks, so simple rules (tag, .class, #id and
+combinations of those) are copied onto each matching element's style
+attribute, including the classes Quill uses for alignment, indents and
+sizes. Rules that cannot be inlined (pseudo-classes, @media, descendant
+selectors) stay in a single minified <style> block. Comments and redundant
+whitespace are then stripped.
+
+Optimization runs on the template, before personalization, and results are
+cached by the template's hash so each campaign pays for it once.
+"""
+
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+
+
+# Quill writes formatting as classes that only exist in its own stylesheet
+QUILL_CSS = """
+.ql-align-center { text-align: center }
+.ql-align-right { text-align: right }
+.ql-align-justify { text-align: justify }
+.ql-direction-rtl { direction: rtl; text-align: inherit }
+.ql-size-small { font-size: 0.75em }
+.ql-size-large { font-size: 1.5em }
+.ql-size-huge { font-size: 2.5em }
+.ql-font-serif { font-family: Georgia, 'Times New Roman', serif }
+.ql-font-monospace { font-family: Monaco, 'Courier New', monospace }
+.ql-indent-1 { padding-left: 3em }
+.ql-indent-2 { padding-left: 6em }
+.ql-indent-3 { padding-left: 9em }
+.ql-indent-4 { padding-left: 12em }
+.ql-indent-5 { padding-left: 15em }
+.ql-indent-6 { padding-left: 18em }
+.ql-indent-7 { padding-left: 21em }
+.ql-indent-8 { padding-left: 24em }
+"""
+
+# Whitespace next to these tags never renders
+BLOCK_TAGS = (
+    'html', 'head', 'body', 'title', 'meta', 'link', 'style', 'div', 'p', 'table', 'thead', 'tbody', 'tfoot',
+    'tr', 'td', 'th', 'ul', 'ol', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'hr', 'blockquote', 'center',
+    'section', 'header', 'footer', 'article', 'nav', 'main', '!doctype'
+)
+
+MAX_CACHED = 64
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+_STYLE_BLOCK = re.compile(r'<style\b[^>]*>(.*?)</style\s*>', re.I | re.S)
+_PRESERVE = re.compile(r'<(pre|textarea|script)\b.*?</\1\s*>', re.I | re.S)
+_COMMENT = re.compile(r'<!--(?!\[if|<!|>).*?-->', re.S)
+_CSS_COMMENT = re.compile(r'/\*.*?\*/', re.S)
+_START_TAG = re.compile(r'<([a-zA-Z][\w-]*)((?:\s+[^\s=/>]+(?:\s*=\s*(?:"[^"]*"|\'[^\']*\'|[^\s>]+))?)*)\s*(/?)>')
+_ATTRIBUTE = re.compile(r'([^\s=/>]+)(?:\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+))?')
+_SIMPLE_SELECTOR = re.compile(r'^(\*|[a-zA-Z][\w-]*)?((?:[.#][\w-]+)*)$')
+_STYLE_ATTRIBUTE = re.compile(r'(\sstyle\s*=\s*)"([^"]*)"', re.I)
+_DECLARATION_SPLIT = re.compile(r';(?![^(]*\))')
+_BLOCK_SPACE = re.compile(r'\s*(</?(?:%s)\b[^>]*>)\s*' % '|'.join(re.escape(t) for t in BLOCK_TAGS), re.I)
+
+
+def _split_rules(css):
+    """Split a stylesheet into (selector, body) rules and at-rule blocks to keep"""
+    rules, kept = [], []
+    pos = 0
+    while pos < len(css):
+        open_brace = css.find('{', pos)
+        if open_brace == -1:
+            break
+        prelude = css[pos:open_brace].strip()
+        # Find the matching brace (at-rules nest)
+        depth, end = 0, open_brace
+        while end < len(css):
+            if css[end] == '{':
+                depth += 1
+            elif css[end] == '}':
+                depth -= 1
+                if depth == 0:
+                    break
+            end += 1
+        body = css[open_brace + 1:end]
+        if prelude.startswith('@'):
+            kept.append(f"{prelude}{{{minify_css(body)}}}")
+        elif prelude:
+            rules.append((prelude, body))
+        pos = end + 1
+    return rules, kept
+
+
+def parse_declarations(text):
+    """Return [(property, value)] from a declaration list"""
+    declarations = []
+    for part in _DECLARATION_SPLIT.split(text or ''):
+        prop, sep, value = part.partition(':')
+        if sep and prop.strip() and value.strip():
+            declarations.append((prop.strip().lower(), ' '.join(value.split())))
+    return declarations
+
+
+def _merge(declaration_lists):
+    merged = OrderedDict()
+    for declarations in declaration_lists:
+        for prop, value in declarations:
+            merged.pop(prop, None)
+            merged[prop] = value
+    return ';'.join(f"{prop}:{value}" for prop, value in merged.items())
+
+
+def minify_css(css):
+    css = _CSS_COMMENT.sub('', css)
+    css = ' '.join(css.split())
+    css = re.sub(r'\s*([{};:,>])\s*', r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+class _Rule:
+    def __init__(self, tag, classes, ids, declarations, order):
+        self.tag = tag
+        self.classes = classes
+        self.ids = ids
+        self.declarations = declarations
+        self.specificity = (len(ids), len(classes), 1 if tag else 0, order)
+
+    def matches(self, tag, classes, element_id):
+        return ((not self.tag or self.tag == tag)
+                and all(c in classes for c in self.classes)
+                and all(i == element_id for i in self.ids))
+
+
+def _compile_rules(css):
+    """Return (inlinable rules, leftover CSS text)"""
+    rules, kept = _split_rules(_CSS_COMMENT.sub('', css))
+    inlinable = []
+    for selector_list, body in rules:
+        declarations = parse_declarations(body)
+        leftover = []
+        for selector in selector_list.split(','):
+            selector = selector.strip()
+            match = _SIMPLE_SELECTOR.match(selector)
+            if not selector or not match or not declarations:
+                leftover.append(selector)
+                continue
+            tag = match.group(1) if match.group(1) not in (None, '*') else None
+            parts = re.findall(r'([.#])([\w-]+)', match.group(2))
+            inlinable.append(_Rule(tag.lower() if tag else None, [name for kind, name in parts if kind == '.'],
+                                   [name for kind, name in parts if kind == '#'], declarations, len(inlinable)))
+        if leftover:
+            kept.append(f"{','.join(leftover)}{{{minify_css(body)}}}")
+    return inlinable, ''.join(kept)
+
+
+def inline_css(html, extra_css=QUILL_CSS):
+    """Move <style> rules onto matching elements' style attributes"""
+    stylesheets = [extra_css] if extra_css else []
+    stylesheets += _STYLE_BLOCK.findall(html)
+    rules, leftover = _compile_rules('\n'.join(stylesheets))
+
+    # One <style> block remains for whatever could not be inlined
+    placed = []
+
+    def replace_style(match):
+        if leftover and not placed:
+            placed.append(True)
+            return f"<style>{leftover}</style>"
+        return ''
+
+    html = _STYLE_BLOCK.sub(replace_style, html)
+    if not rules:
+        return html
+
+    def rewrite(match):
+        tag, attributes, closing = match.group(1), match.group(2) or '', match.group(3)
+        parsed = {name.lower(): (value or '').strip('"\'') for name, value in _ATTRIBUTE.findall(attributes)}
+        classes = parsed.get('class', '').split()
+        matching = [r for r in rules if r.matches(tag.lower(), classes, parsed.get('id'))]
+        if not matching:
+            return match.group(0)
+        matching.sort(key=lambda r: r.specificity)
+        # The element's own style attribute wins over stylesheet rules
+        style = _merge([r.declarations for r in matching] + [parse_declarations(parsed.get('style'))])
+        attributes = re.sub(r'\s+style\s*=\s*("[^"]*"|\'[^\']*\'|[^\s>]+)', '', attributes, flags=re.I)
+        return f'<{tag}{attributes} style="{style.replace(chr(34), chr(39))}"{" /" if closing else ""}>'
+
+    return _START_TAG.sub(rewrite, html)
+
+
+def minify_html(html):
+    """Strip comments and whitespace that does not render"""
+    preserved = []
+
+    def protect(match):
+        preserved.append(match.group(0))
+        return f"\x00{len(preserved) - 1}\x00"
+
+    html = _PRESERVE.sub(protect, html)
+    html = _COMMENT.sub('', html)
+    html = _STYLE_BLOCK.sub(lambda m: f"<style>{minify_css(m.group(1))}</style>", html)
+    html = _STYLE_ATTRIBUTE.sub(lambda m: f'{m.group(1)}"{_merge([parse_declarations(m.group(2))])}"', html)
+    html = re.sub(r'\s+', ' ', html)
+    html = _BLOCK_SPACE.sub(r'\1', html)
+    html = re.sub(r'\x00(\d+)\x00', lambda m: preserved[int(m.group(1))], html)
+    return html.strip()
+
+
+def optimize_html(html):
+    """Inline CSS and minify a template, cached by the template's hash"""
+    if not html:
+        return html
+    key = hashlib.sha256(html.encode('utf-8')).hexdigest()
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    optimized = minify_html(inline_css(html))
+
+    with _cache_lock:
+        _cache[key] = optimized
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+    return optimized
@@ -0,0 +1,83 @@
+"""
+Inline images shared across a campaign
+
+Images pasted into the editor arrive as base64 `data:` URIs inside the HTML,
+so every message would carry (and personalize) a copy of each picture in its
+body. They are lifted out of the template once, re-encoded as MIME parts and
+referenced by `cid:` instead; all messages of the campaign stream the same
+encoded bytes as multipart/related parts.
+"""
+
+import base64
+import binascii
+import hashlib
+import mimetypes
+import re
+import threading
+from collections import OrderedDict
+
+from attachments import InMemoryAttachment
+from html_optimizer import optimize_html
+
+
+MAX_CACHED = 16
+
+_DATA_URI = re.compile(
+    r'''(?P<prefix>\ssrc\s*=\s*)(?P<quote>["'])data:(?P<type>image/[\w.+-]+);base64,(?P<data>[A-Za-z0-9+/=\s]+)(?P=quote)''',
+    re.I
+)
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+class InlineImage(InMemoryAttachment):
+    """A pre-encoded image part referenced from the HTML by Content-ID"""
+
+    def __init__(self, content_id, encoded, size, content_type):
+        extension = mimetypes.guess_extension(content_type) or '.img'
+        super().__init__(f"{content_id.split('@')[0]}{extension}", encoded, size, content_type)
+        self.content_id = content_id
+
+
+def extract_inline_images(html):
+    """Return (html with cid: references, [InlineImage]) for a template
+
+    Identical images are stored once. Results are cached by the template's
+    hash, so a campaign decodes and re-encodes its images a single time.
+    """
+    if not html or 'data:' not in html:
+        return html, []
+    key = hashlib.sha256(html.encode('utf-8')).hexdigest()
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key]
+
+    images = OrderedDict()
+
+    def lift(match):
+        try:
+            data = base64.b64decode(''.join(match.group('data').split()), validate=True)
+        except (binascii.Error, ValueError):
+            # Leave malformed data URIs as they are
+            return match.group(0)
+        content_id = f"img-{hashlib.sha1(data).hexdigest()[:16]}@mumailer"
+        if content_id not in images:
+            encoded = base64.encodebytes(data).replace(b'\n', b'\r\n')
+            images[content_id] = InlineImage(content_id, encoded, len(data), match.group('type').lower())
+        quote = match.group('quote')
+        return f"{match.group('prefix')}{quote}cid:{content_id}{quote}"
+
+    result = (_DATA_URI.sub(lift, html), list(images.values()))
+    with _cache_lock:
+        _cache[key] = result
+        while len(_cache) > MAX_CACHED:
+            _cache.popitem(last=False)
+    return result
+
+
+def prepare_body(html):
+    """Return (send-ready HTML, [InlineImage]): images lifted out, then CSS inlined and minified"""
+    html, images = extract_inline_images(html)
+    return optimize_html(html), images
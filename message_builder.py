@@ -0,0 +1,225 @@
+"""
+MIME message construction shared by the web and desktop front ends
+
+Messages are assembled as a rendered head (headers and HTML body) followed
+by attachment parts that are streamed from the attachment spool, so large
+files are never copied into each message. Inline images go in a
+multipart/related part next to the HTML and are streamed the same way.
+
+The HTML part's transfer encoding is picked from a quick scan of its bytes:
+7bit for ASCII, 8bit when the server advertises 8BITMIME, otherwise
+whichever of quoted-printable and base64 comes out smaller.
+"""
+
+import uuid
+from email import policy
+from email.message import MIMEPart
+from email.mime.base import MIMEBase
+from email.mime.multipart import MIMEMultipart
+from email.utils import formatdate, make_msgid, parseaddr
+
+
+SEVEN_BIT = '7bit'
+EIGHT_BIT = '8bit'
+QUOTED_PRINTABLE = 'quoted-printable'
+BASE64 = 'base64'
+
+# RFC 5322 allows 998 octets per line; folding at 240 characters keeps even
+# 4-byte UTF-8 text under it
+MAX_LINE_OCTETS = 998
+FOLD_CHARS = 240
+
+_ASCII = bytes(range(128))
+
+
+def make_boundary():
+    """Return a unique MIME boundary"""
+    return f"===============mumailer{uuid.uuid4().hex}=="
+
+
+def attachment_headers(attachment):
+    """Return the serialized header block for an attachment part"""
+    maintype, _, subtype = attachment.content_type.partition('/')
+    part = MIMEBase(maintype, subtype or 'octet-stream', policy=policy.SMTP)
+    part['Content-Transfer-Encoding'] = 'base64'
+    content_id = getattr(attachment, 'content_id', None)
+    if content_id:
+        part['Content-ID'] = f"<{content_id}>"
+        part.add_header('Content-Disposition', 'inline', filename=attachment.filename)
+    else:
+        part.add_header('Content-Disposition', 'attachment', filename=attachment.filename)
+    part.set_payload('')
+    return part.as_bytes()
+
+
+def fold_long_lines(text, width=FOLD_CHARS):
+    """Break over-long HTML lines at whitespace (or before a tag); returns None if it can't
+
+    A line break is whitespace to HTML, so this does not change how the
+    message renders. Text with <pre> blocks is left alone.
+    """
+    lines = text.split('\n')
+    if all(len(line) <= width for line in lines):
+        return text
+    lowered = text.lower()
+    if '<pre' in lowered or '<textarea' in lowered:
+        return None
+
+    folded = []
+    for line in lines:
+        while len(line) > width:
+            cut = line.rfind(' ', 1, width)
+            if cut > 0:
+                folded.append(line[:cut])
+                line = line[cut + 1:]
+                continue
+            cut = line.rfind('<', 1, width)
+            if cut <= 0:
+                return None
+            folded.append(line[:cut])
+            line = line[cut:]
+        folded.append(line)
+    return '\n'.join(folded)
+
+
+def estimate_encoded_sizes(data):
+    """Return the approximate (quoted-printable, base64) sizes of `data`"""
+    escaped = len(data.translate(None, _ASCII)) + data.count(b'=')
+    qp = len(data) + 2 * escaped
+    qp += 3 * (qp // 73)
+    b64 = 4 * ((len(data) + 2) // 3)
+    b64 += 2 * (b64 // 76 + 1)
+    return qp, b64
+
+
+def choose_body_encoding(text, eight_bit=False):
+    """Return the smallest safe Content-Transfer-Encoding for an HTML body"""
+    data = text.encode('utf-8')
+    if fold_long_lines(text) is not None and '\r' not in text and '\x00' not in text:
+        if data.isascii():
+            return SEVEN_BIT
+        if eight_bit:
+            return EIGHT_BIT
+    qp, b64 = estimate_encoded_sizes(data)
+    return QUOTED_PRINTABLE if qp <= b64 else BASE64
+
+
+def encoding_fits(encoding, text, eight_bit=False):
+    """Check a campaign-wide encoding choice still holds for one rendered body"""
+    if encoding in (QUOTED_PRINTABLE, BASE64):
+        return True
+    if encoding == EIGHT_BIT and not eight_bit:
+        return False
+    if encoding == SEVEN_BIT and not text.isascii():
+        return False
+    return '\r' not in text and '\x00' not in text and fold_long_lines(text) is not None
+
+
+def html_part(body_html, encoding):
+    """Return the text/html MIME part using the given transfer encoding"""
+    if encoding in (SEVEN_BIT, EIGHT_BIT):
+        body_html = fold_long_lines(body_html)
+    part = MIMEPart(policy=policy.SMTP)
+    part.set_content(body_html, subtype='html', charset='us-ascii' if encoding == SEVEN_BIT else 'utf-8',
+                     cte=encoding)
+    return part
+
+
+class OutgoingMessage:
+    """A MIME message whose attachment bodies are streamed on demand"""
+
+    def __init__(self, head, attachments, boundary, inline_images=None, related_boundary=None, eight_bit=False):
+        self.head = head
+        # True when a part is sent 8bit, so MAIL FROM must declare BODY=8BITMIME
+        self.eight_bit = eight_bit
+        self.attachments = list(attachments)
+        self.boundary = boundary
+        self.inline_images = list(inline_images or [])
+        self.related_boundary = related_boundary
+        self._part_headers = [attachment_headers(a) for a in self.attachments]
+        self._image_headers = [attachment_headers(i) for i in self.inline_images]
+
+    @property
+    def size(self):
+        size = len(self.head) + len(_closing(self.boundary))
+        if self.inline_images:
+            size += len(_closing(self.related_boundary))
+            for headers, image in zip(self._image_headers, self.inline_images):
+                size += len(_delimiter(self.related_boundary)) + len(headers) + image.encoded_size
+        for headers, attachment in zip(self._part_headers, self.attachments):
+            size += len(_delimiter(self.boundary)) + len(headers) + attachment.encoded_size
+        return size
+
+    def iter_chunks(self):
+        """Yield the message in wire format (CRLF line endings)
+
+        Every chunk except base64 attachment data starts at a line boundary.
+        """
+        yield self.head
+        if self.inline_images:
+            # The head stops inside the multipart/related part, right after the HTML
+            for headers, image in zip(self._image_headers, self.inline_images):
+                yield _delimiter(self.related_boundary) + headers
+                yield from image.iter_encoded()
+            yield _closing(self.related_boundary)
+        for headers, attachment in zip(self._part_headers, self.attachments):
+            yield _delimiter(self.boundary) + headers
+            yield from attachment.iter_encoded()
+        yield _closing(self.boundary)
+
+    def as_bytes(self):
+        return b''.join(self.iter_chunks())
+
+
+def _delimiter(boundary):
+    return f"--{boundary}\r\n".encode('ascii')
+
+
+def _closing(boundary):
+    return f"--{boundary}--\r\n".encode('ascii')
+
+
+def sender_domain(sender):
+    """Return the domain of a From address, for the Message-ID"""
+    domain = parseaddr(sender or '')[1].rpartition('@')[2].strip()
+    # make_msgid falls back to a (slow) FQDN lookup without one
+    return domain or 'localhost'
+
+
+def build_message(sender, recipient, subject, body_html, attachments=None, reply_to=None, inline_images=None,
+                  body_encoding=None, eight_bit=False):
+    """Build an OutgoingMessage for one recipient
+
+    `body_encoding` is a campaign-wide choice (see choose_body_encoding); it
+    is used when it still fits this body, otherwise the body is scanned.
+    `eight_bit` says whether the server accepts 8BITMIME.
+    """
+    boundary = make_boundary()
+    msg = MIMEMultipart(boundary=boundary, policy=policy.SMTP)
+    msg['From'] = sender
+    msg['To'] = recipient
+    msg['Subject'] = subject
+    # Spools and local transports hand the message on as it is, with no server to add these
+    msg['Date'] = formatdate(localtime=True)
+    msg['Message-ID'] = make_msgid(domain=sender_domain(sender))
+    if reply_to:
+        msg['Reply-To'] = reply_to
+
+    if not body_encoding or not encoding_fits(body_encoding, body_html, eight_bit):
+        body_encoding = choose_body_encoding(body_html, eight_bit)
+    html = html_part(body_html, body_encoding)
+    related_boundary = None
+    if inline_images:
+        related_boundary = make_boundary()
+        related = MIMEMultipart('related', boundary=related_boundary, policy=policy.SMTP)
+        related.attach(html)
+        msg.attach(related)
+    else:
+        msg.attach(html)
+
+    # Serialize headers and body, then cut at the innermost closing delimiter
+    # so the streamed image and attachment parts can follow
+    data = msg.as_bytes()
+    head = data[:data.rindex(f"--{related_boundary or boundary}--".encode('ascii'))]
+    return OutgoingMessage(head, attachments or [], boundary, inline_images, related_boundary,
+                           eight_bit=body_encoding == EIGHT_BIT)
@@ -0,0 +1,217 @@
+"""
+On-demand profiling of a running campaign
+
+A capture samples the stack of every thread at a fixed interval and takes a
+tracemalloc snapshot at the start and end of its window, then writes its
+reports into a directory next to the campaign's results:
+
+    cpu.collapsed      stacks of threads that were using CPU, one
+                       "frame;frame;frame count" line per stack (input for
+                       flamegraph.pl or speedscope)
+    wall.collapsed     every sample, including threads waiting on sockets,
+                       queues and locks
+    allocations.txt    the source lines that allocated most in the window
+
+A thread counts as using CPU when its CPU time (from /proc on Linux) grew
+since the last sample; where that cannot be read both files hold every
+sample. Sampling is cheap enough to leave on for a whole run; tracemalloc
+slows allocation-heavy code and is only on while a capture runs.
+"""
+
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, namedtuple
+
+
+DEFAULT_DIR = 'profiles'
+DEFAULT_INTERVAL = 0.01
+DEFAULT_SECONDS = 60
+TOP_ALLOCATIONS = 30
+MAX_DEPTH = 64
+
+CPU_FILE = 'cpu.collapsed'
+WALL_FILE = 'wall.collapsed'
+ALLOCATIONS_FILE = 'allocations.txt'
+
+ProfileReport = namedtuple('ProfileReport', ['directory', 'seconds', 'samples', 'cpu_samples', 'files'])
+
+
+def profile_dir(base=DEFAULT_DIR):
+    """Return a new timestamped directory name under `base` for one capture"""
+    return os.path.join(base, time.strftime('profile-%Y%m%d-%H%M%S'))
+
+
+def describe_profile(report):
+    return (f"{report.samples} thread samples ({report.cpu_samples} on CPU) over {report.seconds:.0f}s "
+            f"→ {report.directory}")
+
+
+def _thread_cpu(native_id):
+    """CPU time a thread has used in nanoseconds, or None where it cannot be read"""
+    try:
+        with open(f'/proc/self/task/{native_id}/schedstat') as f:
+            return int(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        with open(f'/proc/self/task/{native_id}/stat') as f:
+            # utime and stime follow the command name, which may itself hold spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) * 10 ** 9 // os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def _thread_label(name):
+    # Numbered threads of one kind (send workers, pool threads) share a label
+    return re.sub(r'[-_ ]?\d+', '', name or 'thread') or 'thread'
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}"
+
+
+def collapse_stack(frame, thread_name=None, max_depth=MAX_DEPTH):
+    """Return a stack as one collapsed line, outermost frame first"""
+    labels = []
+    while frame is not None and len(labels) < max_depth:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    if thread_name:
+        labels.append(_thread_label(thread_name))
+    return ';'.join(reversed(labels))
+
+
+class SamplingProfiler:
+    """Samples every other thread's stack on a background thread"""
+
+    def __init__(self, interval=DEFAULT_INTERVAL):
+        self.interval = interval
+        self.wall = Counter()
+        self.cpu = Counter()
+        self._cpu_seen = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            threads = {thread.ident: thread for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                thread = threads.get(ident)
+                stack = collapse_stack(frame, thread.name if thread else None)
+                self.wall[stack] += 1
+                if self._used_cpu(thread):
+                    self.cpu[stack] += 1
+
+    def _used_cpu(self, thread):
+        native_id = getattr(thread, 'native_id', None)
+        used = _thread_cpu(native_id) if native_id else None
+        if used is None:
+            return True
+        previous = self._cpu_seen.get(native_id)
+        self._cpu_seen[native_id] = used
+        return previous is not None and used > previous
+
+
+def write_collapsed(path, stacks):
+    with open(path, 'w', encoding='utf-8') as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+
+
+def write_allocations(path, before, after, limit=TOP_ALLOCATIONS):
+    """Write the lines whose allocations grew most between two tracemalloc snapshots"""
+    ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+    before, after = before.filter_traces(ignore), after.filter_traces(ignore)
+    diffs = after.compare_to(before, 'lineno')
+    total = sum(stat.size_diff for stat in diffs)
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(f"Net allocated during the capture: {total / 1024:.1f} KiB\n\n")
+        f.write(f"{'size diff':>12}  {'size':>12}  {'blocks':>8}  location\n")
+        for stat in diffs[:limit]:
+            frame = stat.traceback[0]
+            f.write(f"{stat.size_diff / 1024:>10.1f}Ki  {stat.size / 1024:>10.1f}Ki  {stat.count_diff:>+8}  "
+                    f"{frame.filename}:{frame.lineno}\n")
+
+
+class ProfileCapture:
+    """CPU samples and allocation snapshots for one window of a run
+
+    start() begins the window; it ends after `seconds` (None for no limit)
+    or at stop(), whichever comes first, and the reports are written then.
+    Both are safe to call more than once and from any thread.
+    """
+
+    def __init__(self, directory=None, seconds=DEFAULT_SECONDS, interval=DEFAULT_INTERVAL, allocations=True):
+        self.directory = directory or profile_dir()
+        self.seconds = seconds
+        self.allocations = allocations
+        self.profiler = SamplingProfiler(interval)
+        self.report = None
+        self._started = None
+        self._before = None
+        self._own_tracing = False
+        self._timer = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._started is not None and self.report is None
+
+    def start(self):
+        with self._lock:
+            if self._started is not None:
+                return
+            if self.allocations:
+                self._own_tracing = not tracemalloc.is_tracing()
+                if self._own_tracing:
+                    tracemalloc.start()
+                self._before = tracemalloc.take_snapshot()
+            self._started = time.monotonic()
+            self.profiler.start()
+            if self.seconds:
+                self._timer = threading.Timer(self.seconds, self.stop)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def stop(self):
+        """End the window and write the reports; returns the ProfileReport (None if never started)"""
+        with self._lock:
+            if self._started is None or self.report is not None:
+                return self.report
+            if self._timer is not None:
+                self._timer.cancel()
+            self.profiler.stop()
+            seconds = time.monotonic() - self._started
+            os.makedirs(self.directory, exist_ok=True)
+            files = [os.path.join(self.directory, CPU_FILE), os.path.join(self.directory, WALL_FILE)]
+            write_collapsed(files[0], self.profiler.cpu)
+            write_collapsed(files[1], self.profiler.wall)
+            if self._before is not None:
+                after = tracemalloc.take_snapshot()
+                if self._own_tracing:
+                    tracemalloc.stop()
+                files.append(os.path.join(self.directory, ALLOCATIONS_FILE))
+                write_allocations(files[-1], self._before, after)
+                self._before = None
+            self.report = ProfileReport(self.directory, seconds, sum(self.profiler.wall.values()),
+                                        sum(self.profiler.cpu.values()), files)
+            return self.report
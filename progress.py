@@ -0,0 +1,129 @@
+"""
+Progress reporting for bulk sends
+
+Coalesces per-email progress into UI updates at a bounded frequency and
+estimates throughput and ETA from a sliding window of recent sends.
+"""
+
+import time
+from collections import deque, namedtuple
+
+
+ProgressSnapshot = namedtuple(
+    'ProgressSnapshot',
+    ['processed', 'total', 'sent', 'failed', 'skipped', 'rate', 'eta', 'status']
+)
+
+
+def format_duration(seconds):
+    """Format a duration in seconds as H:MM:SS"""
+    if seconds is None:
+        return "--:--"
+    seconds = int(round(seconds))
+    hours, rest = divmod(seconds, 3600)
+    minutes, secs = divmod(rest, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}"
+
+
+def describe_progress(snapshot):
+    """Return a one-line human readable summary of a progress snapshot"""
+    remaining = max(snapshot.total - snapshot.processed, 0)
+    text = f"Sent: {snapshot.sent} | Failed: {snapshot.failed} | Remaining: {remaining}"
+    if snapshot.skipped:
+        text += f" | Skipped: {snapshot.skipped}"
+    if snapshot.rate:
+        text += f" | {snapshot.rate:.1f}/s | ETA {format_duration(snapshot.eta)}"
+    if snapshot.status:
+        text = f"{snapshot.status} — {text}"
+    return text
+
+
+class ProgressReporter:
+    """Throttle progress updates and estimate throughput from a sliding window
+
+    `callback` receives a ProgressSnapshot. Updates are time-based (once per
+    `min_interval` seconds), count-based (every `every` recipients) or both,
+    plus one final update when the campaign finishes.
+    """
+
+    def __init__(self, total, callback, min_interval=0.5, every=None, window_seconds=30.0, clock=time.monotonic):
+        self.total = total
+        self.callback = callback
+        self.min_interval = min_interval
+        self.every = every
+        self.window_seconds = window_seconds
+        self.clock = clock
+
+        self.sent = 0
+        self.failed = 0
+        self.skipped = 0
+        self.status = ""
+
+        start = clock()
+        # (timestamp, processed) samples, thinned to ~50 per window
+        self._samples = deque([(start, 0)])
+        self._resolution = window_seconds / 50.0
+        self._last_emit_time = None
+        self._last_emit_count = 0
+
+    @property
+    def processed(self):
+        return self.sent + self.failed + self.skipped
+
+    def record(self, success=True, skipped=False):
+        """Record the outcome of one recipient and emit an update if due"""
+        if skipped:
+            self.skipped += 1
+        elif success:
+            self.sent += 1
+        else:
+            self.failed += 1
+
+        now = self.clock()
+        if now - self._samples[-1][0] >= self._resolution:
+            self._samples.append((now, self.processed))
+            # Keep one sample older than the window so the span stays full
+            while len(self._samples) > 2 and now - self._samples[1][0] > self.window_seconds:
+                self._samples.popleft()
+
+        if self._due(now):
+            self._emit(now)
+
+    def set_status(self, status):
+        """Set the status line shown with the next update (e.g. current batch)"""
+        self.status = status
+
+    def finish(self, status=None):
+        """Emit a final update regardless of throttling"""
+        if status is not None:
+            self.status = status
+        self._emit(self.clock())
+
+    def snapshot(self, now=None):
+        """Return the current progress with throughput and ETA estimates"""
+        now = self.clock() if now is None else now
+        processed = self.processed
+        oldest_time, oldest_count = self._samples[0]
+        span = now - oldest_time
+        rate = (processed - oldest_count) / span if span > 0 else 0.0
+
+        eta = None
+        if rate > 0:
+            eta = max(self.total - processed, 0) / rate
+
+        return ProgressSnapshot(processed, self.total, self.sent, self.failed,
+                                self.skipped, rate, eta, self.status)
+
+    def _due(self, now):
+        if self._last_emit_time is None:
+            return True
+        if self.every and self.processed - self._last_emit_count >= self.every:
+            return True
+        if self.min_interval is None:
+            return False
+        return now - self._last_emit_time >= self.min_interval
+
+    def _emit(self, now):
+        self._last_emit_time = now
+        self._last_emit_count = self.processed
+        self.callback(self.snapshot(now))
@@ -0,0 +1,273 @@
+"""
+Recipient tables
+
+A CRM export can hold dozens of columns, but a campaign reads only the email
+and name columns, the attachment and timezone columns when set, and the
+columns its subject and body refer to. The header is read first; column data
+is parsed only once a campaign asks for it. Repeated strings (a country, a
+segment) are stored as categoricals and other text as Arrow-backed strings
+when pyarrow is installed, instead of one Python object per cell.
+
+Lists can be CSV, Excel (.xlsx), Parquet or Arrow IPC (.arrow/.feather)
+files; a reader is picked by file extension. Parquet and Arrow files on disk
+are memory-mapped, and Arrow columns become pandas columns without copying
+or parsing, so only the projected columns are ever touched.
+"""
+
+import io
+import os
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from shared_cache import content_key
+from templating import TemplateError, referenced_columns
+
+
+
+# A text column with at most this share of distinct values becomes a categorical
+CATEGORY_RATIO = 0.5
+
+PREVIEW_ROWS = 5
+
+# A table shared between sessions keeps a column this long after anyone last asked for it
+SHARED_KEEP_SECONDS = 600
+
+
+@lru_cache(maxsize=None)
+def _arrow():
+    """Return pyarrow, or None when it is not installed
+
+    Imported on first use: it takes longer to import than pandas, and the
+    app's first page load only needs the list of file types.
+    """
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        return None
+    return pyarrow
+
+
+@lru_cache(maxsize=None)
+def _string_dtype():
+    """Return an Arrow-backed string dtype that keeps NaN for missing values, or None"""
+    if _arrow() is None:
+        return None
+    for make in (lambda: pd.StringDtype('pyarrow', na_value=np.nan), lambda: pd.StringDtype('pyarrow_numpy')):
+        try:
+            return make()
+        except (TypeError, ValueError, ImportError):
+            continue
+    return None
+
+
+def compact_column(series):
+    """Return a text column in the most compact dtype that keeps its values"""
+    if isinstance(series.dtype, pd.CategoricalDtype) or not pd.api.types.is_string_dtype(series.dtype):
+        return series
+    if pd.api.types.infer_dtype(series, skipna=True) not in ('string', 'empty'):
+        # Mixed Python objects are left alone
+        return series
+    if len(series) and series.nunique() <= len(series) * CATEGORY_RATIO:
+        return series.astype('category')
+    string_dtype = _string_dtype()
+    if string_dtype is not None and series.dtype != string_dtype:
+        return series.astype(string_dtype)
+    return series
+
+
+def compact(df):
+    """Convert every text column of a table to a compact dtype"""
+    return df.assign(**{col: compact_column(df[col]) for col in df.columns}) if len(df.columns) else df
+
+
+def campaign_columns(columns, subject='', body='', email_col=None, name_col=None, extra=()):
+    """Return the columns a campaign reads, in file order
+
+    `{Name}` in the subject is the mapped name column, so the subject may
+    refer to 'Name' even when the file has no such column. A template that
+    does not compile keeps every column, so its error shows up unchanged
+    when it is rendered.
+    """
+    columns = tuple(columns)
+    try:
+        used = set(referenced_columns(body or '', columns)) | set(referenced_columns(subject or '', columns))
+    except TemplateError:
+        return list(columns)
+    used.update(col for col in (email_col, name_col) + tuple(extra) if col)
+    return [col for col in columns if col in used]
+
+
+def _open(source):
+    """A fresh file object over bytes, or the path itself"""
+    return io.BytesIO(source) if isinstance(source, bytes) else source
+
+
+class CsvReader:
+    extensions = ('.csv',)
+
+    def columns(self, source):
+        return list(pd.read_csv(_open(source), nrows=0).columns)
+
+    def read(self, source, columns=None, nrows=None):
+        return pd.read_csv(_open(source), usecols=columns, nrows=nrows)
+
+
+class ExcelReader:
+    """First sheet of a workbook"""
+
+    extensions = ('.xlsx',)
+
+    def columns(self, source):
+        return list(pd.read_excel(_open(source), nrows=0).columns)
+
+    def read(self, source, columns=None, nrows=None):
+        return pd.read_excel(_open(source), usecols=columns, nrows=nrows)
+
+
+class _ArrowReader:
+    """Shared by the Arrow-based formats: Arrow tables become pandas columns without a parse"""
+
+    def _input(self, source):
+        pyarrow = _arrow()
+        if pyarrow is None:
+            raise ImportError(f"Reading {'/'.join(self.extensions)} files needs pyarrow (pip install pyarrow)")
+        # Files are memory-mapped; uploaded bytes are wrapped, not copied
+        return pyarrow.BufferReader(source) if isinstance(source, bytes) else pyarrow.memory_map(source)
+
+    def to_pandas(self, table):
+        pyarrow, string_dtype = _arrow(), _string_dtype()
+        mapping = {pyarrow.string(): string_dtype, pyarrow.large_string(): string_dtype} if string_dtype else {}
+        return table.to_pandas(types_mapper=mapping.get)
+
+
+class ParquetReader(_ArrowReader):
+    extensions = ('.parquet', '.pq')
+
+    def columns(self, source):
+        source = self._input(source)
+        return list(_arrow().parquet.read_schema(source).names)
+
+    def read(self, source, columns=None, nrows=None):
+        source = self._input(source)
+        pyarrow = _arrow()
+        handle = pyarrow.parquet.ParquetFile(source)
+        if nrows is not None:
+            # Previews decode one batch, not the whole file
+            batch = next(handle.iter_batches(batch_size=max(nrows, 1), columns=columns), None)
+            table = (pyarrow.Table.from_batches([batch]) if batch is not None
+                     else handle.schema_arrow.empty_table()).slice(0, nrows)
+        else:
+            table = handle.read(columns=columns)
+        return self.to_pandas(table)
+
+
+class ArrowReader(_ArrowReader):
+    """Arrow IPC files (Feather v2) and streams"""
+
+    extensions = ('.arrow', '.feather', '.ipc')
+
+    def _table(self, source):
+        handle = self._input(source)
+        pyarrow = _arrow()
+        try:
+            return pyarrow.ipc.open_file(handle).read_all()
+        except pyarrow.ArrowInvalid:
+            handle.seek(0)
+            return pyarrow.ipc.open_stream(handle).read_all()
+
+    def columns(self, source):
+        return list(self._table(source).schema.names)
+
+    def read(self, source, columns=None, nrows=None):
+        table = self._table(source)
+        if columns is not None:
+            table = table.select(columns)
+        return self.to_pandas(table.slice(0, nrows) if nrows is not None else table)
+
+
+READERS = [CsvReader(), ExcelReader(), ParquetReader(), ArrowReader()]
+
+# Extensions the uploaders accept
+EXTENSIONS = tuple(ext.lstrip('.') for reader in READERS for ext in reader.extensions)
+
+
+def reader_for(name):
+    """Return the reader for a file name (CSV when the extension is unknown)"""
+    extension = os.path.splitext(str(name))[1].lower()
+    for reader in READERS:
+        if extension in reader.extensions:
+            return reader
+    return READERS[0]
+
+
+def read_recipients(path_or_buffer, columns=None, name=None):
+    """Read a recipient list (only `columns`, when given) with compact dtypes"""
+    reader = reader_for(name or getattr(path_or_buffer, 'name', path_or_buffer))
+    return compact(reader.read(path_or_buffer, columns))
+
+
+class RecipientSource:
+    """A recipient file (bytes or a path) whose columns are parsed only when needed
+
+    Loaded columns are kept until a table() call no longer asks for them
+    (or, with `keep_seconds`, until none has for that long), so reruns with
+    the same template do not parse the file again.
+    """
+
+    def __init__(self, data, name=None, keep_seconds=0):
+        self.data = data
+        self.name = name
+        self.keep_seconds = keep_seconds
+        self.reader = reader_for(name or data)
+        self.columns = self.reader.columns(data)
+        self._loaded = {}
+        self._requested = {}
+        self._length = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        if self._length is None:
+            with self._lock:
+                self._load(self.columns[:1])
+        return self._length
+
+    def _load(self, columns):
+        missing = [col for col in columns if col not in self._loaded]
+        if missing:
+            new = compact(self.reader.read(self.data, missing))
+            self._loaded.update((col, new[col]) for col in missing)
+            self._length = len(new)
+
+    def head(self, rows=PREVIEW_ROWS):
+        """Return the first rows with every column, for previews"""
+        return self.reader.read(self.data, nrows=rows)
+
+    def table(self, columns):
+        """Return a table of only `columns` (in file order), parsing the ones not loaded yet"""
+        wanted = [col for col in self.columns if col in set(columns)]
+        with self._lock:
+            self._load(wanted)
+            now = time.monotonic()
+            self._requested.update((col, now) for col in wanted)
+            self._loaded = {col: series for col, series in self._loaded.items()
+                            if now - self._requested.get(col, float('-inf')) <= self.keep_seconds}
+            return pd.DataFrame({col: self._loaded[col] for col in wanted}, columns=wanted)
+
+    def memory_usage(self):
+        """Bytes held by the loaded columns"""
+        with self._lock:
+            return sum(int(series.memory_usage(deep=True)) for series in self._loaded.values())
+
+
+def shared_source(cache, data, name):
+    """Return a Lease on the RecipientSource for uploaded bytes, shared by every session that uploads them"""
+    extension = os.path.splitext(str(name))[1].lower()
+    return cache.lease(content_key('recipients' + extension, data),
+                       lambda: RecipientSource(data, name, keep_seconds=SHARED_KEEP_SECONDS),
+                       sizeof=lambda source: len(source.data) + source.memory_usage())
@@ -0,0 +1,146 @@
+"""
+Parallel render stage
+
+Personalizing a heavy HTML template and building its MIME message is pure
+CPU work. In the send loop it runs on the engine's dispatch thread, where
+the GIL holds it to one core while the SMTP workers wait for jobs. A
+RenderPool renders rows in worker processes instead, from the same campaign
+payload that queue workers and spools use, and hands the finished messages
+to the send engine (or a spool) as SendJobs.
+
+Workers send back only the rendered part of each message (headers and
+HTML); campaign attachments, inline images and per-row files are added on
+this side, still streamed from disk. Chunks of rows are submitted only while
+fewer than `ahead` are outstanding, and the engine pulls jobs only as it
+has room for them, so memory stays flat however long the list is. Jobs come
+out in row order.
+
+Messages are rendered without 8bit bodies, as for a spool, since which
+server will send them is not known yet.
+"""
+
+import itertools
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from inline_images import prepare_body
+from message_builder import OutgoingMessage, build_message, choose_body_encoding
+from send_engine import SendJob, settled_job
+from templating import render_template
+
+
+# Rows per task sent to a worker process
+CHUNK_SIZE = 64
+
+# Lists shorter than this render faster on one core than it takes to start the workers
+MIN_ROWS = 2000
+
+
+def default_processes(rows):
+    """Return how many render processes suit a list of `rows` recipients (1 = render in the send loop)"""
+    return (os.cpu_count() or 1) if rows >= MIN_ROWS else 1
+
+
+class _WorkerCampaign:
+    """What a worker process needs to render the campaign, set up once per process"""
+
+    def __init__(self, payload):
+        self.payload = payload
+        account = payload['accounts'][0]
+        self.sender = account['sender_email']
+        self.reply_to = payload.get('reply_to') or account.get('reply_to')
+        self.body, self.inline_images = prepare_body(payload['body'])
+        self.body_encoding = choose_body_encoding(self.body, eight_bit=False)
+
+    def render(self, email, row):
+        payload = self.payload
+        subject = render_template(payload['subject'], {**row, 'Name': row.get(payload.get('name_col'))})
+        message = build_message(self.sender, email, subject, render_template(self.body, row),
+                                reply_to=self.reply_to, inline_images=self.inline_images,
+                                body_encoding=self.body_encoding)
+        return message.head, message.boundary, message.related_boundary, message.eight_bit
+
+
+_campaign = None
+
+
+def _start_worker(payload):
+    global _campaign
+    _campaign = _WorkerCampaign(payload)
+
+
+def _render_rows(rows):
+    """Render (email, row) pairs in a worker; each result is the message's parts or an error string"""
+    results = []
+    for email, row in rows:
+        try:
+            results.append(_campaign.render(email, row))
+        except Exception as e:
+            results.append(str(e))
+    return results
+
+
+class RenderPool:
+    """Worker processes rendering one campaign's messages ahead of the senders"""
+
+    def __init__(self, payload, processes=None, chunk_size=CHUNK_SIZE, ahead=None):
+        self.payload = payload
+        self.processes = processes or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        # Two chunks per process keeps every worker busy while results are consumed
+        self.ahead = ahead or self.processes * 2
+        # Spawned, not forked: the front ends and engines run threads that a fork would copy mid-flight
+        self.executor = ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_start_worker, initargs=(payload,))
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, chunk):
+        """Settle skipped and failed rows here; send the rest to a worker"""
+        email_col = self.payload['email_col']
+        skip = self.payload.get('skip', {})
+        entries, work = [], []
+        for key, row, prefetched in chunk:
+            email = row.get(email_col)
+            settled = settled_job(key, email, skip.get(str(key)), prefetched)
+            if settled is not None:
+                entries.append(settled)
+            else:
+                entries.append((key, email, prefetched))
+                work.append((email, row))
+        return entries, self.executor.submit(_render_rows, work) if work else None
+
+    def jobs(self, rows, attachments=(), inline_images=()):
+        """Yield a SendJob for each (key, row dict, PrefetchResult or None), in order
+
+        `attachments` and `inline_images` are the campaign's, as loaded
+        from the same payload on this side.
+        """
+        rows = iter(rows)
+        pending = deque()
+        while True:
+            while len(pending) < self.ahead:
+                chunk = list(itertools.islice(rows, self.chunk_size))
+                if not chunk:
+                    break
+                pending.append(self._submit(chunk))
+            if not pending:
+                return
+            entries, future = pending.popleft()
+            rendered = iter(future.result() if future is not None else ())
+            for entry in entries:
+                if isinstance(entry, SendJob):
+                    yield entry
+                    continue
+                key, email, prefetched = entry
+                result = next(rendered)
+                if isinstance(result, str):
+                    yield SendJob(key, email, None, None, error=f"Render error: {result}")
+                    continue
+                head, boundary, related_boundary, eight_bit = result
+                files = list(attachments) + (prefetched.attachments if prefetched is not None else [])
+                yield SendJob(key, email, None, None, message=OutgoingMessage(
+                    head, files, boundary, inline_images, related_boundary, eight_bit=eight_bit))
@@ -0,0 +1,122 @@
+"""
+Retry handling for failed sends
+
+SMTP errors are classified as transient (4xx replies, dropped connections,
+timeouts) or permanent (5xx replies). Transient failures go to a RetryQueue
+that re-submits them after an exponential backoff with jitter, on its own
+thread, so the send workers never sleep on a retry.
+"""
+
+import heapq
+import itertools
+import random
+import smtplib
+import threading
+import time
+
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+
+def classify_smtp_error(exc):
+    """Return TRANSIENT or PERMANENT for an exception raised while sending"""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return TRANSIENT if codes and all(400 <= code < 500 for code in codes) else PERMANENT
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return TRANSIENT if 400 <= exc.smtp_code < 500 else PERMANENT
+    if isinstance(exc, smtplib.SMTPServerDisconnected):
+        return TRANSIENT
+    if isinstance(exc, smtplib.SMTPException):
+        return PERMANENT
+    # Socket errors and timeouts
+    if isinstance(exc, OSError):
+        return TRANSIENT
+    return PERMANENT
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter and a cap on attempts per recipient"""
+
+    def __init__(self, max_attempts=4, base_delay=5.0, max_delay=300.0, jitter=0.5, rng=None):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.rng = rng or random.Random()
+
+    def should_retry(self, exc, attempts):
+        """Return True if a job that failed with `exc` after `attempts` tries should be retried"""
+        return attempts < self.max_attempts and classify_smtp_error(exc) == TRANSIENT
+
+    def delay(self, attempts):
+        """Return the backoff before retry number `attempts`"""
+        delay = min(self.max_delay, self.base_delay * (2 ** max(attempts - 1, 0)))
+        return delay * (1 - self.jitter * self.rng.random())
+
+
+class RetryQueue:
+    """Hold jobs until their backoff expires, then hand them to `resubmit`
+
+    Runs a single timer thread. When `stop_event` is set, pending jobs are
+    handed to `abandon` instead.
+    """
+
+    def __init__(self, resubmit, abandon, stop_event, clock=time.monotonic):
+        self.resubmit = resubmit
+        self.abandon = abandon
+        self.stop_event = stop_event
+        self.clock = clock
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='send-retry', daemon=True)
+        self._thread.start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def schedule(self, job, delay):
+        """Re-submit `job` after `delay` seconds"""
+        with self._cond:
+            heapq.heappush(self._heap, (self.clock() + delay, next(self._seq), job))
+            self._cond.notify()
+
+    def close(self):
+        """Stop the timer thread; pending jobs are abandoned"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            due = []
+            abandoned = []
+            with self._cond:
+                closed = self._closed
+                if closed or self.stop_event.is_set():
+                    abandoned = [job for _, _, job in self._heap]
+                    self._heap.clear()
+                    if not closed and not abandoned:
+                        self._cond.wait(0.5)
+                        continue
+                else:
+                    now = self.clock()
+                    while self._heap and self._heap[0][0] <= now:
+                        due.append(heapq.heappop(self._heap)[2])
+                    if not due:
+                        timeout = self._heap[0][0] - now if self._heap else 0.5
+                        # Wake periodically to notice a stop request
+                        self._cond.wait(min(timeout, 0.5))
+                        continue
+
+            for job in abandoned:
+                self.abandon(job)
+            for job in due:
+                self.resubmit(job)
+            if closed:
+                return
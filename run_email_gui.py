@@ -4,6 +4,7 @@
 A professional email marketing tool with HTML formatting support
 
 To run: python run_email_gui.py
+Add --profile-startup to print how long each startup phase takes.
 """
 
 import sys
@@ -12,6 +13,9 @@ import os
 # Add current directory to path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
+if '--profile-startup' in sys.argv:
+    os.environ['MUMAILER_PROFILE_STARTUP'] = '1'
+
 try:
     from email_gui import main
     print("🚀 Starting μLearn Email Sender GUI...")
@@ -0,0 +1,296 @@
+"""
+Campaign scheduler
+
+Campaigns are queued with a start time and a deadline. Their recipients are
+spread evenly across that window (in each recipient's own timezone when a
+timezone column is given) and released to the campaign's send engine at
+their due time. When several campaigns have sends due at once, higher
+priority campaigns go first, within an optional shared send rate.
+
+Files a campaign's rows attach (the contents of a per-recipient ZIP) are
+taken into the scheduler's own spool when it is queued, since the session
+that uploaded them may be gone by the time the rows come due. They are
+removed once the campaign finishes or is cancelled.
+"""
+
+import atexit
+import heapq
+import itertools
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+from smtp_accounts import RateLimiter
+
+try:
+    from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+except ImportError:
+    ZoneInfo = None
+    ZoneInfoNotFoundError = KeyError
+
+
+TIMEZONE_ENV = 'MUMAILER_TIMEZONE'
+
+_CANCEL = object()
+
+
+def resolve_timezone(name, default=None):
+    """Return a tzinfo for an IANA name like 'Asia/Kolkata', or `default`"""
+    if not name or name != name or ZoneInfo is None:  # empty, NaN or no tz database
+        return default
+    try:
+        return ZoneInfo(str(name).strip())
+    except (ZoneInfoNotFoundError, ValueError):
+        return default
+
+
+def default_timezone_name():
+    """Return the zone schedules default to: MUMAILER_TIMEZONE, else this machine's ('' when it has no IANA name)"""
+    name = os.environ.get(TIMEZONE_ENV) or os.environ.get('TZ', '').lstrip(':')
+    if not name:
+        path = os.path.realpath('/etc/localtime')
+        name = path.split('/zoneinfo/', 1)[1] if '/zoneinfo/' in path else ''
+    return name if resolve_timezone(name) is not None else ''
+
+
+def to_timestamp(moment, tz=None):
+    """Convert a datetime to a POSIX timestamp; naive datetimes are taken as wall time in `tz`"""
+    if moment is None:
+        return None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=tz) if tz is not None else moment.astimezone()
+    return moment.timestamp()
+
+
+def spread_times(count, start, deadline, now):
+    """Return `count` evenly spaced send times within [start, deadline]
+
+    Windows that have already begun start now; windows that have already
+    closed send everything immediately.
+    """
+    start = max(start if start is not None else now, now)
+    if deadline is None or deadline <= start:
+        return [start] * count
+    step = (deadline - start) / count
+    return [start + i * step for i in range(count)]
+
+
+def _link_or_copy(source, target):
+    # Spools normally share a filesystem, where a hard link costs nothing
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+class ScheduledCampaign:
+    """A queued campaign; iterate it to receive jobs as they become due"""
+
+    def __init__(self, name, make_job, priority, total, start, deadline, files_dir=None):
+        self.name = name
+        self.make_job = make_job
+        self.priority = priority
+        self.total = total
+        self.start = start
+        self.deadline = deadline
+        self.released = 0
+        self.cancelled = False
+        self.done = False
+        self.results = []
+        self.files_dir = files_dir
+        self._queue = queue.Queue()
+
+    @property
+    def pending(self):
+        return self.total - self.released
+
+    def count(self, status):
+        return sum(1 for result in self.results if result.status == status)
+
+    def _release(self, key, row):
+        self.released += 1
+        self._queue.put((key, row))
+
+    def _cancel(self):
+        self.cancelled = True
+        self._queue.put(_CANCEL)
+
+    def release_files(self):
+        """Delete the campaign's copy of its per-row files"""
+        if self.files_dir is not None:
+            shutil.rmtree(self.files_dir, ignore_errors=True)
+            self.files_dir = None
+
+    def __iter__(self):
+        """Yield SendJobs as the scheduler releases them (blocks between sends)"""
+        consumed = 0
+        while consumed < self.total:
+            item = self._queue.get()
+            if item is _CANCEL:
+                return
+            consumed += 1
+            yield self.make_job(*item)
+
+
+class CampaignScheduler:
+    """Release queued campaigns' recipients over their send windows by priority"""
+
+    def __init__(self, rate=None, clock=time.time):
+        self.clock = clock
+        self.limiter = RateLimiter(rate)
+        self._pending = []   # (due, seq, campaign, key, row)
+        self._ready = []     # (-priority, due, seq, campaign, key, row)
+        self._campaigns = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = None
+        self._spool_dir = None
+
+    @property
+    def rate(self):
+        return self.limiter.rate
+
+    def set_rate(self, rate):
+        """Change the shared release rate (emails/sec, None for unlimited)"""
+        self.limiter = RateLimiter(rate or None)
+
+    def campaigns(self):
+        """Return queued and running campaigns (finished ones are dropped)"""
+        with self._cond:
+            self._campaigns = [c for c in self._campaigns if not c.done]
+            return list(self._campaigns)
+
+    def take_files(self, directory):
+        """Copy a directory of per-row files into the scheduler's spool and return the copy's path
+
+        Pass the copy to submit() as `files_dir` so it is removed with the campaign.
+        """
+        with self._cond:
+            if self._spool_dir is None:
+                self._spool_dir = tempfile.mkdtemp(prefix='mumailer-scheduled-')
+                atexit.register(shutil.rmtree, self._spool_dir, True)
+        target = tempfile.mkdtemp(prefix='campaign-', dir=self._spool_dir)
+        try:
+            shutil.copytree(directory, target, copy_function=_link_or_copy, dirs_exist_ok=True)
+        except BaseException:
+            shutil.rmtree(target, ignore_errors=True)
+            raise
+        return target
+
+    def submit(self, rows, make_job, start=None, deadline=None, priority=0, name=None,
+               timezone_of=None, default_tz=None, files_dir=None):
+        """Queue a campaign and return its ScheduledCampaign
+
+        `rows` is a list of (key, row) pairs; `make_job(key, row)` builds the
+        SendJob when the row is released. `timezone_of(row)` may return an
+        IANA timezone name so `start`/`deadline` apply in the recipient's
+        local time. `files_dir`, from take_files(), is deleted when the
+        campaign finishes.
+        """
+        rows = list(rows)
+        now = self.clock()
+        campaign = ScheduledCampaign(name or f"Campaign {len(self._campaigns) + 1}", make_job, priority,
+                                     len(rows), start, deadline, files_dir)
+
+        # Spread each timezone group across its own window
+        groups = {}
+        for key, row in rows:
+            tz = resolve_timezone(timezone_of(row), default_tz) if timezone_of else default_tz
+            groups.setdefault(tz, []).append((key, row))
+
+        with self._cond:
+            for tz, group in groups.items():
+                times = spread_times(len(group), to_timestamp(start, tz), to_timestamp(deadline, tz), now)
+                for due, (key, row) in zip(times, group):
+                    heapq.heappush(self._pending, (due, next(self._seq), campaign, key, row))
+            self._campaigns.append(campaign)
+            self._cond.notify()
+
+        if campaign.total == 0:
+            campaign._cancel()
+        self._ensure_running()
+        return campaign
+
+    def cancel(self, campaign):
+        """Stop releasing a campaign; its iterator ends"""
+        with self._cond:
+            campaign._cancel()
+            self._cond.notify()
+
+    def next_due(self, campaign):
+        """Return when the campaign's next recipient is due, as a datetime"""
+        with self._cond:
+            dues = [entry[0] for entry in self._pending if entry[2] is campaign]
+        return datetime.fromtimestamp(min(dues), timezone.utc).astimezone() if dues else None
+
+    def shutdown(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+
+    def _ensure_running(self):
+        with self._cond:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='campaign-scheduler', daemon=True)
+                self._thread.start()
+
+    def _promote_due(self, now):
+        while self._pending and self._pending[0][0] <= now:
+            due, seq, campaign, key, row = heapq.heappop(self._pending)
+            if not campaign.cancelled:
+                heapq.heappush(self._ready, (-campaign.priority, due, seq, campaign, key, row))
+
+    def _run(self):
+        while not self._stop.is_set():
+            with self._cond:
+                self._promote_due(self.clock())
+                while self._ready and self._ready[0][3].cancelled:
+                    heapq.heappop(self._ready)
+                if not self._ready:
+                    timeout = self._pending[0][0] - self.clock() if self._pending else None
+                    self._cond.wait(max(0.0, min(timeout, 1.0)) if timeout is not None else 1.0)
+                    continue
+
+            # Wait for shared capacity first, then release whatever is most urgent
+            if not self.limiter.acquire(self._stop):
+                return
+            with self._cond:
+                self._promote_due(self.clock())
+                while self._ready and self._ready[0][3].cancelled:
+                    heapq.heappop(self._ready)
+                if not self._ready:
+                    continue
+                _, _, _, campaign, key, row = heapq.heappop(self._ready)
+                campaign._release(key, row)
+
+
+def run_in_background(campaign, engine):
+    """Send a scheduled campaign through `engine` on a background thread"""
+    def run():
+        try:
+            for result in engine.run(campaign):
+                campaign.results.append(result)
+        finally:
+            engine.close()
+            campaign.release_files()
+            campaign.done = True
+
+    threading.Thread(target=run, name=f"campaign-{campaign.name}", daemon=True).start()
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Return the process-wide scheduler shared by all sessions"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = CampaignScheduler()
+        return _scheduler
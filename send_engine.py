@@ -0,0 +1,427 @@
+"""
+Concurrent send engine
+
+Jobs are routed to SMTP accounts by weight and sent by a small pool of
+worker threads per account, each keeping its connection open between
+messages. When an account keeps failing, its queued jobs are drained to the
+healthy accounts; transient failures are retried with backoff through a
+RetryQueue. Results are yielded back on the caller's thread so the front
+ends can update their widgets from there. With a governor, sends and
+connections are taken from limits shared with the other running campaigns;
+the engine stays registered, and keeps its open connections and their slots,
+from its first run until close().
+With a profiling.ProfileCapture, the first run starts it and close() writes
+its reports if its window has not already ended.
+"""
+
+import queue
+import smtplib
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from message_builder import build_message
+from retries import RetryPolicy, RetryQueue
+from smtp_accounts import AccountRouter, RateLimiter
+from templating import is_missing
+from transports import open_transport
+
+
+SendResult = namedtuple('SendResult', ['job', 'status', 'message', 'account'])
+
+_STOP = object()
+_DONE = object()
+
+# Most connections opened at once when warming up
+MAX_WARM_THREADS = 16
+
+# How often an idle governed worker checks whether its connection slot is wanted (seconds)
+_IDLE_CHECK = 0.25
+
+
+class SendJob:
+    """One recipient's personalized email"""
+
+    def __init__(self, key, recipient, subject, body_html, attachments=None, reply_to=None, error=None,
+                 skip_reason=None, data=None, inline_images=None, body_encoding=None, message=None):
+        self.key = key
+        self.recipient = recipient
+        self.subject = subject
+        self.body_html = body_html
+        self.attachments = attachments or []
+        # Images shared by the whole campaign, referenced from the HTML by cid:
+        self.inline_images = inline_images or []
+        # Campaign-wide transfer encoding choice for the HTML (checked per message)
+        self.body_encoding = body_encoding
+        self.reply_to = reply_to
+        # Set when the job cannot be sent at all (e.g. a missing attachment)
+        self.error = error
+        # Set when the recipient is deliberately not sent to (e.g. no address)
+        self.skip_reason = skip_reason
+        # Front-end data carried through to the result (e.g. the recipient's name)
+        self.data = data
+        # A message that is already built (e.g. read from a spool); sent as it is
+        self.message = message
+        self.attempts = 0
+        self.reroutes = 0
+        self.last_error = None
+        # Managed by the engine: whether the job counts against the in-flight bound
+        self.holds_slot = False
+
+
+def settled_job(key, recipient, skip_reason=None, prefetched=None, data=None):
+    """Return the SendJob for a row that is not rendered at all, or None if it should be
+
+    A row is settled without rendering when it has no address, is skipped
+    (e.g. suppressed), or its per-row attachments could not be read. Every
+    front end and render path goes through this, so a list gets the same
+    outcomes however it is sent.
+    """
+    if is_missing(recipient):
+        return SendJob(key, recipient, None, None, skip_reason="No email address", data=data)
+    if skip_reason:
+        return SendJob(key, recipient, None, None, skip_reason=skip_reason, data=data)
+    if prefetched is not None and prefetched.error:
+        return SendJob(key, recipient, None, None, error=f"Attachment error: {prefetched.error}", data=data)
+    return None
+
+
+def is_account_error(exc):
+    """Return True if an error points at the account or connection, not the recipient"""
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError,
+                        smtplib.SMTPAuthenticationError, smtplib.SMTPSenderRefused, smtplib.SMTPNotSupportedError)):
+        return True
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code in (421, 454)
+    if isinstance(exc, smtplib.SMTPException):
+        return False
+    return isinstance(exc, OSError)
+
+
+class SendEngine:
+    """Send jobs concurrently across one or more SMTP accounts"""
+
+    def __init__(self, accounts, router=None, max_reroutes=3, in_flight=None, retry_policy=None, governor=None,
+                 profile=None):
+        self.accounts = list(accounts)
+        self.router = router or AccountRouter(self.accounts)
+        self.max_reroutes = max_reroutes
+        self.retry_policy = retry_policy or RetryPolicy()
+        # Bound on jobs dispatched but not finished, so memory stays flat
+        self.in_flight = in_flight or sum(a.connections for a in self.accounts) * 4
+        self.limiters = {a.name: RateLimiter(a.rate) for a in self.accounts}
+        # Shared limits across campaigns (governor.SendGovernor); None paces this engine alone
+        self.governor = governor
+        # On-demand CPU/allocation capture (profiling.ProfileCapture) spanning this engine's runs
+        self.profile = profile
+        self._idle = {a.name: [] for a in self.accounts}
+        self._idle_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._registered = False
+
+    @property
+    def stopped(self):
+        return self._stop.is_set()
+
+    def stop(self):
+        """Stop dispatching; queued jobs are reported as skipped"""
+        self._stop.set()
+
+    def warm(self):
+        """Open and log in every account's connections in parallel, ready for the first sends
+
+        Returns {account name: error} for accounts that could not connect.
+        Those are taken out of rotation, so bad credentials show up before
+        any recipient is tried.
+        """
+        with self._idle_lock:
+            wanted = [account for account in self.accounts
+                      for _ in range(account.connections - len(self._idle[account.name]))]
+        if not wanted:
+            return {}
+        errors = {}
+        with ThreadPoolExecutor(max_workers=min(len(wanted), MAX_WARM_THREADS)) as pool:
+            futures = [(account, pool.submit(open_transport, account.settings)) for account in wanted]
+            for account, future in futures:
+                try:
+                    self._return_connection(account, future.result())
+                except Exception as e:
+                    errors.setdefault(account.name, e)
+        for account in self.accounts:
+            if account.name in errors and is_account_error(errors[account.name]):
+                self.router.disable(account)
+        return errors
+
+    def adopt_connections(self, other):
+        """Take over another engine's idle connections for accounts that log in the same way"""
+        with other._idle_lock:
+            idle, other._idle = other._idle, {a.name: [] for a in other.accounts}
+        for other_account in other.accounts:
+            servers = idle.pop(other_account.name, [])
+            account = next((a for a in self.accounts if a.settings == other_account.settings), None)
+            for server in servers:
+                if account is not None:
+                    self._return_connection(account, server)
+                else:
+                    _quit(server)
+
+    def close(self):
+        """Close connections kept open between runs, give up governed slots (and end a profile capture)"""
+        if self.profile is not None:
+            self.profile.stop()
+        with self._idle_lock:
+            idle, self._idle = self._idle, {a.name: [] for a in self.accounts}
+        for servers in idle.values():
+            for server in servers:
+                _quit(server)
+        if self._registered:
+            self._registered = False
+            self.governor.unregister(self, self.accounts)
+
+    def run(self, jobs):
+        """Send an iterable of SendJobs, yielding a SendResult for each on this thread"""
+        results = queue.Queue()
+        queues = {a.name: queue.Queue() for a in self.accounts}
+        slots = threading.Semaphore(self.in_flight)
+
+        def release(job):
+            if job.holds_slot:
+                job.holds_slot = False
+                slots.release()
+
+        def finish(job, status, message, account):
+            results.put(SendResult(job, status, message, account.name if account else None))
+            release(job)
+
+        def retry_or_fail(job, error, account):
+            if not self._stop.is_set() and self.retry_policy.should_retry(error, job.attempts):
+                # Waiting retries don't count against the in-flight bound
+                release(job)
+                retry_queue.schedule(job, self.retry_policy.delay(job.attempts))
+            else:
+                finish(job, 'failed', str(error), account)
+
+        def route(job, exclude=None):
+            account = self.router.choose(exclude)
+            if account is None:
+                error = job.last_error or smtplib.SMTPServerDisconnected("No healthy SMTP account available")
+                retry_or_fail(job, error, exclude)
+            else:
+                queues[account.name].put(job)
+
+        retry_queue = RetryQueue(route, lambda job: finish(job, 'skipped', "Stopped by user", None), self._stop)
+
+        def dispatch():
+            count = 0
+            error = None
+            try:
+                for job in jobs:
+                    while not self._stop.is_set() and not slots.acquire(timeout=0.2):
+                        pass
+                    if self._stop.is_set():
+                        break
+                    count += 1
+                    job.holds_slot = True
+                    if job.skip_reason:
+                        finish(job, 'skipped', job.skip_reason, None)
+                    elif job.error:
+                        finish(job, 'failed', job.error, None)
+                    else:
+                        route(job)
+            except Exception as e:
+                error = e
+            finally:
+                results.put((_DONE, count, error))
+
+        if self.governor is not None and not self._registered:
+            self._registered = True
+            self.governor.register(self, self.accounts, reclaim=self._drop_idle)
+        if self.profile is not None:
+            self.profile.start()
+
+        workers = []
+        for account in self.accounts:
+            for _ in range(account.connections):
+                worker = _AccountWorker(self, account, queues[account.name], route, finish, retry_or_fail)
+                worker.start()
+                workers.append(worker)
+
+        dispatcher = threading.Thread(target=dispatch, name='send-dispatch', daemon=True)
+        dispatcher.start()
+
+        received = 0
+        total = None
+        dispatch_error = None
+        try:
+            while total is None or received < total:
+                item = results.get()
+                if isinstance(item, tuple) and item and item[0] is _DONE:
+                    _, total, dispatch_error = item
+                    continue
+                received += 1
+                yield item
+        finally:
+            if total is None or received < total:
+                # Caller abandoned the run: let workers skip what is left
+                self.stop()
+            retry_queue.close()
+            for account in self.accounts:
+                for _ in range(account.connections):
+                    queues[account.name].put(_STOP)
+            for worker in workers:
+                worker.join()
+            dispatcher.join(timeout=1.0)
+
+        if dispatch_error is not None:
+            raise dispatch_error
+
+    def _acquire_send(self, account):
+        if self.governor is not None:
+            return self.governor.account(account).acquire_send(self, self._stop)
+        return self.limiters[account.name].acquire(self._stop)
+
+    def _take_connection(self, account):
+        with self._idle_lock:
+            idle = self._idle[account.name]
+            return idle.pop() if idle else None
+
+    def _return_connection(self, account, server):
+        with self._idle_lock:
+            self._idle[account.name].append(server)
+
+    def _drop_idle(self, account):
+        # The governor handed this connection's slot to another campaign
+        server = self._take_connection(account)
+        if server is not None:
+            _quit(server)
+
+
+class _AccountWorker(threading.Thread):
+    """Worker thread sending one account's jobs over a persistent connection"""
+
+    def __init__(self, engine, account, jobs, route, finish, retry_or_fail):
+        super().__init__(name=f"send-{account.name}", daemon=True)
+        self.engine = engine
+        self.account = account
+        self.jobs = jobs
+        self.route = route
+        self.finish = finish
+        self.retry_or_fail = retry_or_fail
+        self.server = None
+        # Governed workers hold a connection slot while they may connect
+        self.governed = engine.governor.account(account) if engine.governor is not None else None
+        self.slot_held = False
+
+    def run(self):
+        engine, account = self.engine, self.account
+        try:
+            while True:
+                job = self.next_job()
+                if job is _STOP:
+                    break
+                if engine.stopped:
+                    self.finish(job, 'skipped', "Stopped by user", account)
+                    continue
+                if not engine.router.is_healthy(account):
+                    # Drain this account's share to the healthy ones
+                    self.route(job, exclude=account)
+                    continue
+                if self.governed is not None and not self.slot_held:
+                    # A slot kept from an earlier run comes with its connection still open
+                    if not (self.governed.unpark_connection(engine)
+                            or self.governed.acquire_connection(engine, engine._stop)):
+                        self.finish(job, 'skipped', "Stopped by user", account)
+                        continue
+                    self.slot_held = True
+                if not engine._acquire_send(account):
+                    self.finish(job, 'skipped', "Stopped by user", account)
+                    continue
+
+                job.attempts += 1
+                try:
+                    self.send(job)
+                except Exception as e:
+                    job.last_error = e
+                    if is_account_error(e):
+                        self.disconnect()
+                        engine.router.report_failure(account)
+                        # Hand straight to another healthy account if there is one
+                        others = [a for a in engine.router.healthy_accounts() if a is not account]
+                        job.reroutes += 1
+                        if others and job.reroutes <= engine.max_reroutes:
+                            self.route(job, exclude=account)
+                            continue
+                    self.retry_or_fail(job, e, account)
+                else:
+                    engine.router.report_success(account)
+                    self.finish(job, 'sent', "Sent successfully", account)
+                    if self.governed is not None and self.governed.should_yield(engine):
+                        # Hand the connection slot to a campaign that has fewer
+                        self.release_slot()
+        finally:
+            if self.governed is None:
+                if self.server is not None:
+                    engine._return_connection(account, self.server)
+            elif self.slot_held and self.server is not None and not engine.stopped:
+                # Keep the connection and its slot for the next run, until close() or another campaign needs it
+                engine._return_connection(account, self.server)
+                self.governed.park_connection(engine)
+            else:
+                self.release_slot()
+
+    def next_job(self):
+        if self.governed is None:
+            return self.jobs.get()
+        while True:
+            try:
+                return self.jobs.get(timeout=_IDLE_CHECK)
+            except queue.Empty:
+                # Don't sit on a connection slot another worker or campaign is waiting for
+                if self.slot_held and self.governed.connection_wanted():
+                    self.release_slot()
+
+    def build(self, job):
+        # Built per connection, since 8bit bodies depend on the server's extensions
+        if job.message is not None:
+            return job.message
+        account = self.account
+        return build_message(account.sender_email, job.recipient, job.subject, job.body_html,
+                             job.attachments, reply_to=job.reply_to or account.reply_to,
+                             inline_images=job.inline_images, body_encoding=job.body_encoding,
+                             eight_bit=self.server.eight_bit)
+
+    def send(self, job):
+        account = self.account
+        if self.server is None:
+            # A connection opened by warm() or left by an earlier run
+            self.server = self.engine._take_connection(account)
+        if self.server is not None:
+            try:
+                self.server.deliver(account.sender_email, job.recipient, self.build(job))
+                return
+            except Exception as e:
+                # A reused connection may have been dropped while idle; reconnect once
+                if not is_account_error(e) or isinstance(e, smtplib.SMTPAuthenticationError):
+                    raise
+                self.disconnect()
+
+        self.server = open_transport(account.settings)
+        self.server.deliver(account.sender_email, job.recipient, self.build(job))
+
+    def disconnect(self):
+        if self.server is not None:
+            _quit(self.server)
+            self.server = None
+
+    def release_slot(self):
+        self.disconnect()
+        if self.slot_held:
+            self.slot_held = False
+            self.governed.release_connection(self.engine)
+
+
+def _quit(server):
+    try:
+        server.quit()
+    except Exception:
+        server.close()
@@ -0,0 +1,149 @@
+"""
+Process-wide cache of uploads shared between sessions
+
+Every browser session of the hosted app runs in the same process. When
+several teammates upload the same recipient list or attachment, one copy is
+kept, found by the SHA-256 of its content. Entries are immutable; each
+session holds a lease on the entries it uses, and an entry with no leases
+stays cached until the memory budget needs the room, oldest first.
+
+    MUMAILER_CACHE_MB=1024 streamlit run app.py    # default 512
+"""
+
+import hashlib
+import os
+import threading
+import weakref
+from collections import OrderedDict, namedtuple
+
+
+BUDGET_ENV = 'MUMAILER_CACHE_MB'
+DEFAULT_BUDGET_MB = 512
+
+CacheStats = namedtuple('CacheStats', ['entries', 'leased', 'bytes', 'budget', 'hits', 'misses', 'evictions'])
+
+
+def content_key(kind, data, chunk_size=1024 * 1024):
+    """Return the cache key of some content (bytes or a seekable file): its kind and SHA-256"""
+    digest = hashlib.sha256()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        digest.update(data)
+    else:
+        data.seek(0)
+        for chunk in iter(lambda: data.read(chunk_size), b''):
+            digest.update(chunk)
+        data.seek(0)
+    return f"{kind}:{digest.hexdigest()}"
+
+
+def describe_cache(stats):
+    return (f"{stats.entries} shared entries ({stats.leased} in use), "
+            f"{stats.bytes / 1e6:.1f} of {stats.budget / 1e6:.0f} MB; "
+            f"{stats.hits} hits, {stats.misses} misses, {stats.evictions} evicted")
+
+
+class _Entry:
+    __slots__ = ('value', 'sizeof', 'refs')
+
+    def __init__(self, value, sizeof):
+        self.value = value
+        self.sizeof = sizeof
+        self.refs = 0
+
+
+class Lease:
+    """One holder's claim on a cache entry; released explicitly or when garbage collected"""
+
+    def __init__(self, cache, key, value):
+        self.key = key
+        self.value = value
+        self._release = weakref.finalize(self, cache._release, key)
+
+    def release(self):
+        self._release()
+
+    @property
+    def released(self):
+        return not self._release.alive
+
+
+class SharedCache:
+    """Immutable values shared by content key, reference counted, evicted LRU under a byte budget
+
+    Leased entries are never evicted, so the budget can be exceeded while
+    they are in use. Sizes are measured again on each trim, because a value
+    such as a recipient table may load more columns after it is cached.
+    """
+
+    def __init__(self, budget_bytes):
+        self.budget = budget_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = self.misses = self.evictions = 0
+
+    def lease(self, key, build, sizeof=len):
+        """Return a Lease on the value for `key`, calling build() only if it is not cached
+
+        `sizeof(value)` gives its size in bytes. An evicted value is only
+        dropped by the cache; whatever still uses it keeps it alive.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            else:
+                self.misses += 1
+                # Built under the lock, so two sessions uploading the same file build it once
+                entry = self._entries[key] = _Entry(build(), sizeof)
+            entry.refs += 1
+            lease = Lease(self, key, entry.value)
+        self.trim()
+        return lease
+
+    def _release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.refs > 0:
+                entry.refs -= 1
+        self.trim()
+
+    def _size(self, entry):
+        try:
+            return int(entry.sizeof(entry.value))
+        except Exception:
+            return 0
+
+    def trim(self):
+        """Evict the least recently leased unused entries until the cache fits its budget"""
+        with self._lock:
+            total = sum(self._size(entry) for entry in self._entries.values())
+            for key in list(self._entries):
+                if total <= self.budget:
+                    break
+                entry = self._entries[key]
+                if entry.refs:
+                    continue
+                total -= self._size(entry)
+                del self._entries[key]
+                self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            return CacheStats(len(self._entries), sum(1 for e in self._entries.values() if e.refs),
+                              sum(self._size(e) for e in self._entries.values()), self.budget,
+                              self.hits, self.misses, self.evictions)
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Return the process-wide cache, sized from MUMAILER_CACHE_MB"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            budget_mb = float(os.environ.get(BUDGET_ENV) or DEFAULT_BUDGET_MB)
+            _cache = SharedCache(int(budget_mb * 1024 * 1024))
+        return _cache
@@ -0,0 +1,192 @@
+"""
+SMTP accounts, per-account rate limits and weighted routing
+
+Several accounts or relays can share one campaign. Each has its own rate
+limit, connection count and routing weight; accounts that keep failing are
+taken out of rotation for a cool-down period so their share goes to the
+healthy ones.
+"""
+
+import threading
+import time
+
+
+# Servers given as scheme://path deliver locally instead of over SMTP (see transports.open_transport)
+LOCAL_SCHEMES = ('sendmail', 'pickup', 'maildir', 'mbox')
+
+# Fields stored in config.json (passwords are never saved)
+ACCOUNT_FIELDS = ['name', 'server', 'port', 'username', 'sender_email', 'reply_to', 'rate', 'weight', 'connections']
+
+
+class SmtpAccount:
+    """One SMTP login with its own limits"""
+
+    def __init__(self, name, server, port, username, password, sender_email, reply_to=None,
+                 rate=None, weight=1, connections=1):
+        self.name = name
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.sender_email = sender_email
+        self.reply_to = reply_to
+        # Emails per second (None or 0 means unlimited)
+        self.rate = float(rate) if rate else None
+        self.weight = max(1, int(weight or 1))
+        self.connections = max(1, int(connections or 1))
+
+    @property
+    def settings(self):
+        """Return the settings dict used by transports.open_smtp"""
+        return {
+            'server': self.server, 'port': self.port,
+            'username': self.username, 'password': self.password,
+            'sender_email': self.sender_email, 'reply_to': self.reply_to
+        }
+
+    def to_config(self):
+        """Return a JSON-safe dict without the password"""
+        return {field: getattr(self, field) for field in ACCOUNT_FIELDS}
+
+    def __repr__(self):
+        return f"SmtpAccount({self.name!r}, {self.server!r})"
+
+
+def transport_scheme(server):
+    """Split a server into (scheme, rest): ('smtp', host) unless it is written scheme://rest"""
+    scheme, sep, rest = str(server or '').partition('://')
+    return (scheme.lower(), rest) if sep else ('smtp', str(server or ''))
+
+
+def is_local(server):
+    """True when a server delivers to a local MTA or file instead of logging in to SMTP"""
+    return transport_scheme(server)[0] in LOCAL_SCHEMES
+
+
+def account_from_settings(settings, name='Primary', rate=None, weight=1, connections=1):
+    """Build an account from a front end's single-account settings dict"""
+    return SmtpAccount(name, settings['server'], settings['port'], settings['username'], settings['password'],
+                       settings['sender_email'], settings.get('reply_to'), rate, weight, connections)
+
+
+def accounts_from_config(entries, passwords=None):
+    """Build accounts from config.json entries, taking passwords from `passwords` by name"""
+    passwords = passwords or {}
+    accounts = []
+    for i, entry in enumerate(entries or []):
+        name = entry.get('name') or f"Account {i + 1}"
+        accounts.append(SmtpAccount(
+            name, entry.get('server', ''), entry.get('port', '587'), entry.get('username', ''),
+            passwords.get(name, entry.get('password', '')), entry.get('sender_email', ''),
+            entry.get('reply_to'), entry.get('rate'), entry.get('weight', 1), entry.get('connections', 1)
+        ))
+    return accounts
+
+
+class RateLimiter:
+    """Thread-safe token bucket allowing `rate` operations per second"""
+
+    def __init__(self, rate, burst=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate or 1.0)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        """Change the rate in place, keeping the tokens already earned (up to the new capacity)"""
+        with self._lock:
+            capacity = burst or max(1.0, rate or 1.0)
+            if not self.rate:
+                # Nothing accrues while unlimited, so a newly limited bucket starts full
+                self.tokens, self._updated = capacity, self.clock()
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+
+    def try_acquire(self):
+        """Take a token if one is available; returns 0 if taken, otherwise the seconds until one is"""
+        if not self.rate:
+            return 0.0
+        with self._lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, stop_event=None):
+        """Block until a token is available; returns False if stopped while waiting"""
+        while True:
+            wait = self.try_acquire()
+            if not wait:
+                return True
+            if stop_event is not None:
+                if stop_event.wait(wait):
+                    return False
+            else:
+                self.sleep(wait)
+
+
+class AccountRouter:
+    """Smooth weighted round-robin over healthy accounts
+
+    After `failure_threshold` consecutive account-level failures an account
+    is skipped for `cooldown` seconds, then tried again.
+    """
+
+    def __init__(self, accounts, failure_threshold=3, cooldown=60.0, clock=time.monotonic):
+        self.accounts = list(accounts)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self._current = {a.name: 0 for a in self.accounts}
+        self._failures = {a.name: 0 for a in self.accounts}
+        self._disabled_until = {a.name: 0.0 for a in self.accounts}
+        self._lock = threading.Lock()
+
+    def is_healthy(self, account):
+        return self.clock() >= self._disabled_until[account.name]
+
+    def healthy_accounts(self):
+        return [a for a in self.accounts if self.is_healthy(a)]
+
+    def choose(self, exclude=None):
+        """Return the next account by weight, or None if none are healthy"""
+        with self._lock:
+            healthy = self.healthy_accounts()
+            candidates = [a for a in healthy if a is not exclude] or healthy
+            if not candidates:
+                return None
+            total = sum(a.weight for a in candidates)
+            best = None
+            for account in candidates:
+                self._current[account.name] += account.weight
+                if best is None or self._current[account.name] > self._current[best.name]:
+                    best = account
+            self._current[best.name] -= total
+            return best
+
+    def disable(self, account):
+        """Take an account out of rotation for the cool-down period"""
+        with self._lock:
+            self._disabled_until[account.name] = self.clock() + self.cooldown
+            self._failures[account.name] = 0
+
+    def report_success(self, account):
+        with self._lock:
+            self._failures[account.name] = 0
+
+    def report_failure(self, account):
+        """Record an account-level failure; returns True if the account was just disabled"""
+        with self._lock:
+            self._failures[account.name] += 1
+            if self._failures[account.name] >= self.failure_threshold and self.is_healthy(account):
+                self._disabled_until[account.name] = self.clock() + self.cooldown
+                self._failures[account.name] = 0
+                return True
+            return False
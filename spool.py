@@ -0,0 +1,417 @@
+"""
+Render-to-spool campaigns
+
+Instead of rendering and sending in one loop, a campaign can be rendered
+flat out into a spool directory of ready-to-send RFC 5322 messages, with no
+network involved, and delivered later by one or more dispatcher processes.
+A slow relay then never holds up rendering, and a render error never holds
+up delivery. Rendering on its own doubles as a dry run and a throughput test.
+
+Two layouts are supported: a Maildir (messages in `new/`, readable by any
+mail client) or plain `.eml` files in the spool directory. Either way
+messages are stored with LF line endings, as transports.MaildirConnection
+writes them, and each is written to `tmp/` first and renamed into place.
+Who a message goes to is kept beside it in `envelopes/`, so the message
+files hold nothing but the message. Dispatchers claim a message by renaming
+it into `sending/`, so several dispatchers can drain one spool. Delivered
+messages move to `sent/`, rejected ones to `failed/`, and every outcome is
+appended to `results.jsonl`.
+
+The campaign's attachments and per-row files are copied into `files/` when
+the campaign is saved, so `spool.py render` can run long after the app
+session that created the spool is gone.
+
+    python spool.py dispatch outbox/          # send everything in the spool
+    python spool.py render outbox/ more.csv   # render more rows with outbox/campaign.json
+    python spool.py status outbox/
+
+Messages are rendered without 8bit bodies, since the relay is not known yet.
+The From header comes from the campaign's first account; dispatchers send
+with whichever account the router picks.
+"""
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import socket
+import sys
+import threading
+import time
+from collections import namedtuple
+
+from message_builder import build_message
+from transports import unix_lines
+
+
+MAILDIR = 'maildir'
+EML = 'eml'
+
+CAMPAIGN_FILE = 'campaign.json'
+RESULTS_FILE = 'results.jsonl'
+ENVELOPE_DIR = 'envelopes'
+FILES_DIR = 'files'
+
+# Claimed messages untouched for this long belong to a dispatcher that died
+DEFAULT_STALE_SECONDS = 900.0
+
+_READ_SIZE = 64 * 1024
+
+
+SpoolStatus = namedtuple('SpoolStatus', ['ready', 'sending', 'sent', 'failed'])
+
+RenderStats = namedtuple('RenderStats', ['rendered', 'skipped', 'failed', 'bytes', 'seconds'])
+
+
+def describe_render(stats):
+    """Return a one-line summary of a render run"""
+    rate = stats.rendered / stats.seconds if stats.seconds else 0.0
+    return (f"Rendered: {stats.rendered} | Skipped: {stats.skipped} | Failed: {stats.failed} | "
+            f"{stats.bytes / 1048576:.1f} MB in {stats.seconds:.1f}s ({rate:.0f} msg/s)")
+
+
+class SpooledMessage:
+    """A message read back from the spool, streamed from disk when sent"""
+
+    def __init__(self, path, name, key, recipient, size):
+        self.path = path
+        self.name = name
+        self.key = key
+        self.recipient = recipient
+        self.size = size
+        self.eight_bit = False
+
+    def iter_chunks(self):
+        """Yield the message in wire format (CRLF line endings), each chunk starting at a line boundary"""
+        with open(self.path, 'rb') as f:
+            pending = b''
+            while True:
+                block = f.read(_READ_SIZE)
+                if not block:
+                    break
+                data = pending + block
+                cut = data.rfind(b'\n') + 1
+                if cut:
+                    yield data[:cut].replace(b'\n', b'\r\n')
+                pending = data[cut:]
+            if pending:
+                yield pending
+
+    def as_bytes(self):
+        return b''.join(self.iter_chunks())
+
+
+class Spool:
+    """A directory of rendered messages waiting for a dispatcher"""
+
+    def __init__(self, path, layout=None):
+        self.path = path
+        if layout is None:
+            # An existing spool keeps its layout
+            layout = EML if os.path.isdir(path) and not os.path.isdir(os.path.join(path, 'new')) else MAILDIR
+        self.layout = layout
+        self.ready_dir = os.path.join(path, 'new') if layout == MAILDIR else path
+        for name in ('tmp', 'sending', 'sent', 'failed', ENVELOPE_DIR) + (('new', 'cur') if layout == MAILDIR else ()):
+            os.makedirs(os.path.join(path, name), exist_ok=True)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._listing = []
+
+    def _unique_name(self):
+        with self._lock:
+            self._seq += 1
+            seq = self._seq
+        # Maildir-style names: sortable by time, unique across processes and hosts
+        name = f"{time.time_ns() // 1000}.P{os.getpid()}Q{seq}.{socket.gethostname().replace('/', '_')}"
+        return name + '.eml' if self.layout == EML else name
+
+    def _is_message(self, name):
+        return not name.startswith('.') and (self.layout == MAILDIR or name.endswith('.eml'))
+
+    def _copy_files(self, payload):
+        """Copy a campaign's attachments into files/; the returned payload refers to them relative to the spool"""
+        attachments = payload.get('attachments') or []
+        attachment_dir = payload.get('attachment_dir')
+        folder = os.path.join(self.path, FILES_DIR)
+        # Copied beside the old files, which are replaced only once the copy is complete
+        partial = folder + '.partial'
+        shutil.rmtree(partial, ignore_errors=True)
+        if not attachments and not attachment_dir:
+            shutil.rmtree(folder, ignore_errors=True)
+            return payload
+        os.makedirs(partial)
+        try:
+            copied = []
+            for i, attachment in enumerate(attachments):
+                path = os.path.join(FILES_DIR, f"{i}-{os.path.basename(attachment['path'])}")
+                shutil.copyfile(attachment['path'], os.path.join(partial, os.path.basename(path)))
+                copied.append({**attachment, 'path': path,
+                               'filename': attachment.get('filename') or os.path.basename(attachment['path'])})
+            if attachment_dir:
+                shutil.copytree(attachment_dir, os.path.join(partial, 'rows'))
+        except BaseException:
+            shutil.rmtree(partial, ignore_errors=True)
+            raise
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(partial, folder)
+        return {**payload, 'files': FILES_DIR, 'attachments': copied,
+                'attachment_dir': os.path.join(FILES_DIR, 'rows') if attachment_dir else None}
+
+    def write_campaign(self, payload):
+        """Save how the campaign renders and sends (never passwords) next to its messages, with copies of its files"""
+        with open(os.path.join(self.path, CAMPAIGN_FILE), 'w') as f:
+            json.dump(self._copy_files(payload), f, indent=2)
+
+    def campaign(self):
+        """Return the saved campaign, with its copied files' paths as seen from this host"""
+        with open(os.path.join(self.path, CAMPAIGN_FILE)) as f:
+            payload = json.load(f)
+        if payload.get('files'):
+            payload['attachments'] = [{**a, 'path': os.path.join(self.path, a['path'])}
+                                      for a in payload.get('attachments', [])]
+            if payload.get('attachment_dir'):
+                payload['attachment_dir'] = os.path.join(self.path, payload['attachment_dir'])
+        return payload
+
+    def _envelope_path(self, name):
+        return os.path.join(self.path, ENVELOPE_DIR, name + '.json')
+
+    def add(self, key, recipient, message):
+        """Write one OutgoingMessage into the spool; returns its size in bytes as sent"""
+        name = self._unique_name()
+        tmp_path = os.path.join(self.path, 'tmp', name)
+        size = 0
+
+        def counted(chunks):
+            nonlocal size
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+
+        with open(tmp_path, 'wb') as f:
+            for chunk in unix_lines(counted(message.iter_chunks())):
+                f.write(chunk)
+        envelope_tmp = tmp_path + '.json'
+        with open(envelope_tmp, 'w') as f:
+            json.dump({'key': key, 'recipient': recipient, 'size': size}, f)
+        os.replace(envelope_tmp, self._envelope_path(name))
+        # The rename makes the message visible to dispatchers only once it and its envelope are complete
+        os.replace(tmp_path, os.path.join(self.ready_dir, name))
+        return size
+
+    def record(self, key, recipient, status, message=None, account=None):
+        """Append one recipient's outcome to the results log"""
+        line = json.dumps({'key': key, 'recipient': recipient, 'status': status, 'message': message,
+                           'account': account, 'time': time.time()})
+        with self._lock, open(os.path.join(self.path, RESULTS_FILE), 'a') as f:
+            f.write(line + '\n')
+
+    def claim(self):
+        """Take the next ready message for sending, or return None when the spool is empty"""
+        while True:
+            with self._lock:
+                if not self._listing:
+                    # One directory listing serves many claims
+                    self._listing = sorted((n for n in os.listdir(self.ready_dir) if self._is_message(n)),
+                                           reverse=True)
+                    if not self._listing:
+                        return None
+                name = self._listing.pop()
+            path = os.path.join(self.path, 'sending', name)
+            try:
+                os.rename(os.path.join(self.ready_dir, name), path)
+            except FileNotFoundError:
+                # Another dispatcher claimed it first
+                continue
+            os.utime(path)
+            try:
+                with open(self._envelope_path(name)) as f:
+                    envelope = json.load(f)
+            except (OSError, ValueError):
+                # Not written by add(), so there is no one to send it to
+                os.replace(path, os.path.join(self.path, 'failed', name))
+                continue
+            return SpooledMessage(path, name, envelope['key'], envelope['recipient'], envelope['size'])
+
+    def finish(self, message, status, error=None, account=None):
+        """Move a claimed message to sent/ or failed/, or back to the queue if it was not attempted"""
+        if status == 'skipped':
+            os.replace(message.path, os.path.join(self.ready_dir, message.name))
+            return
+        os.replace(message.path, os.path.join(self.path, 'sent' if status == 'sent' else 'failed', message.name))
+        self.record(message.key, message.recipient, status, error, account)
+        # The results log now holds who it went to
+        try:
+            os.remove(self._envelope_path(message.name))
+        except FileNotFoundError:
+            pass
+
+    def recover(self, stale_seconds=DEFAULT_STALE_SECONDS):
+        """Return messages claimed by dispatchers that stopped long ago to the queue"""
+        sending = os.path.join(self.path, 'sending')
+        cutoff = time.time() - stale_seconds
+        recovered = 0
+        for name in os.listdir(sending):
+            path = os.path.join(sending, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.rename(path, os.path.join(self.ready_dir, name))
+                    recovered += 1
+            except FileNotFoundError:
+                continue
+        return recovered
+
+    def status(self):
+        def count(directory, check=False):
+            return sum(1 for n in os.listdir(directory) if not check or self._is_message(n))
+        return SpoolStatus(count(self.ready_dir, check=True), count(os.path.join(self.path, 'sending')),
+                           count(os.path.join(self.path, 'sent')), count(os.path.join(self.path, 'failed')))
+
+
+def render_to_spool(spool, jobs, sender, reply_to=None, on_result=None):
+    """Render SendJobs into the spool as fast as the CPU allows; returns RenderStats
+
+    Jobs that cannot be sent (no address, attachment errors) are recorded in
+    the results log instead of being spooled. `on_result(job, status)` is
+    called with 'rendered', 'skipped' or 'failed' for each job.
+    """
+    started = time.perf_counter()
+    rendered = skipped = failed = total_bytes = 0
+    for job in jobs:
+        if job.skip_reason:
+            spool.record(job.key, job.recipient, 'skipped', job.skip_reason)
+            skipped += 1
+            status = 'skipped'
+        elif job.error:
+            spool.record(job.key, job.recipient, 'failed', job.error)
+            failed += 1
+            status = 'failed'
+        else:
+            # Jobs from a render_pool.RenderPool arrive already built
+            message = job.message or build_message(
+                sender, job.recipient, job.subject, job.body_html, job.attachments,
+                reply_to=job.reply_to or reply_to, inline_images=job.inline_images, body_encoding=job.body_encoding)
+            total_bytes += spool.add(job.key, job.recipient, message)
+            rendered += 1
+            status = 'rendered'
+        if on_result is not None:
+            on_result(job, status)
+    return RenderStats(rendered, skipped, failed, total_bytes, time.perf_counter() - started)
+
+
+def render_campaign(spool, rows, passwords=None, processes=1):
+    """Render (key, row dict) pairs with the spool's saved campaign; returns RenderStats
+
+    With more than one process, rows are rendered on a render_pool.RenderPool.
+    """
+    from work_queue import CampaignContext, render_job
+
+    payload = spool.campaign()
+    context = CampaignContext(payload, passwords or {})
+    pool = None
+    try:
+        if processes > 1:
+            from render_pool import RenderPool
+            pool = RenderPool(payload, processes)
+            jobs = pool.jobs(context.prefetcher.iterate(rows), context.attachments, context.inline_images)
+        else:
+            jobs = (render_job(key, row, context) for key, row in rows)
+        return render_to_spool(spool, jobs, payload['accounts'][0]['sender_email'], payload.get('reply_to'))
+    finally:
+        if pool is not None:
+            pool.close()
+        context.close()
+
+
+def dispatch(spool, accounts, max_attempts=4, stop_event=None, log=print, profile_seconds=None):
+    """Send everything in the spool through a SendEngine; returns {status: count}
+
+    With `profile_seconds`, the first seconds of sending are profiled into
+    a profile-* directory in the spool.
+    """
+    from retries import RetryPolicy
+    from governor import shared_governor
+    from send_engine import SendEngine, SendJob
+
+    stop_event = stop_event or threading.Event()
+    profile = None
+    if profile_seconds:
+        from profiling import ProfileCapture, profile_dir
+        profile = ProfileCapture(profile_dir(spool.path), seconds=profile_seconds)
+    engine = SendEngine(accounts, retry_policy=RetryPolicy(max_attempts=max_attempts), governor=shared_governor(),
+                        profile=profile)
+
+    def make_jobs():
+        # Messages are claimed only as the engine has room for them
+        while not stop_event.is_set():
+            message = spool.claim()
+            if message is None:
+                return
+            yield SendJob(message.key, message.recipient, None, None, message=message)
+
+    counts = {'sent': 0, 'failed': 0, 'skipped': 0}
+    watcher = threading.Thread(target=lambda: stop_event.wait() or engine.stop(), name='spool-stop', daemon=True)
+    watcher.start()
+    try:
+        for result in engine.run(make_jobs()):
+            spool.finish(result.job.message, result.status, result.message, result.account)
+            counts[result.status] += 1
+            if result.status == 'failed':
+                log(f"❌ {result.job.recipient}: {result.message}")
+    finally:
+        engine.close()
+        stop_event.set()
+    if profile is not None and profile.report is not None:
+        from profiling import describe_profile
+        log(f"🔬 Profile: {describe_profile(profile.report)}")
+    return counts
+
+
+def main(argv=None):
+    from smtp_accounts import accounts_from_config
+    from work_queue import PASSWORDS_ENV, load_passwords
+
+    parser = argparse.ArgumentParser(description="Render campaigns into a spool and dispatch them")
+    commands = parser.add_subparsers(dest='command', required=True)
+    send = commands.add_parser('dispatch', help="Send the spooled messages over SMTP")
+    send.add_argument('spool', help="Spool directory")
+    send.add_argument('--stale', type=float, default=DEFAULT_STALE_SECONDS,
+                      help="Requeue messages claimed longer ago than this many seconds")
+    send.add_argument('--no-prompt', action='store_true', help=f"Take passwords only from ${PASSWORDS_ENV}")
+    send.add_argument('--profile', type=float, metavar='SECONDS',
+                      help="Profile CPU and allocations for the first SECONDS of sending (reports go in the spool)")
+    render = commands.add_parser('render', help="Render a CSV with the spool's campaign (no network)")
+    render.add_argument('spool', help="Spool directory holding campaign.json")
+    render.add_argument('csv', help="Recipients CSV")
+    render.add_argument('--processes', type=int, default=1,
+                        help="Render on this many worker processes (default 1: render in this one)")
+    status = commands.add_parser('status', help="Count ready, sending, sent and failed messages")
+    status.add_argument('spool', help="Spool directory")
+    args = parser.parse_args(argv)
+
+    spool = Spool(args.spool)
+    if args.command == 'status':
+        print(spool.status())
+    elif args.command == 'render':
+        with open(args.csv, newline='', encoding='utf-8-sig') as f:
+            rows = [(i, {k: (v if v != '' else None) for k, v in row.items()}) for i, row in enumerate(csv.DictReader(f))]
+        print(describe_render(render_campaign(spool, rows, processes=args.processes)))
+    else:
+        payload = spool.campaign()
+        names = [a['name'] for a in payload['accounts']]
+        passwords = load_passwords(names, prompt=not args.no_prompt and sys.stdin.isatty())
+        recovered = spool.recover(args.stale)
+        if recovered:
+            print(f"♻️ Requeued {recovered} messages left by a stopped dispatcher")
+        stop_event = threading.Event()
+        try:
+            counts = dispatch(spool, accounts_from_config(payload['accounts'], passwords),
+                              payload.get('max_attempts', 4), stop_event, profile_seconds=args.profile)
+            print(f"🏁 Sent: {counts['sent']} | Failed: {counts['failed']} | Requeued: {counts['skipped']}")
+        except KeyboardInterrupt:
+            stop_event.set()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""
+Suppression list
+
+Unsubscribes and hard bounces are kept in a SQLite file, one row per
+address, and checked before a campaign does any SMTP work. For fast checks
+against millions of entries, the addresses are also kept as a sorted array
+of 64-bit hashes (8 bytes each). The array is saved next to the database and
+rebuilt only after the list changes. A whole recipient column is hashed and
+looked up in one vectorized pass. The few hash hits are then confirmed
+against the exact addresses, so a hash collision never suppresses anyone.
+"""
+
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_PATH = 'suppressions.db'
+
+UNSUBSCRIBE = 'unsubscribe'
+HARD_BOUNCE = 'hard bounce'
+MANUAL = 'manual'
+REASONS = (UNSUBSCRIBE, HARD_BOUNCE, MANUAL)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS suppressions (
+    address TEXT PRIMARY KEY,
+    reason TEXT,
+    source TEXT,
+    added REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Confirm hash hits against the table this many addresses at a time
+_CONFIRM_BATCH = 500
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def normalize(addresses):
+    """Return a Series of trimmed, lower-cased addresses (None where there is none)"""
+    series = pd.Series(addresses, dtype=object)
+    normalized = series.astype(str).str.strip().str.lower()
+    return normalized.where(series.notna() & (normalized != ''), None)
+
+
+def hash_addresses(normalized):
+    """Hash normalized addresses to uint64 in one vectorized pass"""
+    return pd.util.hash_array(normalized.fillna('').to_numpy(dtype=object), categorize=False)
+
+
+def find_email_column(df):
+    """Return the column holding addresses in an uploaded list"""
+    for col in df.columns:
+        if str(col).strip().lower() in ('email', 'e-mail', 'email address', 'address'):
+            return col
+    # Otherwise the first column that mostly holds addresses
+    for col in df.columns:
+        values = df[col].dropna().astype(str)
+        if len(values) and values.str.contains('@').mean() > 0.5:
+            return col
+    raise ValueError("No column of email addresses found")
+
+
+class SuppressionList:
+    """A persistent set of addresses that must not be sent to"""
+
+    def __init__(self, path=DEFAULT_PATH, timeout=30.0):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=timeout, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @property
+    def index_path(self):
+        return self.path + '.idx.npy'
+
+    def _generation(self, key='generation'):
+        row = self._conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else 0
+
+    def _changed(self):
+        self._conn.execute("INSERT INTO meta (key, value) VALUES ('generation', 1) "
+                           "ON CONFLICT(key) DO UPDATE SET value = value + 1")
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM suppressions").fetchone()[0]
+
+    def add(self, addresses, reason=MANUAL, source=None):
+        """Suppress addresses; returns how many were not already on the list"""
+        normalized = normalize(addresses).dropna().unique()
+        now = time.time()
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany("INSERT OR IGNORE INTO suppressions (address, reason, source, added) "
+                                   "VALUES (?, ?, ?, ?)", ((a, reason, source, now) for a in normalized))
+            added = self._conn.total_changes - before
+            if added:
+                self._changed()
+        return added
+
+    def add_file(self, path_or_buffer, reason=MANUAL, source=None):
+        """Suppress every address in a CSV or Excel list; returns how many were new"""
+        name = str(getattr(path_or_buffer, 'name', path_or_buffer)).lower()
+        df = pd.read_excel(path_or_buffer) if name.endswith(('.xlsx', '.xls')) else pd.read_csv(path_or_buffer)
+        return self.add(df[find_email_column(df)], reason, source or os.path.basename(name))
+
+    def remove(self, addresses):
+        """Take addresses off the list; returns how many were removed"""
+        normalized = normalize(addresses).dropna().unique()
+        with self._lock, self._conn:
+            before = self._conn.total_changes
+            self._conn.executemany("DELETE FROM suppressions WHERE address = ?", ((a,) for a in normalized))
+            removed = self._conn.total_changes - before
+            if removed:
+                self._changed()
+        return removed
+
+    def counts(self):
+        """Return {reason: count}"""
+        with self._lock:
+            return dict(self._conn.execute("SELECT COALESCE(reason, ''), COUNT(*) FROM suppressions GROUP BY reason"))
+
+    def index(self):
+        """Return the sorted hash array, rebuilding it only when the list has changed"""
+        with self._lock:
+            generation = self._generation()
+            saved = self._generation('index_generation')
+        key = (os.path.abspath(self.path), generation)
+        with _indexes_lock:
+            if key in _indexes:
+                return _indexes[key]
+
+        if saved == generation and os.path.exists(self.index_path):
+            hashes = np.load(self.index_path, mmap_mode='r')
+        else:
+            with self._lock:
+                addresses = pd.Series([row[0] for row in self._conn.execute("SELECT address FROM suppressions")],
+                                      dtype=object)
+            hashes = np.unique(hash_addresses(addresses))
+            tmp_path = self.index_path + f'.{os.getpid()}.tmp.npy'
+            np.save(tmp_path, hashes)
+            os.replace(tmp_path, self.index_path)
+            with self._lock, self._conn:
+                self._conn.execute("INSERT INTO meta (key, value) VALUES ('index_generation', ?) "
+                                   "ON CONFLICT(key) DO UPDATE SET value = excluded.value", (generation,))
+
+        with _indexes_lock:
+            # Only the newest index of each list is kept in memory
+            for stale in [k for k in _indexes if k[0] == key[0]]:
+                del _indexes[stale]
+            _indexes[key] = hashes
+        return hashes
+
+    def check(self, addresses):
+        """Return a Series aligned with `addresses`: the suppression reason, or None
+
+        Hashing and lookup are vectorized over the whole column; only hash
+        hits are confirmed against the stored addresses.
+        """
+        series = addresses if isinstance(addresses, pd.Series) else pd.Series(addresses, dtype=object)
+        normalized = normalize(series.to_numpy(dtype=object))
+        reasons = pd.Series(None, index=series.index, dtype=object)
+        hashes = self.index()
+        if len(hashes) == 0 or len(series) == 0:
+            return reasons
+
+        candidates = hash_addresses(normalized)
+        positions = np.searchsorted(hashes, candidates).clip(max=len(hashes) - 1)
+        hits = (np.asarray(hashes)[positions] == candidates) & normalized.notna().to_numpy()
+        if not hits.any():
+            return reasons
+
+        # Exact fallback: confirm the hits by address
+        hit_addresses = normalized[hits].unique().tolist()
+        found = {}
+        with self._lock:
+            for start in range(0, len(hit_addresses), _CONFIRM_BATCH):
+                batch = hit_addresses[start:start + _CONFIRM_BATCH]
+                query = (f"SELECT address, COALESCE(reason, '{MANUAL}') FROM suppressions "
+                         f"WHERE address IN ({','.join('?' * len(batch))})")
+                found.update(self._conn.execute(query, batch))
+        confirmed = normalized.map(found).where(hits).astype(object)
+        return confirmed.where(confirmed.notna(), None).set_axis(series.index)
+
+
+def list_generation(path=DEFAULT_PATH):
+    """Return a number that changes whenever the list changes (0 when there is no list yet)
+
+    Reads one row without creating the file, so callers can cache checks
+    against the list cheaply.
+    """
+    if not os.path.exists(path):
+        return 0
+    try:
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30.0)
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return 0
+    return row[0] if row else 0
+
+
+def suppressed_rows(addresses, path=DEFAULT_PATH):
+    """Return {row label: reason} for the suppressed entries of an address column
+
+    Returns {} when there is no suppression list yet.
+    """
+    if not os.path.exists(path):
+        return {}
+    suppressions = SuppressionList(path)
+    try:
+        reasons = suppressions.check(addresses)
+    finally:
+        suppressions.close()
+    return {label: reason for label, reason in reasons.items() if reason is not None}
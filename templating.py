@@ -0,0 +1,355 @@
+"""
+Email templates with conditionals, filters and loops
+
+Templates are compiled once into a Python function and cached, so rendering
+a row is a single call however much logic the template holds.
+
+    {Name}                          the row's value ("" when missing or NaN)
+    {Name|default:"there"}          a fallback for missing values
+    {Name|first|title}              filters, applied left to right
+    {% if Segment == "student" %} ... {% elif Score >= 80 %} ... {% else %} ... {% endif %}
+    {% for course in Courses %}<li>{course}</li>{% endfor %}
+
+Loops split a column on ";" unless another separator is given, as in
+`Courses|split:","`. Column names with spaces are written `[First Name]`
+inside tags. A bare `{Word}` that is not a column is left as it is, so CSS
+and other braces in the HTML pass through untouched; `{%-` and `-%}` trim
+the whitespace next to a tag.
+"""
+
+import html
+import re
+from functools import lru_cache
+
+
+class TemplateError(ValueError):
+    """Raised when a template cannot be compiled"""
+
+
+def is_missing(value):
+    """Return True for None, NaN and blank strings"""
+    if value is None:
+        return True
+    if isinstance(value, float) and value != value:
+        return True
+    return isinstance(value, str) and value.strip() == ''
+
+
+def to_text(value):
+    return '' if is_missing(value) else str(value)
+
+
+def truthy(value):
+    """Template truthiness: missing values and 'false'/'no'/'0' are false"""
+    return not is_missing(value) and str(value).strip().lower() not in ('false', 'no', '0', 'nan')
+
+
+def split_values(value, separator=';'):
+    if is_missing(value):
+        return []
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [part.strip() for part in str(value).split(separator) if part.strip()]
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def compare(left, op, right):
+    """Compare two values, numerically when both are numbers"""
+    if op in ('==', '!='):
+        a, b = _number(left), _number(right)
+        equal = a == b if a is not None and b is not None else to_text(left).strip() == to_text(right).strip()
+        return equal if op == '==' else not equal
+    a, b = _number(left), _number(right)
+    if a is None or b is None:
+        a, b = to_text(left), to_text(right)
+    return {'>': a > b, '<': a < b, '>=': a >= b, '<=': a <= b}[op]
+
+
+def _truncate(value, length=50, ellipsis='…'):
+    text = to_text(value)
+    return text if len(text) <= int(length) else text[:int(length)].rstrip() + ellipsis
+
+
+FILTERS = {
+    'default': lambda value, fallback='': fallback if is_missing(value) else value,
+    'upper': lambda value: to_text(value).upper(),
+    'lower': lambda value: to_text(value).lower(),
+    'title': lambda value: to_text(value).title(),
+    'capitalize': lambda value: to_text(value).capitalize(),
+    'strip': lambda value: to_text(value).strip(),
+    'first': lambda value: (to_text(value).split() or [''])[0],
+    'escape': lambda value: html.escape(to_text(value)),
+    'truncate': _truncate,
+    'split': split_values,
+    'join': lambda value, separator=', ': separator.join(to_text(v) for v in split_values(value)),
+    'count': lambda value: len(split_values(value)),
+}
+
+_RUNTIME = {'_text': to_text, '_truthy': truthy, '_split': split_values, '_compare': compare, '_filters': FILTERS}
+
+_TAG = re.compile(r'\{%(-?)\s*(.*?)\s*(-?)%\}|\{([^{}\n]+)\}', re.S)
+_TOKEN = re.compile(r'''\s*(?:
+    (?P<column>\[[^\]]+\])
+  | (?P<string>"(?:[^"\\]|\\.)*"|'(?:[^'\\]|\\.)*')
+  | (?P<number>-?\d+(?:\.\d+)?)
+  | (?P<op>==|!=|>=|<=|>|<|\(|\)|\||:)
+  | (?P<name>[A-Za-z_][\w.]*)
+)''', re.X)
+
+
+def _tokenize(source):
+    tokens = []
+    pos = 0
+    source = source.strip()
+    while pos < len(source):
+        match = _TOKEN.match(source, pos)
+        if not match or match.end() == pos:
+            raise TemplateError(f"Cannot parse '{source[pos:]}' in '{source}'")
+        kind = match.lastgroup
+        text = match.group(kind)
+        tokens.append((kind, text[1:-1] if kind == 'column' else text))
+        pos = match.end()
+    return tokens
+
+
+class _ExpressionParser:
+    """Turn a tag's expression into Python source over the runtime helpers"""
+
+    def __init__(self, source, scope):
+        self.source = source
+        self.tokens = _tokenize(source)
+        self.pos = 0
+        self.scope = scope
+
+    def peek(self, text=None):
+        if self.pos >= len(self.tokens):
+            return None
+        token = self.tokens[self.pos]
+        if text is not None and not (token[0] in ('op', 'name') and token[1] == text):
+            return None
+        return token
+
+    def take(self, text=None):
+        token = self.peek(text)
+        if token is None:
+            expected = f"'{text}'" if text else "more"
+            raise TemplateError(f"Expected {expected} in '{self.source}'")
+        self.pos += 1
+        return token
+
+    def done(self):
+        if self.pos != len(self.tokens):
+            raise TemplateError(f"Unexpected '{self.tokens[self.pos][1]}' in '{self.source}'")
+
+    def condition(self):
+        left = self.and_expr()
+        while self.peek('or'):
+            self.take()
+            left = f"({left} or {self.and_expr()})"
+        return left
+
+    def and_expr(self):
+        left = self.not_expr()
+        while self.peek('and'):
+            self.take()
+            left = f"({left} and {self.not_expr()})"
+        return left
+
+    def not_expr(self):
+        if self.peek('not'):
+            self.take()
+            return f"(not {self.not_expr()})"
+        if self.peek('('):
+            self.take()
+            inner = self.condition()
+            self.take(')')
+            return inner
+        left = self.value()
+        token = self.peek()
+        if token and token[0] == 'op' and token[1] in ('==', '!=', '>=', '<=', '>', '<'):
+            self.take()
+            return f"_compare({left}, {token[1]!r}, {self.value()})"
+        return f"_truthy({left})"
+
+    def value(self):
+        kind, text = self.take()
+        if kind == 'string':
+            expr = repr(_unquote(text))
+        elif kind == 'number':
+            expr = text
+        elif kind in ('name', 'column'):
+            expr = self.scope.lookup(text)
+        else:
+            raise TemplateError(f"Unexpected '{text}' in '{self.source}'")
+        return self.filters(expr)
+
+    def filters(self, expr):
+        while self.peek('|'):
+            self.take()
+            kind, name = self.take()
+            if kind != 'name' or name not in FILTERS:
+                raise TemplateError(f"Unknown filter '{name}' in '{self.source}'")
+            args = []
+            while self.peek(':'):
+                self.take()
+                kind, text = self.take()
+                if kind not in ('string', 'number'):
+                    raise TemplateError(f"Filter arguments must be quoted strings or numbers in '{self.source}'")
+                args.append(repr(_unquote(text)) if kind == 'string' else text)
+            expr = f"_filters[{name!r}]({', '.join([expr] + args)})"
+        return expr
+
+
+def _tag_source(text):
+    # The editor escapes < > & and quotes inside tags like any other text
+    return html.unescape(text).replace('\xa0', ' ').strip()
+
+
+def _unquote(text):
+    return re.sub(r'\\(.)', r'\1', text[1:-1])
+
+
+class _Scope:
+    """Columns of the row plus the variables of enclosing loops"""
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.loops = []
+        self.used = set()
+
+    def lookup(self, name):
+        for var, local in reversed(self.loops):
+            if var == name:
+                return local
+        self.used.add(name)
+        return f"_row.get({name!r})"
+
+    def knows(self, name):
+        return name in self.columns or any(var == name for var, _ in self.loops)
+
+
+def _generate(text, columns, scope=None):
+    """Return the Python source of the render function for a template"""
+    scope = scope or _Scope(columns)
+    lines = ["def render(_row):", " _out = []", " _emit = _out.append"]
+    depth = 1
+    stack = []
+    pos = 0
+    trim_next = False
+    pieces = []
+
+    def emit_literal(literal):
+        if literal:
+            lines.append(' ' * depth + f"_emit({literal!r})")
+
+    for match in _TAG.finditer(text):
+        literal = text[pos:match.start()]
+        pos = match.end()
+        if trim_next:
+            literal = literal.lstrip()
+            trim_next = False
+
+        if match.group(4) is not None:
+            # {Column} or {Column|filter...}
+            source = _tag_source(match.group(4))
+            name = source.split('|', 1)[0].strip()
+            if name.startswith('[') and name.endswith(']'):
+                name = name[1:-1]
+            if '|' not in source and not scope.knows(name):
+                pieces.append(literal + match.group(0))
+                continue
+            emit_literal(''.join(pieces) + literal)
+            pieces = []
+            # The column part may contain spaces, so only the filters go through the tokenizer
+            parser = _ExpressionParser(source[len(source.split('|', 1)[0]):], scope)
+            parser.source = source
+            expr = parser.filters(scope.lookup(name))
+            parser.done()
+            lines.append(' ' * depth + f"_emit(_text({expr}))")
+            continue
+
+        trim_before, statement, trim_after = match.group(1), _tag_source(match.group(2)), match.group(3)
+        literal = ''.join(pieces) + literal
+        pieces = []
+        emit_literal(literal.rstrip() if trim_before else literal)
+        trim_next = bool(trim_after)
+
+        keyword, _, rest = statement.partition(' ')
+        if keyword == 'if':
+            parser = _ExpressionParser(rest, scope)
+            condition = parser.condition()
+            parser.done()
+            lines.append(' ' * depth + f"if {condition}:")
+            stack.append('if')
+            depth += 1
+            lines.append(' ' * depth + "pass")
+        elif keyword in ('elif', 'else'):
+            if not stack or stack[-1] != 'if':
+                raise TemplateError(f"'{{% {keyword} %}}' without a matching '{{% if %}}'")
+            if keyword == 'elif':
+                parser = _ExpressionParser(rest, scope)
+                condition = parser.condition()
+                parser.done()
+                lines.append(' ' * (depth - 1) + f"elif {condition}:")
+            else:
+                lines.append(' ' * (depth - 1) + "else:")
+            lines.append(' ' * depth + "pass")
+        elif keyword == 'endif':
+            if not stack or stack.pop() != 'if':
+                raise TemplateError("'{% endif %}' without a matching '{% if %}'")
+            depth -= 1
+        elif keyword == 'for':
+            var, sep, iterable = rest.partition(' in ')
+            var = var.strip()
+            if not sep or not re.fullmatch(r'[A-Za-z_]\w*', var):
+                raise TemplateError(f"Use '{{% for item in Column %}}', not '{{% {statement} %}}'")
+            parser = _ExpressionParser(iterable, scope)
+            source = parser.value()
+            parser.done()
+            local = f"_loop{len(scope.loops)}"
+            lines.append(' ' * depth + f"for {local} in _split({source}):")
+            scope.loops.append((var, local))
+            stack.append('for')
+            depth += 1
+            lines.append(' ' * depth + "pass")
+        elif keyword == 'endfor':
+            if not stack or stack.pop() != 'for':
+                raise TemplateError("'{% endfor %}' without a matching '{% for %}'")
+            scope.loops.pop()
+            depth -= 1
+        else:
+            raise TemplateError(f"Unknown tag '{{% {statement} %}}'")
+
+    if stack:
+        raise TemplateError(f"'{{% {stack[-1]} %}}' is never closed")
+    tail = text[pos:]
+    emit_literal(''.join(pieces) + (tail.lstrip() if trim_next else tail))
+    lines.append(" return ''.join(_out)")
+    return '\n'.join(lines)
+
+
+@lru_cache(maxsize=256)
+def compile_template(text, columns=()):
+    """Compile a template for rows with the given columns into a render(row) function"""
+    namespace = dict(_RUNTIME)
+    exec(compile(_generate(text or '', frozenset(columns)), '<template>', 'exec'), namespace)
+    return namespace['render']
+
+
+@lru_cache(maxsize=256)
+def referenced_columns(text, columns=()):
+    """Return the columns (in the given order) a template reads"""
+    scope = _Scope(frozenset(columns))
+    _generate(text or '', scope.columns, scope)
+    return tuple(col for col in columns if col in scope.used)
+
+
+def render_template(text, row, columns=None):
+    """Render a template for one row (a dict or pandas Series)"""
+    return compile_template(text or '', tuple(columns if columns is not None else row.keys()))(row)
@@ -0,0 +1,81 @@
+import io
+import os
+import time
+import zipfile
+
+import pytest
+
+from attachments import AttachmentError, AttachmentPrefetcher, AttachmentStore, encoded_length
+
+
+def make_zip(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def store():
+    store = AttachmentStore(max_attachment_bytes=1000, max_archive_bytes=2500, max_archive_files=5)
+    yield store
+    store.close()
+
+
+def test_archive_extracts_nested_files(store):
+    folder = store.add_archive('ok', make_zip([('a.txt', 'x' * 900), ('sub/b.txt', 'y' * 900)]))
+    assert sorted(os.listdir(folder)) == ['a.txt', 'sub']
+    assert open(os.path.join(folder, 'sub', 'b.txt')).read() == 'y' * 900
+    assert store.add_archive('ok', None) == folder
+
+
+@pytest.mark.parametrize('files, message', [
+    ([('a', 'x' * 5000)], 'attachment limit'),
+    ([(str(n), 'x' * 900) for n in range(4)], 'unpacks to more than'),
+    ([(str(n), '') for n in range(6)], 'file limit'),
+    ([('../escape', 'x')], 'Unsafe path'),
+])
+def test_archive_limits(store, files, message):
+    with pytest.raises(AttachmentError, match=message):
+        store.add_archive('bad', make_zip(files))
+    # Nothing half-extracted is left to be picked up later
+    assert os.listdir(store.spool_dir) == []
+
+
+@pytest.fixture
+def files(tmp_path):
+    for n in range(6):
+        (tmp_path / f'f{n}').write_bytes(b'x' * 3000)
+    return tmp_path
+
+
+def test_row_over_message_limit_fails(files):
+    prefetcher = AttachmentPrefetcher('files', base_dir=str(files), confine=True,
+                                      max_message_bytes=10000, message_bytes=5000)
+    assert prefetcher.load_row({'files': 'f0'}).attachments[0].size == 3000
+    result = prefetcher.load_row({'files': 'f0;f1'})
+    assert result.error.startswith('Message would be about')
+    assert prefetcher.load_row({'files': '../outside'}).error
+
+
+def test_iterate_bounds_buffered_bytes(files):
+    prefetcher = AttachmentPrefetcher('files', base_dir=str(files), lookahead=16,
+                                      max_buffered_bytes=2 * encoded_length(3000))
+    loaded = []
+    original = prefetcher.load_row
+
+    def load_row(row):
+        loaded.append(row['files'])
+        return original(row)
+
+    prefetcher.load_row = load_row
+    rows = iter([(n, {'files': f'f{n}'}) for n in range(6)] + [(6, {'files': None})])
+    results = prefetcher.iterate(rows)
+    key, _, result = next(results)
+    assert key == 0 and len(result.attachments) == 1
+    time.sleep(0.2)
+    # Two rows' worth of files fit the budget, so only the next one was started
+    assert loaded == ['f0', 'f1']
+    assert [key for key, _, _ in results] == [1, 2, 3, 4, 5, 6]
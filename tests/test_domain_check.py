@@ -0,0 +1,71 @@
+import socket
+
+from domain_check import (NEGATIVE_TTL, NO_DOMAIN, NO_MAIL, OK, UNKNOWN, DomainCache, DomainChecker,
+                          StaticResolver, SystemResolver)
+
+
+class CountingResolver(StaticResolver):
+    def __init__(self, records):
+        super().__init__(records)
+        self.lookups = []
+
+    def lookup(self, domain):
+        self.lookups.append(domain)
+        return super().lookup(domain)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+RECORDS = {'example.com': ['mx.example.com'], 'nomail.com': [], 'flaky.com': None}
+
+
+def test_statuses():
+    checks = DomainChecker(StaticResolver(RECORDS)).check_domains(
+        ['example.com', 'nomail.com', 'flaky.com', 'gmial.com'])
+    assert {domain: check.status for domain, check in checks.items()} == {
+        'example.com': OK, 'nomail.com': NO_MAIL, 'flaky.com': UNKNOWN, 'gmial.com': NO_DOMAIN}
+
+
+def test_check_addresses_flags_only_undeliverable():
+    reasons = DomainChecker(StaticResolver(RECORDS)).check_addresses(
+        ['a@example.com', 'b@flaky.com', 'c@gmial.com', 'not an address', None, ''])
+    assert reasons[0] is None
+    assert reasons[1] is None
+    assert reasons[2] == 'gmial.com does not exist (did you mean gmail.com?)'
+    assert reasons[3] == 'not a valid email address'
+    assert reasons[4] is None and reasons[5] is None
+
+
+def test_cache_until_ttl_expires():
+    clock = Clock()
+    cache = DomainCache(':memory:', clock=clock)
+    resolver = CountingResolver(RECORDS)
+    checker = DomainChecker(resolver, cache)
+
+    checker.check_domains(['gmial.com', 'flaky.com'])
+    checker.check_domains(['gmial.com', 'flaky.com'])
+    # Failed lookups are not cached, answers are
+    assert sorted(resolver.lookups) == ['flaky.com', 'flaky.com', 'gmial.com']
+
+    clock.now += NEGATIVE_TTL + 1
+    resolver.lookups.clear()
+    assert checker.check_domains(['gmial.com'])['gmial.com'].status == NO_DOMAIN
+    assert resolver.lookups == ['gmial.com']
+    cache.close()
+
+
+def test_system_resolver_does_not_flag_missing_address_records(monkeypatch):
+    def getaddrinfo(host, *args, **kwargs):
+        if host == SystemResolver.PROBE_DOMAIN:
+            return []
+        raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known')
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    status, _, ttl = SystemResolver().lookup('mx-only.example')
+    assert status == UNKNOWN and not ttl
@@ -0,0 +1,70 @@
+import json
+import os
+
+from event_log import EventLog
+
+
+def read(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_entries_are_json_lines(tmp_path):
+    log = EventLog(str(tmp_path / 'logs' / 'mumailer.jsonl'))
+    log.write("Sent", recipient='to@example.com', status='sent', name=float('nan'), attempts=2)
+    log.write(status='failed', error=ValueError('bad'))
+    assert log.flush(5)
+    log.close()
+    first, second = read(tmp_path / 'logs' / 'mumailer.jsonl')
+    assert first['message'] == 'Sent' and first['name'] is None and first['attempts'] == 2
+    assert 'time' in first
+    assert second == {'time': second['time'], 'status': 'failed', 'error': 'bad'}
+
+
+def test_rotation_keeps_the_newest_files(tmp_path):
+    path = str(tmp_path / 'mumailer.jsonl')
+    log = EventLog(path, max_bytes=300, backups=2)
+    for n in range(20):
+        log.write(f"entry {n:02d}", padding='x' * 40)
+        assert log.flush(5)
+    log.close()
+
+    assert sorted(os.listdir(tmp_path)) == ['mumailer.jsonl', 'mumailer.jsonl.1', 'mumailer.jsonl.2']
+    assert all(os.path.getsize(tmp_path / name) <= 300 for name in os.listdir(tmp_path))
+    newest = [entry['message'] for name in ('mumailer.jsonl.2', 'mumailer.jsonl.1', 'mumailer.jsonl')
+              for entry in read(tmp_path / name)]
+    assert newest == [f"entry {n:02d}" for n in range(20 - len(newest), 20)]
+
+
+def test_rotation_without_backups(tmp_path):
+    path = str(tmp_path / 'mumailer.jsonl')
+    log = EventLog(path, max_bytes=200, backups=0)
+    for n in range(10):
+        log.write(f"entry {n}", padding='x' * 40)
+        assert log.flush(5)
+    log.close()
+    assert os.listdir(tmp_path) == ['mumailer.jsonl']
+    assert read(path)[-1]['message'] == 'entry 9'
+
+
+def test_write_errors_drop_entries_and_close_the_file(tmp_path):
+    path = str(tmp_path / 'mumailer.jsonl')
+    log = EventLog(path)
+    log.write("before")
+    assert log.flush(5)
+    opened = log._file
+
+    def fail(lines):
+        raise OSError("disk full")
+
+    log._write, write = fail, log._write
+    log.write("lost")
+    assert log.flush(5)
+    assert log.dropped == 1 and opened.closed and log._file is None
+
+    # The next batch opens the file again
+    log._write = write
+    log.write("after")
+    assert log.flush(5)
+    log.close()
+    assert [entry['message'] for entry in read(path)] == ['before', 'after']
@@ -0,0 +1,171 @@
+import threading
+import time
+
+from governor import AccountGovernor, SqliteRateLimiter
+
+
+class Clock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class GateLimiter:
+    """Grants only the tokens a test hands out"""
+
+    def __init__(self):
+        self.tokens = 0
+        self.rate = None
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate, burst=None):
+        self.rate = rate
+
+    def try_acquire(self):
+        with self.lock:
+            if self.tokens:
+                self.tokens -= 1
+                return 0.0
+        return 0.01
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_limits_follow_the_strictest_campaign():
+    governor = AccountGovernor('u@smtp.example.com:587')
+    limiter = governor.limiter
+    governor.register('a', rate=10, connections=4)
+    governor.register('b', rate=5, connections=2)
+    assert (governor.rate, governor.max_connections) == (5, 2)
+    governor.unregister('b')
+    assert (governor.rate, governor.max_connections) == (10, 4)
+    # The limiter is changed in place, never replaced
+    assert governor.limiter is limiter and limiter.rate == 10
+    governor.unregister('a')
+    assert governor.idle and governor.rate is None
+
+
+def test_campaign_that_sent_least_goes_next():
+    governor = AccountGovernor('account')
+    governor.limiter = GateLimiter()
+    governor.register('big')
+    governor.register('small')
+    governor._sent['big'] = 10
+    winners = []
+    threads = [start(lambda name=name: governor.acquire_send(name) and winners.append(name))
+               for name in ('big', 'small')]
+    wait_for(lambda: all(governor._waiting_send.values()))
+    governor.limiter.tokens = 1
+    wait_for(lambda: winners)
+    assert winners == ['small']
+    governor.limiter.tokens = 1
+    for thread in threads:
+        thread.join(5)
+    assert winners == ['small', 'big'] and governor.sent == 2
+
+
+def test_newcomer_starts_level():
+    governor = AccountGovernor('account')
+    governor.register('a')
+    governor._sent['a'] = 7
+    governor.register('b')
+    assert governor._sent['b'] == 7
+
+
+def test_token_is_taken_outside_the_lock():
+    governor = AccountGovernor('account')
+    entered, release = threading.Event(), threading.Event()
+
+    class SlowLimiter(GateLimiter):
+        def try_acquire(self):
+            entered.set()
+            release.wait(5)
+            return 0.0
+
+    governor.limiter = SlowLimiter()
+    governor.register('a')
+    sender = start(governor.acquire_send, 'a')
+    assert entered.wait(5)
+    # Other campaigns can register while the limiter is busy
+    registering = start(governor.register, 'b')
+    registering.join(1)
+    assert not registering.is_alive()
+    release.set()
+    sender.join(5)
+    assert governor.sent == 1
+
+
+def test_stopped_waiter_gives_up():
+    governor = AccountGovernor('account')
+    governor.limiter = GateLimiter()
+    governor.register('a')
+    stop = threading.Event()
+    stop.set()
+    assert governor.acquire_send('a', stop) is False
+    assert governor._waiting_send['a'] == 0
+
+
+def test_connection_cap_and_parked_slots():
+    governor = AccountGovernor('account')
+    reclaimed = []
+    governor.register('a', connections=1, reclaim=lambda: reclaimed.append('a'))
+    governor.register('b', connections=1)
+    assert governor.acquire_connection('a')
+    stop = threading.Event()
+    timer = threading.Timer(0.3, stop.set)
+    timer.start()
+    assert governor.acquire_connection('b', stop) is False
+
+    # A parked connection's slot goes to a campaign that needs it
+    governor.park_connection('a')
+    assert governor.acquire_connection('b')
+    assert reclaimed == ['a']
+    assert governor.unpark_connection('a') is False
+    assert governor.stats().in_use == 1
+
+
+def test_should_yield():
+    governor = AccountGovernor('account')
+    governor.register('a', connections=2)
+    governor.register('b', connections=2)
+    assert governor.acquire_connection('a') and governor.acquire_connection('a')
+    assert not governor.should_yield('a')
+    waiter = start(governor.acquire_connection, 'b')
+    wait_for(lambda: governor.connection_wanted())
+    assert governor.should_yield('a') and not governor.should_yield('b')
+    governor.release_connection('a')
+    waiter.join(5)
+    assert governor.stats().in_use == 2
+
+
+def test_sqlite_limiter_shares_the_bucket(tmp_path):
+    clock = Clock()
+    path = str(tmp_path / 'governor.db')
+    first = SqliteRateLimiter(path, 'account', 2, clock=clock)
+    second = SqliteRateLimiter(path, 'account', 2, clock=clock)
+    try:
+        assert first.try_acquire() == 0 and second.try_acquire() == 0
+        assert first.try_acquire() == 0.5
+        clock.now += 0.5
+        assert second.try_acquire() == 0
+        # A lower rate applies to the same bucket
+        second.set_rate(1)
+        assert second.try_acquire() == 1.0
+        second.set_rate(None)
+        assert second.try_acquire() == 0
+    finally:
+        first.close()
+        second.close()
@@ -0,0 +1,72 @@
+from email import message_from_bytes, policy
+
+import pytest
+
+from attachments import load_attachment
+from message_builder import (BASE64, EIGHT_BIT, QUOTED_PRINTABLE, SEVEN_BIT, build_message, choose_body_encoding,
+                             encoding_fits, fold_long_lines, sender_domain)
+
+
+@pytest.mark.parametrize('text, eight_bit, expected', [
+    ('<p>Hello</p>', False, SEVEN_BIT),
+    ('<p>Hello</p>', True, SEVEN_BIT),
+    ('<p>Grüße aus München</p>', True, EIGHT_BIT),
+    ('<p>Grüße aus München, and a lot more plain text after it</p>', False, QUOTED_PRINTABLE),
+    ('<p>' + '日本語のテキスト' * 20 + '</p>', False, BASE64),
+    ('<p>Hello\r\n</p>', True, QUOTED_PRINTABLE),
+    ('x' * 2000, False, QUOTED_PRINTABLE),
+])
+def test_choose_body_encoding(text, eight_bit, expected):
+    assert choose_body_encoding(text, eight_bit) == expected
+
+
+def test_fold_long_lines():
+    text = ' '.join(['word'] * 200)
+    folded = fold_long_lines(text, width=40)
+    assert all(len(line) <= 40 for line in folded.split('\n'))
+    assert folded.split() == text.split()
+    assert fold_long_lines('<td>' * 30, width=40).replace('\n', '') == '<td>' * 30
+    assert fold_long_lines('<pre>' + 'x ' * 100 + '</pre>', width=40) is None
+    assert fold_long_lines('x' * 100, width=40) is None
+
+
+def test_encoding_fits():
+    assert encoding_fits(SEVEN_BIT, '<p>Hi</p>')
+    assert not encoding_fits(SEVEN_BIT, '<p>Hé</p>')
+    assert not encoding_fits(EIGHT_BIT, '<p>Hé</p>', eight_bit=False)
+    assert encoding_fits(EIGHT_BIT, '<p>Hé</p>', eight_bit=True)
+    assert encoding_fits(BASE64, 'anything\r\n')
+
+
+def test_sender_domain():
+    assert sender_domain('News <news@example.com>') == 'example.com'
+    assert sender_domain('') == 'localhost'
+
+
+def test_build_message(tmp_path):
+    path = tmp_path / 'report.txt'
+    path.write_bytes(b'report body')
+    message = build_message('News <news@example.com>', 'to@example.org', 'Hello', '<p>Grüße</p>',
+                            [load_attachment(str(path))], reply_to='reply@example.com',
+                            body_encoding=SEVEN_BIT, eight_bit=False)
+    data = message.as_bytes()
+    assert message.size == len(data)
+    assert not message.eight_bit
+    assert b'\n' not in data.replace(b'\r\n', b'')
+
+    parsed = message_from_bytes(data, policy=policy.default)
+    assert parsed['Date'] and parsed['Message-ID'].endswith('@example.com>')
+    assert parsed['Reply-To'] == 'reply@example.com'
+    # The campaign's 7bit choice does not fit this body, so it was picked again
+    body = parsed.get_body(('html',))
+    assert body['Content-Transfer-Encoding'] == QUOTED_PRINTABLE
+    assert body.get_content().rstrip() == '<p>Grüße</p>'
+    (attachment,) = parsed.iter_attachments()
+    assert attachment.get_filename() == 'report.txt'
+    assert attachment.get_payload(decode=True) == b'report body'
+
+
+def test_build_message_eight_bit():
+    message = build_message('news@example.com', 'to@example.org', 'Hello', '<p>Grüße</p>', eight_bit=True)
+    assert message.eight_bit
+    assert 'Grüße'.encode('utf-8') in message.as_bytes()
@@ -0,0 +1,134 @@
+import os
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import scheduler
+from scheduler import (CampaignScheduler, default_timezone_name, resolve_timezone, run_in_background, spread_times,
+                       to_timestamp)
+
+
+class Clock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_spread_times():
+    assert spread_times(4, 100, 200, now=50) == [100, 125, 150, 175]
+    # A window that has already begun starts now
+    assert spread_times(2, 100, 200, now=150) == [150, 175]
+    # Closed windows and windows without a deadline send at once
+    assert spread_times(3, 100, 200, now=300) == [300, 300, 300]
+    assert spread_times(2, 100, None, now=50) == [100, 100]
+
+
+def test_to_timestamp():
+    kolkata = resolve_timezone('Asia/Kolkata')
+    if kolkata is None:
+        pytest.skip("no timezone database")
+    moment = datetime(2026, 1, 1, 9, 0)
+    assert to_timestamp(moment, kolkata) == datetime(2026, 1, 1, 3, 30, tzinfo=timezone.utc).timestamp()
+    # Aware datetimes keep their own zone
+    assert to_timestamp(moment.replace(tzinfo=timezone.utc), kolkata) == datetime(
+        2026, 1, 1, 9, 0, tzinfo=timezone.utc).timestamp()
+    assert to_timestamp(None) is None
+
+
+def test_resolve_timezone():
+    assert resolve_timezone('Not/AZone', default=timezone.utc) is timezone.utc
+    assert resolve_timezone(float('nan')) is None
+    assert resolve_timezone('') is None
+
+
+def test_default_timezone_name(monkeypatch):
+    if resolve_timezone('Asia/Kolkata') is None:
+        pytest.skip("no timezone database")
+    monkeypatch.setenv(scheduler.TIMEZONE_ENV, 'Asia/Kolkata')
+    assert default_timezone_name() == 'Asia/Kolkata'
+    monkeypatch.setenv(scheduler.TIMEZONE_ENV, 'Not/AZone')
+    assert default_timezone_name() == ''
+
+
+def make_scheduler(clock):
+    campaigns = CampaignScheduler(clock=clock)
+    order = []
+
+    def submit(name, priority, start):
+        campaign = campaigns.submit([(n, None) for n in range(3)], lambda key, row: (name, key),
+                                    start=start, priority=priority, name=name)
+        release = campaign._release
+        campaign._release = lambda key, row: (order.append(name), release(key, row))
+        return campaign
+
+    return campaigns, order, submit
+
+
+def test_higher_priority_goes_first():
+    clock = Clock()
+    campaigns, order, submit = make_scheduler(clock)
+    start = datetime.fromtimestamp(10, timezone.utc)
+    low = submit('low', 1, start)
+    high = submit('high', 5, start)
+    assert campaigns.next_due(low).timestamp() == 10
+    try:
+        clock.now = 10
+        assert list(low) == [('low', 0), ('low', 1), ('low', 2)]
+        assert list(high) == [('high', 0), ('high', 1), ('high', 2)]
+        assert order == ['high'] * 3 + ['low'] * 3
+    finally:
+        campaigns.shutdown()
+
+
+def test_cancel_ends_the_campaign():
+    clock = Clock()
+    campaigns, order, submit = make_scheduler(clock)
+    campaign = submit('later', 1, datetime.fromtimestamp(10, timezone.utc))
+    try:
+        campaigns.cancel(campaign)
+        clock.now = 10
+        assert list(campaign) == []
+        time.sleep(0.1)
+        assert order == []
+    finally:
+        campaigns.shutdown()
+
+
+class Engine:
+    def __init__(self):
+        self.closed = False
+
+    def run(self, jobs):
+        for job in jobs:
+            yield type('Result', (), {'status': 'sent', 'job': job})()
+
+    def close(self):
+        self.closed = True
+
+
+def test_run_in_background_releases_files(tmp_path):
+    source = tmp_path / 'rows'
+    source.mkdir()
+    (source / 'one.pdf').write_bytes(b'row')
+    campaigns = CampaignScheduler()
+    files_dir = campaigns.take_files(str(source))
+    try:
+        campaign = campaigns.submit([(1, None)], lambda key, row: open(os.path.join(files_dir, 'one.pdf')).read(),
+                                    files_dir=files_dir)
+        engine = Engine()
+        run_in_background(campaign, engine)
+        wait_for(lambda: campaign.done)
+        assert [result.job for result in campaign.results] == ['row']
+        assert engine.closed and not os.path.exists(files_dir)
+    finally:
+        campaigns.shutdown()
@@ -0,0 +1,54 @@
+import json
+import os
+import shutil
+
+from message_builder import build_message
+from spool import EML, MAILDIR, Spool
+
+
+def message(recipient='to@example.com'):
+    return build_message('from@example.com', recipient, 'Hello', '<p>Hi</p>\n.dot line')
+
+
+def test_maildir_holds_only_the_message(tmp_path):
+    spool = Spool(str(tmp_path / 'outbox'), MAILDIR)
+    size = spool.add(7, 'to@example.com', message())
+    (name,) = os.listdir(spool.ready_dir)
+    data = (tmp_path / 'outbox' / 'new' / name).read_bytes()
+    assert b'\r' not in data
+    assert not data.startswith(b'X-Mumailer')
+
+    claimed = spool.claim()
+    wire = claimed.as_bytes()
+    assert (claimed.key, claimed.recipient) == (7, 'to@example.com')
+    assert claimed.size == size == len(wire)
+    assert b'\n' not in wire.replace(b'\r\n', b'')
+    assert wire.replace(b'\r\n', b'\n') == data
+    spool.finish(claimed, 'sent')
+    assert os.listdir(tmp_path / 'outbox' / 'envelopes') == []
+    assert spool.status().sent == 1
+
+
+def test_message_without_envelope_fails(tmp_path):
+    spool = Spool(str(tmp_path / 'outbox'), EML)
+    (tmp_path / 'outbox' / 'stray.eml').write_bytes(b'Subject: x\n\nbody\n')
+    assert spool.claim() is None
+    assert spool.status().failed == 1
+
+
+def test_campaign_files_are_copied(tmp_path):
+    source = tmp_path / 'session'
+    (source / 'rows').mkdir(parents=True)
+    (source / 'report.pdf').write_bytes(b'pdf')
+    (source / 'rows' / 'one.pdf').write_bytes(b'row')
+    spool = Spool(str(tmp_path / 'outbox'))
+    spool.write_campaign({'attachments': [{'path': str(source / 'report.pdf')}],
+                          'attachment_dir': str(source / 'rows')})
+    shutil.rmtree(source)
+
+    with open(tmp_path / 'outbox' / 'campaign.json') as f:
+        assert not os.path.isabs(json.load(f)['attachments'][0]['path'])
+    campaign = spool.campaign()
+    assert open(campaign['attachments'][0]['path'], 'rb').read() == b'pdf'
+    assert campaign['attachments'][0]['filename'] == 'report.pdf'
+    assert os.listdir(campaign['attachment_dir']) == ['one.pdf']
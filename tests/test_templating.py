@@ -0,0 +1,37 @@
+import pytest
+
+from templating import TemplateError, referenced_columns, render_template
+
+
+def test_conditionals_and_filters():
+    template = '{% if Score >= 80 %}Top{% elif Score < 10 %}Low{% else %}Mid{% endif %} {Name|default:"there"|title}'
+    assert render_template(template, {'Score': 90, 'Name': 'ada'}) == 'Top Ada'
+    assert render_template(template, {'Score': 5, 'Name': None}) == 'Low There'
+    assert render_template(template, {'Score': 50, 'Name': ''}) == 'Mid There'
+
+
+def test_loops_split_columns():
+    template = '<ul>{% for course in Courses %}<li>{course}</li>{% endfor %}</ul>'
+    assert render_template(template, {'Courses': 'Maths; Art'}) == '<ul><li>Maths</li><li>Art</li></ul>'
+
+
+def test_editor_escaped_tags():
+    # The HTML editor stores comparison operators and quotes inside tags as entities
+    template = ('<p>{% if Score &gt;= 80 %}hi{% elif Segment == &quot;R&amp;D&quot; %}lab{% endif %}'
+                '&nbsp;{Name|default:&quot;there&quot;}</p>')
+    assert render_template(template, {'Score': 90, 'Segment': '', 'Name': 'Ada'}) == '<p>hi&nbsp;Ada</p>'
+    assert render_template(template, {'Score': 1, 'Segment': 'R&D', 'Name': None}) == '<p>lab&nbsp;there</p>'
+    assert render_template('<p>{%&nbsp;if Score &lt;= 1&nbsp;%}low{%&nbsp;endif&nbsp;%}</p>', {'Score': 0}) == '<p>low</p>'
+
+
+def test_unknown_braces_pass_through():
+    assert render_template('p {color: red} {Name}', {'Name': 'Ada'}) == 'p {color: red} Ada'
+
+
+def test_referenced_columns():
+    assert referenced_columns('{% if Score > 1 %}{Name}{% endif %}', ('Email', 'Name', 'Score')) == ('Name', 'Score')
+
+
+def test_unclosed_tag():
+    with pytest.raises(TemplateError):
+        render_template('{% if Score > 1 %}hi', {'Score': 2})
@@ -0,0 +1,381 @@
+"""
+Delivery transports
+
+Every transport opens a connection with deliver(sender, recipients,
+message), an `eight_bit` flag saying whether 8bit bodies may be used, and
+quit()/close(). open_transport() picks one from the account's server:
+
+    smtp.example.com              SMTP (STARTTLS, or implicit TLS on port 465)
+    sendmail:///usr/sbin/sendmail hand each message to the local MTA's sendmail
+                                  command, which queues it (path optional)
+    pickup:///var/mail/pickup     drop .eml files into an MTA pickup directory
+    maildir:///tmp/outbox         write messages into a Maildir
+    mbox:///tmp/outbox.mbox       append messages to an mbox file
+
+The local transports need no network or login, so a campaign can run flat
+out against a local MTA that does its own queueing, and tests and load runs
+can exercise the whole pipeline offline. The send engine keeps SMTP
+connections open and pools them between runs; local connections are cheap
+to keep the same way.
+
+`send_message` streams an OutgoingMessage through the DATA command chunk by
+chunk, so attachment bodies go from the spool's memory map to the socket
+without building the whole message as one string.
+
+Every connection uses one SSL context for the whole process, and the TLS
+session of the last connection to each server is offered again, so servers
+that allow resumption skip the full handshake. Port 465 uses implicit TLS
+instead of STARTTLS. Handshake counts and times are kept for reporting.
+"""
+
+import itertools
+import os
+import re
+import shlex
+import smtplib
+import socket
+import ssl
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+from smtp_accounts import transport_scheme
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+_LEADING_DOT = re.compile(br'(?m)^\.')
+
+IMPLICIT_TLS_PORT = 465
+
+DEFAULT_SENDMAIL = '/usr/sbin/sendmail'
+
+# sendmail exit status for "try again later" (sysexits.h EX_TEMPFAIL)
+_EX_TEMPFAIL = 75
+
+TlsStats = namedtuple('TlsStats', ['handshakes', 'resumed', 'seconds'])
+
+_contexts = {}
+_sessions = {}
+_handshakes = {'count': 0, 'resumed': 0, 'seconds': 0.0}
+_tls_lock = threading.Lock()
+
+_drop_counter = itertools.count(1)
+_mbox_locks = {}
+_mbox_locks_lock = threading.Lock()
+
+
+def ssl_context(verify=False):
+    """Return the shared client context
+
+    Without `verify`, certificates are not checked, as with a bare
+    smtplib starttls(); pass verify=True to check them against the
+    system's CA store.
+    """
+    with _tls_lock:
+        if verify not in _contexts:
+            if verify:
+                context = ssl.create_default_context()
+            else:
+                context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            _contexts[verify] = context
+        return _contexts[verify]
+
+
+def tls_stats():
+    """Return the handshakes done so far: how many, how many resumed a session, and their total time"""
+    with _tls_lock:
+        return TlsStats(_handshakes['count'], _handshakes['resumed'], _handshakes['seconds'])
+
+
+def describe_tls(stats, since=None):
+    """Summarize TLS handshakes, optionally only those after an earlier tls_stats()"""
+    if since is not None:
+        stats = TlsStats(*(now - before for now, before in zip(stats, since)))
+    if not stats.handshakes:
+        return "no TLS handshakes"
+    return (f"{stats.handshakes} TLS handshakes ({stats.resumed} resumed), "
+            f"{stats.seconds * 1000 / stats.handshakes:.0f} ms average")
+
+
+def _wrap(context, sock, host, port):
+    """Run the TLS handshake, offering the last session for this server"""
+    with _tls_lock:
+        session = _sessions.get((host, port))
+    started = time.perf_counter()
+    tls_sock = context.wrap_socket(sock, server_hostname=host, session=session)
+    elapsed = time.perf_counter() - started
+    with _tls_lock:
+        _handshakes['count'] += 1
+        _handshakes['resumed'] += bool(tls_sock.session_reused)
+        _handshakes['seconds'] += elapsed
+    return tls_sock
+
+
+def _remember_session(server, host, port):
+    # TLS 1.3 tickets arrive after the handshake, so this runs once the server has replied
+    session = getattr(server.sock, 'session', None)
+    if session is not None:
+        with _tls_lock:
+            _sessions[(host, port)] = session
+
+
+class _SmtpDelivery:
+    """The transport interface on top of an smtplib connection"""
+
+    @property
+    def eight_bit(self):
+        return supports_8bitmime(self)
+
+    def deliver(self, sender, recipients, message):
+        return send_message(self, sender, recipients, message)
+
+
+class _SMTP(_SmtpDelivery, smtplib.SMTP):
+    """SMTP whose STARTTLS uses the shared context and resumes earlier sessions"""
+
+    def starttls(self, context=None):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('starttls'):
+            raise smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server.")
+        code, reply = self.docmd('STARTTLS')
+        if code != 220:
+            raise smtplib.SMTPResponseException(code, reply)
+        self.sock = _wrap(context or ssl_context(), self.sock, self._host, self.port)
+        # The server forgets everything said before TLS
+        self.file = None
+        self.helo_resp = self.ehlo_resp = None
+        self.esmtp_features = {}
+        self.does_esmtp = False
+        return code, reply
+
+    def connect(self, host='localhost', port=0, source_address=None):
+        self.port = port
+        return super().connect(host, port, source_address)
+
+
+class _SMTP_SSL(_SmtpDelivery, smtplib.SMTP_SSL):
+    """Implicit TLS (port 465) with the shared context and session resumption"""
+
+    def _get_socket(self, host, port, timeout):
+        return _wrap(self.context, smtplib.SMTP._get_socket(self, host, port, timeout), host, port)
+
+
+def open_smtp(settings, context=None):
+    """Open, secure and authenticate an SMTP connection"""
+    host, port = settings['server'], int(settings['port'])
+    if port == IMPLICIT_TLS_PORT:
+        server = _SMTP_SSL(host, port, context=context or ssl_context())
+    else:
+        server = _SMTP(host, port)
+        server.starttls(context)
+    server.login(settings['username'], settings['password'])
+    _remember_session(server, host, port)
+    return server
+
+
+def _recipients(recipients):
+    return [recipients] if isinstance(recipients, str) else list(recipients)
+
+
+def unix_lines(chunks):
+    """Yield chunks with CRLF line endings turned into LF, as local mail stores expect"""
+    carry = b''
+    for chunk in chunks:
+        chunk = carry + chunk
+        # A CRLF may be split between two chunks
+        carry = b'\r' if chunk.endswith(b'\r') else b''
+        yield chunk[:len(chunk) - len(carry)].replace(b'\r\n', b'\n')
+    if carry:
+        yield carry
+
+
+class _LocalConnection:
+    """Shared by the local transports: nothing to log in to or close"""
+
+    eight_bit = True
+
+    def quit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SendmailConnection(_LocalConnection):
+    """Hand each message to a sendmail-compatible command (Postfix, Exim, msmtp), which queues it"""
+
+    def __init__(self, command=DEFAULT_SENDMAIL):
+        self.command = shlex.split(command or DEFAULT_SENDMAIL)
+
+    def deliver(self, sender, recipients, message):
+        recipients = _recipients(recipients)
+        # -i: a line holding a single dot does not end the message
+        process = subprocess.Popen(self.command + ['-i', '-f', sender, '--'] + recipients,
+                                   stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        try:
+            for chunk in unix_lines(message.iter_chunks()):
+                process.stdin.write(chunk)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+        error = process.stderr.read().decode('utf-8', 'replace').strip()
+        status = process.wait()
+        if status:
+            code = 451 if status == _EX_TEMPFAIL else 554
+            raise smtplib.SMTPDataError(code, f"sendmail exited with {status}: {error}".encode())
+        return {}
+
+
+class _FileDrop(_LocalConnection):
+    """Write each message to a temporary file, then rename it into place, so readers never see half a message"""
+
+    def __init__(self, directory, tmp_dir):
+        self.directory = directory
+        self.tmp_dir = tmp_dir
+        os.makedirs(directory, exist_ok=True)
+        os.makedirs(tmp_dir, exist_ok=True)
+
+    def _unique_name(self):
+        # Maildir-style names: unique across threads, processes and hosts
+        return (f"{time.time_ns() // 1000}.P{os.getpid()}T{threading.get_ident()}"
+                f"Q{next(_drop_counter)}.{socket.gethostname().replace('/', '_')}")
+
+    def _drop(self, name, chunks):
+        tmp_path = os.path.join(self.tmp_dir, name)
+        with open(tmp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+
+class PickupConnection(_FileDrop):
+    """Drop .eml files into a pickup directory (IIS, Exchange, hMailServer and similar MTAs)"""
+
+    def __init__(self, directory):
+        # Written beside the directory, since the MTA takes every file that appears in it
+        super().__init__(directory, os.path.join(os.path.dirname(os.path.abspath(directory)), '.pickup-tmp'))
+
+    def deliver(self, sender, recipients, message):
+        recipients = _recipients(recipients)
+        envelope = f"X-Sender: {sender}\r\n" + ''.join(f"X-Receiver: {r}\r\n" for r in recipients)
+        self._drop(self._unique_name() + '.eml', [envelope.encode('utf-8')] + list(message.iter_chunks()))
+        return {}
+
+
+class MaildirConnection(_FileDrop):
+    """Write messages into a Maildir (tmp/ then new/), readable by any mail client"""
+
+    def __init__(self, path):
+        os.makedirs(os.path.join(path, 'cur'), exist_ok=True)
+        super().__init__(os.path.join(path, 'new'), os.path.join(path, 'tmp'))
+
+    def deliver(self, sender, recipients, message):
+        envelope = f"Return-Path: <{sender}>\nDelivered-To: {', '.join(_recipients(recipients))}\n"
+        self._drop(self._unique_name(), [envelope.encode('utf-8')] + list(unix_lines(message.iter_chunks())))
+        return {}
+
+
+class MboxConnection(_LocalConnection):
+    """Append messages to an mbox file (mboxrd quoting), one writer at a time"""
+
+    _FROM_LINE = re.compile(br'(?m)^(>*From )')
+
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with _mbox_locks_lock:
+            self._lock = _mbox_locks.setdefault(self.path, threading.Lock())
+
+    def deliver(self, sender, recipients, message):
+        # Built first, so the file is locked only while it is written
+        data = b''.join(self._FROM_LINE.sub(br'>\1', chunk) for chunk in unix_lines(message.iter_chunks()))
+        if not data.endswith(b'\n'):
+            data += b'\n'
+        from_line = f"From {sender or 'MAILER-DAEMON'} {time.asctime()}\n".encode('utf-8')
+        with self._lock, open(self.path, 'ab') as f:
+            if fcntl is not None:
+                fcntl.lockf(f, fcntl.LOCK_EX)
+            f.write(from_line + data + b'\n')
+        return {}
+
+
+LOCAL_TRANSPORTS = {
+    'sendmail': SendmailConnection,
+    'pickup': PickupConnection,
+    'maildir': MaildirConnection,
+    'mbox': MboxConnection,
+}
+
+
+def open_transport(settings, context=None):
+    """Open a connection for an account's settings: SMTP, or a local transport for scheme://path servers"""
+    scheme, rest = transport_scheme(settings['server'])
+    if scheme in LOCAL_TRANSPORTS:
+        return LOCAL_TRANSPORTS[scheme](rest)
+    if scheme != 'smtp':
+        raise smtplib.SMTPConnectError(554, f"Unknown transport {scheme}://".encode())
+    return open_smtp(dict(settings, server=rest), context)
+
+
+def supports_8bitmime(server):
+    """Return True if the server accepts 8bit message bodies"""
+    server.ehlo_or_helo_if_needed()
+    return bool(server.has_extn('8bitmime'))
+
+
+def server_size_limit(server):
+    """Return the SIZE limit advertised by the server in EHLO, or None"""
+    size = server.esmtp_features.get('size', '') if server.does_esmtp else ''
+    return int(size) if size.isdigit() and int(size) > 0 else None
+
+
+def send_message(server, sender, recipients, message):
+    """Send an OutgoingMessage over an open connection, streaming its body"""
+    if isinstance(recipients, str):
+        recipients = [recipients]
+
+    server.ehlo_or_helo_if_needed()
+    size = message.size
+    limit = server_size_limit(server)
+    if limit and size > limit:
+        raise smtplib.SMTPDataError(552, f"Message is {size} bytes, server limit is {limit}".encode())
+
+    options = [f"SIZE={size}"] if server.has_extn('size') else []
+    if getattr(message, 'eight_bit', False):
+        options.append("BODY=8BITMIME")
+    code, resp = server.mail(sender, options)
+    if code != 250:
+        server.rset()
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+
+    refused = {}
+    for recipient in recipients:
+        code, resp = server.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, resp)
+    if len(refused) == len(recipients):
+        server.rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    server.putcmd("data")
+    code, resp = server.getreply()
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+
+    # Chunks begin at line starts (or are base64, which has no dots), so
+    # dot-stuffing each chunk independently is safe
+    for chunk in message.iter_chunks():
+        server.send(_LEADING_DOT.sub(b'..', chunk))
+    server.send(b".\r\n")
+
+    code, resp = server.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return refused
@@ -0,0 +1,523 @@
+"""
+Shared campaign work queue
+
+A campaign is split into chunks of recipients stored in a SQLite file. Any
+number of worker processes, on this host or on others sharing the file,
+claim a chunk under a time-limited lease, send it, and keep the lease alive
+with heartbeats. Chunks whose lease expires (a worker crashed or hung) are
+claimed again by another worker. Every recipient's outcome is recorded
+once, keyed by row, so a reclaimed chunk skips recipients that were already
+sent. A chunk that has been claimed max_attempts times without finishing is
+marked failed, and its unsent recipients are recorded as failures.
+
+Run workers with:
+
+    python work_queue.py campaigns.db
+
+Attachments are copied into a folder next to the queue file
+(campaigns.db.files), so workers that can open the queue can read them too;
+a campaign's copies are deleted once all its chunks are finished.
+
+SMTP passwords are never stored in the queue; workers read them from the
+MUMAILER_PASSWORDS environment variable (a JSON object of account name to
+password) or prompt for them, the first time they work on a campaign that
+uses the account.
+"""
+
+import argparse
+import getpass
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import namedtuple
+
+from attachments import AttachmentPrefetcher, AttachmentStore, message_size
+from governor import shared_governor
+from retries import RetryPolicy
+from send_engine import SendEngine, SendJob, settled_job
+from smtp_accounts import accounts_from_config, is_local
+from templating import is_missing, render_template
+from inline_images import prepare_body
+from message_builder import choose_body_encoding
+
+
+PASSWORDS_ENV = 'MUMAILER_PASSWORDS'
+
+DEFAULT_CHUNK_SIZE = 100
+DEFAULT_LEASE_SECONDS = 60.0
+DEFAULT_MAX_ATTEMPTS = 5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS campaigns (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    payload TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    created REAL NOT NULL,
+    cancelled INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    campaign_id INTEGER NOT NULL REFERENCES campaigns(id),
+    seq INTEGER NOT NULL,
+    rows TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS chunks_claim ON chunks (state, campaign_id, seq);
+CREATE TABLE IF NOT EXISTS results (
+    campaign_id INTEGER NOT NULL,
+    row_key TEXT NOT NULL,
+    status TEXT NOT NULL,
+    message TEXT,
+    account TEXT,
+    worker TEXT,
+    finished REAL NOT NULL,
+    PRIMARY KEY (campaign_id, row_key)
+);
+"""
+
+
+Lease = namedtuple('Lease', ['chunk_id', 'campaign_id', 'rows', 'owner', 'attempts'])
+
+CampaignStatus = namedtuple('CampaignStatus', ['id', 'name', 'total', 'sent', 'failed', 'skipped',
+                                               'leased', 'cancelled'])
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class WorkQueue:
+    """Leased recipient chunks in a SQLite file shared by worker processes
+
+    Leases use wall-clock time, so hosts sharing a queue need synchronised
+    clocks. The rollback journal is kept (not WAL) so the file also works on
+    network storage.
+    """
+
+    def __init__(self, path, timeout=30.0, clock=time.time, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        self.path = path
+        self.clock = clock
+        self.max_attempts = max_attempts
+        self._conn = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    @property
+    def files_dir(self):
+        """Where campaigns' attachments are copied, beside the queue file so every worker can read them"""
+        return self.path + '.files'
+
+    def _copy_files(self, payload):
+        """Copy a campaign's attachments into files_dir; the returned payload refers to them relative to it"""
+        attachments = payload.get('attachments') or []
+        attachment_dir = payload.get('attachment_dir')
+        if not attachments and not attachment_dir:
+            return payload
+        os.makedirs(self.files_dir, exist_ok=True)
+        folder = tempfile.mkdtemp(prefix='campaign-', dir=self.files_dir)
+        name = os.path.basename(folder)
+        try:
+            copied = []
+            for i, attachment in enumerate(attachments):
+                path = os.path.join(name, f"{i}-{os.path.basename(attachment['path'])}")
+                shutil.copyfile(attachment['path'], os.path.join(self.files_dir, path))
+                copied.append({**attachment, 'path': path,
+                               'filename': attachment.get('filename') or os.path.basename(attachment['path'])})
+            if attachment_dir:
+                shutil.copytree(attachment_dir, os.path.join(folder, 'rows'))
+        except BaseException:
+            shutil.rmtree(folder, ignore_errors=True)
+            raise
+        return {**payload, 'files': name, 'attachments': copied,
+                'attachment_dir': os.path.join(name, 'rows') if attachment_dir else None}
+
+    def _transaction(self, fn):
+        # BEGIN IMMEDIATE takes the write lock up front so two workers never claim the same chunk
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = fn(self._conn)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def create_campaign(self, rows, payload, name=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Queue a campaign and return its id
+
+        `rows` is a list of (key, row dict) pairs; `payload` is a JSON-safe
+        dict describing how to render and send them (see render_job).
+        """
+        rows = [(str(key), row) for key, row in rows]
+        chunk_size = max(1, int(chunk_size))
+        stored = self._copy_files(payload)
+
+        def create(conn):
+            cursor = conn.execute("INSERT INTO campaigns (name, payload, total, created) VALUES (?, ?, ?, ?)",
+                                  (name, json.dumps(stored), len(rows), self.clock()))
+            campaign_id = cursor.lastrowid
+            conn.executemany(
+                "INSERT INTO chunks (campaign_id, seq, rows) VALUES (?, ?, ?)",
+                ((campaign_id, seq, json.dumps(rows[start:start + chunk_size], default=str))
+                 for seq, start in enumerate(range(0, len(rows), chunk_size)))
+            )
+            return campaign_id
+
+        try:
+            return self._transaction(create)
+        except BaseException:
+            if stored.get('files'):
+                shutil.rmtree(os.path.join(self.files_dir, stored['files']), ignore_errors=True)
+            raise
+
+    def payload(self, campaign_id):
+        """Return a campaign's payload, with its copied files' paths as seen from this host"""
+        with self._lock:
+            row = self._conn.execute("SELECT payload FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        if row is None:
+            return None
+        payload = json.loads(row[0])
+        if payload.get('files'):
+            payload['attachments'] = [{**a, 'path': os.path.join(self.files_dir, a['path'])}
+                                      for a in payload.get('attachments', [])]
+            if payload.get('attachment_dir'):
+                payload['attachment_dir'] = os.path.join(self.files_dir, payload['attachment_dir'])
+        return payload
+
+    def remove_files(self, campaign_id):
+        """Delete a campaign's copied files once none of its chunks can be sent again; returns True if finished"""
+        with self._lock:
+            unfinished = self._conn.execute(
+                "SELECT COUNT(*) FROM chunks WHERE campaign_id = ? AND state NOT IN ('done', 'failed')",
+                (campaign_id,)
+            ).fetchone()[0]
+            row = self._conn.execute("SELECT payload FROM campaigns WHERE id = ?", (campaign_id,)).fetchone()
+        if unfinished or row is None:
+            return False
+        name = json.loads(row[0]).get('files')
+        if name:
+            shutil.rmtree(os.path.join(self.files_dir, name), ignore_errors=True)
+        return True
+
+    def _fail_chunk(self, conn, chunk_id, campaign_id, rows, owner, message):
+        """Mark a chunk failed, recording every recipient in it without an outcome as a failure"""
+        now = self.clock()
+        conn.executemany(
+            "INSERT OR IGNORE INTO results (campaign_id, row_key, status, message, account, worker, finished) "
+            "VALUES (?, ?, 'failed', ?, NULL, ?, ?)",
+            ((campaign_id, str(key), message, owner, now) for key, _ in json.loads(rows))
+        )
+        conn.execute("UPDATE chunks SET state = 'failed', owner = NULL, lease_until = NULL WHERE id = ?", (chunk_id,))
+
+    def claim(self, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Lease the next pending (or expired) chunk to `owner`; returns a Lease or None"""
+        def claim(conn):
+            now = self.clock()
+            while True:
+                row = conn.execute(
+                    "SELECT chunks.id, chunks.campaign_id, chunks.rows, chunks.attempts, chunks.owner FROM chunks "
+                    "JOIN campaigns ON campaigns.id = chunks.campaign_id "
+                    "WHERE campaigns.cancelled = 0 "
+                    "AND (chunks.state = 'pending' OR (chunks.state = 'leased' AND chunks.lease_until < ?)) "
+                    "ORDER BY chunks.campaign_id, chunks.seq LIMIT 1", (now,)
+                ).fetchone()
+                if row is None:
+                    return None
+                chunk_id, campaign_id, rows, attempts, last_owner = row
+                if attempts < self.max_attempts:
+                    break
+                # Its last worker died or hung holding it, again
+                self._fail_chunk(conn, chunk_id, campaign_id, rows, last_owner,
+                                 f"Gave up after {attempts} attempts (lease expired)")
+            conn.execute("UPDATE chunks SET state = 'leased', owner = ?, lease_until = ?, attempts = attempts + 1 "
+                         "WHERE id = ?", (owner, now + lease_seconds, chunk_id))
+            return Lease(chunk_id, campaign_id, [tuple(r) for r in json.loads(rows)], owner, attempts + 1)
+
+        return self._transaction(claim)
+
+    def heartbeat(self, lease, lease_seconds=DEFAULT_LEASE_SECONDS):
+        """Extend a lease; returns False if it has been lost to another worker"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE chunks SET lease_until = ? WHERE id = ? AND owner = ? AND state = 'leased'",
+                (self.clock() + lease_seconds, lease.chunk_id, lease.owner)
+            )
+        return cursor.rowcount == 1
+
+    def finished_keys(self, lease):
+        """Return the keys in a leased chunk that already have a recorded outcome"""
+        keys = [key for key, _ in lease.rows]
+        with self._lock:
+            found = self._conn.execute(
+                f"SELECT row_key FROM results WHERE campaign_id = ? AND row_key IN ({','.join('?' * len(keys))})",
+                [lease.campaign_id] + keys
+            ).fetchall() if keys else []
+        return {key for key, in found}
+
+    def record(self, lease, key, status, message=None, account=None):
+        """Record a recipient's final outcome; the first outcome recorded wins"""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO results (campaign_id, row_key, status, message, account, worker, finished) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (lease.campaign_id, str(key), status, message, account, lease.owner, self.clock())
+            )
+
+    def release(self, lease, done, error=None):
+        """Give a chunk back: marked done, returned to pending for another worker, or failed after max_attempts"""
+        def release(conn):
+            if not done and lease.attempts >= self.max_attempts:
+                owned = conn.execute("SELECT rows FROM chunks WHERE id = ? AND owner = ?",
+                                     (lease.chunk_id, lease.owner)).fetchone()
+                if owned is not None:
+                    self._fail_chunk(conn, lease.chunk_id, lease.campaign_id, owned[0], lease.owner,
+                                     f"Gave up after {lease.attempts} attempts: {error or 'not finished'}")
+                return
+            conn.execute(
+                "UPDATE chunks SET state = ?, owner = NULL, lease_until = NULL WHERE id = ? AND owner = ?",
+                ('done' if done else 'pending', lease.chunk_id, lease.owner)
+            )
+
+        self._transaction(release)
+
+    def cancel(self, campaign_id):
+        """Stop handing out a campaign's chunks; leased chunks finish their current sends"""
+        with self._lock:
+            self._conn.execute("UPDATE campaigns SET cancelled = 1 WHERE id = ?", (campaign_id,))
+
+    def campaigns(self):
+        """Return a CampaignStatus for every queued campaign, newest first"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT campaigns.id, campaigns.name, campaigns.total, "
+                "(SELECT COUNT(*) FROM results WHERE campaign_id = campaigns.id AND status = 'sent'), "
+                "(SELECT COUNT(*) FROM results WHERE campaign_id = campaigns.id AND status = 'failed'), "
+                "(SELECT COUNT(*) FROM results WHERE campaign_id = campaigns.id AND status = 'skipped'), "
+                "(SELECT COUNT(*) FROM chunks WHERE campaign_id = campaigns.id AND state = 'leased' "
+                " AND lease_until >= ?), "
+                "campaigns.cancelled "
+                "FROM campaigns ORDER BY campaigns.id DESC", (self.clock(),)
+            ).fetchall()
+        return [CampaignStatus(*row[:7], bool(row[7])) for row in rows]
+
+
+def render_job(key, row, context):
+    """Build the SendJob for one queued row"""
+    payload = context.payload
+    email = row.get(payload['email_col'])
+    # Suppressed rows and undeliverable domains were found by the front end when the campaign was queued
+    skip_reason = payload.get('skip', {}).get(str(key))
+    prefetched = context.prefetcher.load_row(row) if not skip_reason and not is_missing(email) else None
+    settled = settled_job(key, email, skip_reason, prefetched)
+    if settled is not None:
+        return settled
+    subject = render_template(payload['subject'], {**row, 'Name': row.get(payload.get('name_col'))})
+    return SendJob(key, email, subject, render_template(context.body, row),
+                   context.attachments + prefetched.attachments, reply_to=payload.get('reply_to'),
+                   inline_images=context.inline_images, body_encoding=context.body_encoding)
+
+
+class CampaignContext:
+    """A worker's engine and attachments for the campaign it is working on"""
+
+    def __init__(self, payload, passwords, prompt=False):
+        self.payload = payload
+        # Campaigns queued after the worker started may use accounts it has no password for yet
+        self.passwords = load_passwords([a['name'] for a in payload['accounts'] if not is_local(a.get('server'))],
+                                        prompt, passwords)
+        self.store = AttachmentStore()
+        try:
+            self.attachments = [self.store.add_path(a['path'], a.get('filename'))
+                                for a in payload.get('attachments', [])]
+            self.store.prepare()
+        except BaseException:
+            self.store.close()
+            raise
+        # Pasted images become shared cid: parts; the HTML is optimized once per campaign
+        self.body, self.inline_images = prepare_body(payload['body'])
+        self.body_encoding = choose_body_encoding(self.body, eight_bit=True)
+        self.prefetcher = AttachmentPrefetcher(payload.get('attachment_col'), base_dir=payload.get('attachment_dir'),
+                                               confine=True,
+                                               message_bytes=message_size(self.body, self.attachments + self.inline_images))
+        self.engine = None
+
+    def get_engine(self):
+        # A stopped engine cannot be reused, so a lost lease means a fresh one
+        if self.engine is None or self.engine.stopped:
+            if self.engine is not None:
+                self.engine.close()
+            accounts = accounts_from_config(self.payload['accounts'], self.passwords)
+            self.engine = SendEngine(accounts, retry_policy=RetryPolicy(max_attempts=self.payload.get('max_attempts', 4)),
+                                     governor=shared_governor())
+        return self.engine
+
+    def close(self):
+        if self.engine is not None:
+            self.engine.close()
+        self.store.close()
+
+
+def process_lease(work_queue, lease, context, lease_seconds=DEFAULT_LEASE_SECONDS, log=print):
+    """Send one leased chunk, heartbeating until done; returns the number of outcomes recorded"""
+    engine = context.get_engine()
+    lost = threading.Event()
+    finished = threading.Event()
+
+    def heartbeat():
+        while not finished.wait(lease_seconds / 3):
+            if not work_queue.heartbeat(lease, lease_seconds):
+                log(f"⚠️ Lost lease on chunk {lease.chunk_id}; stopping")
+                lost.set()
+                engine.stop()
+                return
+
+    done = work_queue.finished_keys(lease)
+
+    def make_jobs():
+        for key, row in lease.rows:
+            if lost.is_set():
+                return
+            if key not in done:
+                yield render_job(key, row, context)
+
+    beat = threading.Thread(target=heartbeat, name=f"lease-{lease.chunk_id}", daemon=True)
+    beat.start()
+    recorded = 0
+    unfinished = 0
+    error = None
+    try:
+        for result in engine.run(make_jobs()):
+            if result.status == 'skipped' and not result.job.skip_reason:
+                # Stopped before sending: leave it for whoever takes the chunk next
+                unfinished += 1
+                continue
+            work_queue.record(lease, result.job.key, result.status, result.message, result.account)
+            recorded += 1
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        finished.set()
+        beat.join()
+        complete = not lost.is_set() and unfinished == 0 and len(done) + recorded == len(lease.rows)
+        work_queue.release(lease, done=complete, error=error)
+    return recorded
+
+
+def run_worker(work_queue, passwords=None, owner=None, lease_seconds=DEFAULT_LEASE_SECONDS, wait=False,
+               poll_interval=5.0, stop_event=None, log=print, prompt=False):
+    """Claim and send chunks until the queue is empty (or forever with `wait`)
+
+    Passwords missing from `passwords` are looked up per campaign (see
+    load_passwords) and remembered for later campaigns.
+    """
+    owner = owner or default_worker_id()
+    passwords = dict(passwords or {})
+    stop_event = stop_event or threading.Event()
+    contexts = {}
+    try:
+        while not stop_event.is_set():
+            lease = work_queue.claim(owner, lease_seconds)
+            if lease is None:
+                if not wait:
+                    break
+                stop_event.wait(poll_interval)
+                continue
+
+            if lease.campaign_id not in contexts:
+                # Keep one campaign's connections open at a time
+                for context in contexts.values():
+                    context.close()
+                contexts = {}
+                try:
+                    contexts[lease.campaign_id] = CampaignContext(work_queue.payload(lease.campaign_id), passwords,
+                                                                   prompt)
+                except Exception as e:
+                    # e.g. its attachments are missing; other campaigns can still be sent
+                    log(f"❌ {owner}: cannot set up campaign {lease.campaign_id}: {e}")
+                    work_queue.release(lease, done=False, error=e)
+                    continue
+                if not work_queue.heartbeat(lease, lease_seconds):
+                    # Lost while waiting for a password to be typed in
+                    continue
+            try:
+                count = process_lease(work_queue, lease, contexts[lease.campaign_id], lease_seconds, log)
+            except Exception as e:
+                # The chunk is back in the queue (or failed for good); this worker carries on
+                log(f"❌ {owner}: chunk {lease.chunk_id} of campaign {lease.campaign_id} failed: {e}")
+            else:
+                log(f"📦 {owner}: chunk {lease.chunk_id} of campaign {lease.campaign_id} — {count} recipients done")
+            work_queue.remove_files(lease.campaign_id)
+    finally:
+        for context in contexts.values():
+            context.close()
+
+
+def load_passwords(account_names, prompt=True, passwords=None):
+    """Read account passwords from the environment, prompting for any that are missing
+
+    Passwords already in `passwords` are kept, and the ones found are added to it.
+    """
+    passwords = passwords if passwords is not None else {}
+    from_env = json.loads(os.environ.get(PASSWORDS_ENV) or '{}')
+    for name in account_names:
+        if name in passwords:
+            continue
+        if name in from_env:
+            passwords[name] = from_env[name]
+        elif prompt:
+            passwords[name] = getpass.getpass(f"Password for {name}: ")
+    return passwords
+
+
+def start_process(args, passwords):
+    """Start a Python script (a worker or spool dispatcher) in the background and return its Popen
+
+    Passwords reach it through its environment, never a file. A thread waits
+    on it, so a long-running app is not left with a zombie for every process
+    that has finished.
+    """
+    env = dict(os.environ, **{PASSWORDS_ENV: json.dumps(passwords)})
+    process = subprocess.Popen([sys.executable] + list(args), env=env, stdin=subprocess.DEVNULL)
+    threading.Thread(target=process.wait, name=f'reap-{process.pid}', daemon=True).start()
+    return process
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send queued campaign chunks")
+    parser.add_argument('queue', help="Path to the shared SQLite queue file")
+    parser.add_argument('--worker-id', help="Name recorded against leases (default: host-pid)")
+    parser.add_argument('--lease', type=float, default=DEFAULT_LEASE_SECONDS, help="Lease length in seconds")
+    parser.add_argument('--wait', action='store_true', help="Keep polling for new campaigns when the queue is empty")
+    parser.add_argument('--no-prompt', action='store_true', help=f"Take passwords only from ${PASSWORDS_ENV}")
+    args = parser.parse_args(argv)
+
+    work_queue = WorkQueue(args.queue)
+    try:
+        run_worker(work_queue, owner=args.worker_id, lease_seconds=args.lease, wait=args.wait,
+                   prompt=not args.no_prompt and sys.stdin.isatty())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        work_queue.close()
+
+
+if __name__ == '__main__':
+    main()